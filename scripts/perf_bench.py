@@ -0,0 +1,488 @@
+#!/usr/bin/env python3
+from __future__ import annotations
+
+import argparse
+import asyncio
+import base64
+import email
+import email.message
+import html as ihtml
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import TYPE_CHECKING, Callable
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+import tg_email
+
+if TYPE_CHECKING:
+    from quart import Quart, Response
+
+
+def cpu_time(fn: Callable[[], object], repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.process_time()
+        fn()
+        best = min(best, time.process_time() - started)
+    return best
+
+
+def print_comparison(label: str, before: float, after: float) -> None:
+    saved = before - after
+    ratio = before / after if after else float("inf")
+    print(f"{label}")
+    print(f"  before: {before * 1000:.2f} ms CPU")
+    print(f"  after:  {after * 1000:.2f} ms CPU")
+    print(f"  saved:  {saved * 1000:.2f} ms CPU ({ratio:.1f}x)")
+
+
+def legacy_format_email_text(
+    state: tg_email.EmailState,
+    *,
+    body_override: str | None = None,
+    status_line: str | None = None,
+) -> str:
+    body_text = (body_override if body_override is not None else state.body)[: tg_email.TELEGRAM_MAX]
+    parts = [
+        f"📧 <b>{ihtml.escape(state.subject or '(senza oggetto)')}</b>",
+        "",
+        ihtml.escape(body_text),
+    ]
+    if status_line:
+        parts.extend(["", "---", ihtml.escape(status_line)])
+    return "\n".join(parts)
+
+
+def cmd_render(args: argparse.Namespace) -> int:
+    body = ("Caro <team> & partner, \"ecco\" il resoconto trimestrale. " * 200)[: tg_email.TELEGRAM_MAX]
+    chunk = "Grazie per l'aggiornamento <dettagliato> & puntuale. "[: args.chunk_size]
+    stream: list[str] = []
+    accumulated = ""
+    while len(accumulated) + len(chunk) < tg_email.TELEGRAM_MAX:
+        accumulated += chunk
+        stream.append(accumulated)
+
+    def make_state() -> tg_email.EmailState:
+        return tg_email.EmailState(
+            tg_message_id=424242,
+            gmail_message_id="bench",
+            gmail_thread_id="bench",
+            sender="sender@example.com",
+            subject="Resoconto <Q3> & budget",
+            body=body,
+            header="",
+            attachments=[],
+            starred=False,
+            lang="it",
+        )
+
+    def run_stream(formatter: Callable[..., str]) -> None:
+        for _ in range(args.streams):
+            state = make_state()
+            for partial in stream:
+                formatter(state, body_override=partial, status_line="Analisi AI in corso…")
+
+    def run_pixel_edits(formatter: Callable[..., str]) -> None:
+        for index in range(args.pixel_edits):
+            formatter(make_state(), status_line=f"✅ apertura utente probabile · evento {index}")
+
+    state = make_state()
+    for partial in stream:
+        assert legacy_format_email_text(state, body_override=partial, status_line="x") == tg_email.format_email_text(
+            state, body_override=partial, status_line="x"
+        )
+
+    print(f"AI stream: {len(stream)} edits x {args.streams} streams, {len(chunk)} chars per chunk")
+    print_comparison(
+        "format_email_text during AI streaming",
+        cpu_time(lambda: run_stream(legacy_format_email_text), args.repeat),
+        cpu_time(lambda: run_stream(tg_email.format_email_text), args.repeat),
+    )
+    print(f"Pixel status edits: {args.pixel_edits}")
+    print_comparison(
+        "format_email_text for pixel status edits",
+        cpu_time(lambda: run_pixel_edits(legacy_format_email_text), args.repeat),
+        cpu_time(lambda: run_pixel_edits(tg_email.format_email_text), args.repeat),
+    )
+    return 0
+
+
+def legacy_append_tracking_to_raw(raw: str, tracking_markup: str) -> str:
+    message = tg_email.parse_raw_email_message(raw)
+    html_part: email.message.EmailMessage | None = None
+    for part in message.walk():
+        if part.is_multipart():
+            continue
+        if part.get_content_type() == "text/html":
+            html_part = part
+            break
+    if html_part is None:
+        raise RuntimeError("benchmark drafts always carry an html part")
+    html_body = html_part.get_content()
+    if tracking_markup not in html_body:
+        html_body += tracking_markup
+        charset = html_part.get_content_charset() or "utf-8"
+        html_part.set_content(html_body, subtype="html", charset=charset)
+    return tg_email.encode_raw_email_message(message)
+
+
+def legacy_draft_headers_from_raw(raw: str) -> tuple[str, str]:
+    message = tg_email.parse_raw_email_message(raw)
+    return tg_email.decode_hdr(message.get("Subject") or ""), tg_email.parseaddr(message.get("To") or "")[1].strip()
+
+
+def build_inline_image_draft(image_bytes: int, images: int) -> str:
+    message = email.message.EmailMessage()
+    message["To"] = "Lead <lead@example.com>"
+    message["Subject"] = "Proposta commerciale"
+    message.set_content("Buongiorno,\nin allegato la proposta.\n")
+    inline = "".join(f'<img src="cid:img{index}">' for index in range(images))
+    message.add_alternative(f"<p>Buongiorno,</p><p>in allegato la proposta.</p>{inline}", subtype="html")
+    html_part = message.get_payload()[1]
+    for index in range(images):
+        html_part.add_related(os.urandom(image_bytes), "image", "png", cid=f"<img{index}>")
+    return base64.urlsafe_b64encode(message.as_bytes()).decode()
+
+
+def cmd_tracking_inject(args: argparse.Namespace) -> int:
+    markup = '<img src="https://tracker.example/track/img/2x1/token.png" width="2" height="1" alt="">'
+    raw = build_inline_image_draft(args.image_kb * 1024, args.images)
+
+    def legacy() -> None:
+        final_raw = legacy_append_tracking_to_raw(raw, markup)
+        legacy_draft_headers_from_raw(final_raw)
+
+    def single_pass() -> None:
+        tg_email.prepare_tracked_raw(raw, markup)
+
+    print(f"Draft: {args.images} inline image(s) x {args.image_kb} KB, {len(raw) / 1024 / 1024:.1f} MB raw")
+    print_comparison(
+        "tracking injection + Subject/To extraction",
+        cpu_time(legacy, args.repeat),
+        cpu_time(single_pass, args.repeat),
+    )
+    return 0
+
+
+LEGACY_PIXEL_HEADERS = {
+    "cache-control": "private, no-cache, no-store, max-age=0, s-maxage=0, must-revalidate, proxy-revalidate",
+    "pragma": "no-cache",
+    "expires": "0",
+    "surrogate-control": "no-store",
+    "cdn-cache-control": "no-store",
+    "cloudflare-cdn-cache-control": "no-store",
+    "vary": "User-Agent, Accept, Accept-Language, Sec-Fetch-Dest, Sec-Fetch-Mode, Sec-Fetch-Site, Purpose, Sec-Purpose, X-Gmail-Fetch-Info",
+    "x-content-type-options": "nosniff",
+    "access-control-allow-origin": "*",
+    "timing-allow-origin": "*",
+    "accept-ranges": "none",
+}
+
+
+def legacy_pixel_asset_response(kind: str) -> Response:
+    from quart import Response
+
+    headers = dict(LEGACY_PIXEL_HEADERS)
+    if kind == "font":
+        return Response(tg_email.PIXEL_PROBE_FONT, headers={**headers, "content-type": "font/woff2"})
+    return Response(tg_email.TRANSPARENT_PNG_2X1, headers={**headers, "content-type": "image/png"})
+
+
+def build_pixel_asset_app() -> Quart:
+    from quart import Quart
+
+    app = Quart("perf_bench")
+
+    @app.get("/before/track/img/<dims>/<token>.png")
+    async def before(dims: str, token: str):
+        return legacy_pixel_asset_response("image")
+
+    @app.get("/after/track/img/<dims>/<token>.png")
+    async def after(dims: str, token: str):
+        return tg_email.pixel_asset_response("image")
+
+    return app
+
+
+def start_bench_server(app: Quart, port: int) -> threading.Event:
+    from hypercorn.asyncio import serve
+    from hypercorn.config import Config as HypercornConfig
+
+    shutdown = threading.Event()
+    config = HypercornConfig()
+    config.bind = [f"127.0.0.1:{port}"]
+    config.accesslog = None
+    config.errorlog = None
+
+    async def shutdown_trigger() -> None:
+        while not shutdown.is_set():
+            await asyncio.sleep(0.05)
+
+    thread = threading.Thread(
+        target=lambda: asyncio.run(serve(app, config, shutdown_trigger=shutdown_trigger)),
+        daemon=True,
+    )
+    thread.start()
+    deadline = time.monotonic() + 10
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(("127.0.0.1", port), timeout=0.2).close()
+            return shutdown
+        except OSError:
+            time.sleep(0.05)
+    raise RuntimeError("hypercorn did not start")
+
+
+async def keepalive_client(port: int, path: str, requests: int) -> None:
+    reader, writer = await asyncio.open_connection("127.0.0.1", port)
+    request = f"GET {path} HTTP/1.1\r\nHost: 127.0.0.1\r\nUser-Agent: perf-bench\r\n\r\n".encode()
+    try:
+        for _ in range(requests):
+            writer.write(request)
+            head = await reader.readuntil(b"\r\n\r\n")
+            if not head.startswith(b"HTTP/1.1 200"):
+                raise RuntimeError(head.split(b"\r\n", 1)[0].decode())
+            length = 0
+            for line in head.split(b"\r\n"):
+                name, _, value = line.partition(b":")
+                if name.strip().lower() == b"content-length":
+                    length = int(value)
+            await reader.readexactly(length)
+    finally:
+        writer.close()
+
+
+def requests_per_second(port: int, path: str, requests: int, concurrency: int) -> float:
+    per_client = max(1, requests // concurrency)
+
+    async def run() -> float:
+        started = time.perf_counter()
+        await asyncio.gather(*(keepalive_client(port, path, per_client) for _ in range(concurrency)))
+        return per_client * concurrency / (time.perf_counter() - started)
+
+    return asyncio.run(run())
+
+
+def cmd_pixel_asset(args: argparse.Namespace) -> int:
+    shutdown = start_bench_server(build_pixel_asset_app(), args.port)
+    token = "A" * 36
+    try:
+        for prefix in ("before", "after"):
+            requests_per_second(args.port, f"/{prefix}/track/img/2x1/{token}.png", args.concurrency * 10, args.concurrency)
+        results: dict[str, float] = {"before": 0.0, "after": 0.0}
+        for _ in range(args.repeat):
+            for prefix in ("before", "after"):
+                path = f"/{prefix}/track/img/2x1/{token}.png"
+                results[prefix] = max(results[prefix], requests_per_second(args.port, path, args.requests, args.concurrency))
+    finally:
+        shutdown.set()
+    print(f"/track/img under hypercorn: {args.requests} requests, {args.concurrency} keep-alive connections")
+    print(f"  before: {results['before']:.0f} req/s")
+    print(f"  after:  {results['after']:.0f} req/s")
+    print(f"  gain:   {(results['after'] / results['before'] - 1) * 100:+.1f}%")
+
+    def build_responses(factory: Callable[[str], object]) -> None:
+        for index in range(args.requests):
+            factory("font" if index % 2 else "image")
+
+    print_comparison(
+        f"pixel asset response construction x {args.requests}",
+        cpu_time(lambda: build_responses(legacy_pixel_asset_response), args.repeat),
+        cpu_time(lambda: build_responses(tg_email.pixel_asset_response), args.repeat),
+    )
+    return 0
+
+
+def cmd_rescore(args: argparse.Namespace) -> int:
+    classifications = [("human_browser", 1), ("font_loader", 1), ("gmail_proxy", 0), ("unknown_proxy", None)]
+    base = tg_email.datetime(2026, 1, 1, tzinfo=tg_email.timezone.utc)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        store = tg_email.StateStore(Path(tmpdir) / "state.db")
+        with store._conn:  # noqa: SLF001 - benchmark only
+            store._conn.executemany(
+                "INSERT INTO tracked_emails (tg_message_id, draft_id, recipient, subject, open_count, created_at, updated_at) "
+                "VALUES (?, '', '', '', 0, '', '')",
+                [(tg_message_id,) for tg_message_id in range(args.emails)],
+            )
+            store._conn.executemany(
+                "INSERT INTO pixel_events (tg_message_id, classification, layer, dimensions, confidence, is_user_open, "
+                "email_subject, created_at) VALUES (?, ?, 'img', '2x1', 0.5, ?, '', ?)",
+                [
+                    (
+                        tg_message_id,
+                        *classifications[index % len(classifications)],
+                        (base + tg_email.timedelta(seconds=tg_message_id * 3600 + index * 47)).isoformat(),
+                    )
+                    for tg_message_id in range(args.emails)
+                    for index in range(args.events)
+                ],
+            )
+
+        def per_row() -> None:
+            for tg_message_id in range(args.emails):
+                store.get_tracked_email(tg_message_id)
+
+        print(f"History: {args.emails} tracked emails x {args.events} pixel events")
+        print_comparison(
+            "session counts for every tracked email",
+            cpu_time(per_row, args.repeat),
+            cpu_time(store.tracked_session_counts, args.repeat),
+        )
+        store.close()
+    return 0
+
+
+HEAVY_IMPORTS = (
+    "google.auth.transport.requests",
+    "google.generativeai",
+    "google_auth_oauthlib.flow",
+    "googleapiclient.discovery",
+    "hypercorn.asyncio",
+    "hypercorn.config",
+    "quart",
+    "telegram.ext",
+)
+REPO_ROOT = Path(__file__).resolve().parents[1]
+
+
+def import_time_us(code: str) -> int:
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", code],
+        cwd=REPO_ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    total = 0
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:"):
+            continue
+        _, cumulative, name = line.split("|", 2)
+        if cumulative.strip().isdigit() and not name.startswith("  "):
+            total += int(cumulative)
+    return total
+
+
+def cmd_import_time(args: argparse.Namespace) -> int:
+    eager = "import " + ", ".join(HEAVY_IMPORTS) + "; import tg_email"
+    lazy = "import tg_email"
+    before = min(import_time_us(eager) for _ in range(args.repeat))
+    after = min(import_time_us(lazy) for _ in range(args.repeat))
+    print(f"import tg_email (best of {args.repeat}, python -X importtime)")
+    print(f"  eager SDK imports: {before / 1000:.1f} ms")
+    print(f"  lazy SDK imports:  {after / 1000:.1f} ms")
+    print(f"  saved:             {(before - after) / 1000:.1f} ms")
+    return 0
+
+
+def legacy_apply_runtime_overrides(runtime: tg_email.Runtime) -> None:
+    rows = runtime.store._conn.execute("SELECT key, value FROM app_settings ORDER BY key").fetchall()  # noqa: SLF001 - benchmark only
+    overrides = {row["key"]: row["value"] or "" for row in rows}
+    merged = runtime.base_config.with_overrides(runtime.startup_overrides).with_overrides(overrides)
+    merged.validate_effective(runtime.mode)
+    runtime.config = merged
+    runtime.gmail.config = runtime.config
+    runtime.config.materialize_google_credentials()
+    runtime.config.materialize_gmail_token()
+    runtime.gmail.invalidate()
+    if runtime.config.google_api_key:
+        runtime.model = tg_email.build_gemini_model(runtime.config.google_api_key, runtime.config.ai_model)
+    else:
+        runtime.model = None
+
+
+def cmd_settings_save(args: argparse.Namespace) -> int:
+    token_json = tg_email.json.dumps({"token": "t", "refresh_token": "r", "client_id": "c", "client_secret": "s"})
+    credentials_json = tg_email.json.dumps({"web": {"client_id": "c", "client_secret": "s", "project_id": "p"}})
+    with tempfile.TemporaryDirectory() as tmpdir:
+        config = tg_email.Config.from_env({"TELEGRAM_BOT_TOKEN": "token", "DATA_DIR": tmpdir})
+        store = tg_email.StateStore(Path(tmpdir) / "state.db")
+        for key, value in {
+            "GOOGLE_API_KEY": "bench-key",
+            "GOOGLE_OAUTH_CREDENTIALS_JSON": credentials_json,
+            "GOOGLE_OAUTH_TOKEN_JSON": token_json,
+        }.items():
+            store.set_app_setting(key, value)
+        runtime = tg_email.Runtime(
+            base_config=config,
+            config=config,
+            startup_overrides={},
+            store=store,
+            gmail=tg_email.GmailClient(config),
+            model=None,
+            shutdown_event=asyncio.Event(),
+            mode="polling",
+        )
+        tg_email.apply_runtime_overrides(runtime)
+
+        def save_many(apply: Callable[[tg_email.Runtime], object]) -> None:
+            for index in range(args.saves):
+                store.set_app_setting("WATCH_INTERVAL", str(30 + index % 2))
+                apply(runtime)
+
+        print(f"{args.saves} settings saves (WATCH_INTERVAL toggled, OAuth JSON and Gemini key configured)")
+        print_comparison(
+            "set_app_setting + apply_runtime_overrides",
+            cpu_time(lambda: save_many(legacy_apply_runtime_overrides), args.repeat),
+            cpu_time(lambda: save_many(tg_email.apply_runtime_overrides), args.repeat),
+        )
+        store.close()
+    return 0
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser()
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    render = subparsers.add_parser("render")
+    render.add_argument("--streams", type=int, default=20)
+    render.add_argument("--chunk-size", type=int, default=40)
+    render.add_argument("--pixel-edits", type=int, default=2000)
+    render.add_argument("--repeat", type=int, default=5)
+    render.set_defaults(func=cmd_render)
+
+    tracking_inject = subparsers.add_parser("tracking-inject")
+    tracking_inject.add_argument("--image-kb", type=int, default=2048)
+    tracking_inject.add_argument("--images", type=int, default=3)
+    tracking_inject.add_argument("--repeat", type=int, default=3)
+    tracking_inject.set_defaults(func=cmd_tracking_inject)
+
+    pixel_asset = subparsers.add_parser("pixel-asset")
+    pixel_asset.add_argument("--requests", type=int, default=5000)
+    pixel_asset.add_argument("--concurrency", type=int, default=16)
+    pixel_asset.add_argument("--port", type=int, default=8765)
+    pixel_asset.add_argument("--repeat", type=int, default=3)
+    pixel_asset.set_defaults(func=cmd_pixel_asset)
+
+    rescore = subparsers.add_parser("rescore")
+    rescore.add_argument("--emails", type=int, default=500)
+    rescore.add_argument("--events", type=int, default=40)
+    rescore.add_argument("--repeat", type=int, default=3)
+    rescore.set_defaults(func=cmd_rescore)
+
+    import_time = subparsers.add_parser("import-time")
+    import_time.add_argument("--repeat", type=int, default=5)
+    import_time.set_defaults(func=cmd_import_time)
+
+    settings_save = subparsers.add_parser("settings-save")
+    settings_save.add_argument("--saves", type=int, default=200)
+    settings_save.add_argument("--repeat", type=int, default=3)
+    settings_save.set_defaults(func=cmd_settings_save)
+
+    return parser.parse_args()
+
+
+def main() -> int:
+    args = parse_args()
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -6,6 +6,8 @@ import base64
 import hashlib
 import hmac
 import json
+import os
+import struct
 import threading
 from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 from pathlib import Path
@@ -17,6 +19,12 @@ def b64url_encode(data: bytes) -> str:
 
 
 def make_token(secret: str, tg_message_id: int) -> str:
+    body = struct.pack(">BQ6s", 1, tg_message_id, os.urandom(6))
+    signature = hmac.new(secret.encode(), body, hashlib.sha256).digest()[:12]
+    return b64url_encode(body + signature)
+
+
+def make_legacy_token(secret: str, tg_message_id: int) -> str:
     payload = b64url_encode(
         json.dumps({"tg": tg_message_id, "nonce": uuid4().hex}, separators=(",", ":")).encode()
     )
@@ -24,8 +32,13 @@ def make_token(secret: str, tg_message_id: int) -> str:
     return f"{payload}.{signature}"
 
 
-def build_bundle(base_url: str, secret: str, tg_message_id: int) -> tuple[dict[str, str], str]:
-    token = make_token(secret, tg_message_id)
+def build_bundle(
+    base_url: str,
+    secret: str,
+    tg_message_id: int,
+    legacy_token: bool = False,
+) -> tuple[dict[str, str], str]:
+    token = (make_legacy_token if legacy_token else make_token)(secret, tg_message_id)
     nonce = uuid4().hex[:10]
     base_url = base_url.rstrip("/")
     urls = {
@@ -73,7 +86,7 @@ def build_bundle(base_url: str, secret: str, tg_message_id: int) -> tuple[dict[s
 
 
 def cmd_bundle(args: argparse.Namespace) -> int:
-    urls, html = build_bundle(args.base_url, args.secret, args.tg_id)
+    urls, html = build_bundle(args.base_url, args.secret, args.tg_id, args.legacy_token)
     out_path = Path(args.out)
     out_path.parent.mkdir(parents=True, exist_ok=True)
     out_path.write_text(html)
@@ -145,6 +158,7 @@ def parse_args() -> argparse.Namespace:
     bundle.add_argument("--base-url", required=True)
     bundle.add_argument("--secret", required=True)
     bundle.add_argument("--tg-id", type=int, default=424242)
+    bundle.add_argument("--legacy-token", action="store_true")
     bundle.add_argument(
         "--out",
         default="output/pixel-smoke/pixel-fixture.html",
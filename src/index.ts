@@ -76,10 +76,17 @@ function parseTrackRequest(url: URL): TrackRequest {
   };
 }
 
+const COMPACT_TOKEN_VERSION = 1;
+const COMPACT_TOKEN_BODY_BYTES = 15;
+const COMPACT_TOKEN_MAC_BYTES = 12;
+
 async function parseToken(token: string, secret: string): Promise<TokenPayload> {
   if (!secret) {
     throw new Error("Missing PIXEL_WEBHOOK_SECRET");
   }
+  if (!token.includes(".")) {
+    return parseCompactToken(token, secret);
+  }
   const [payload, signature] = token.split(".");
   if (!payload || !signature) {
     throw new Error("Malformed token");
@@ -95,7 +102,26 @@ async function parseToken(token: string, secret: string): Promise<TokenPayload>
   return decoded;
 }
 
+async function parseCompactToken(token: string, secret: string): Promise<TokenPayload> {
+  const data = base64UrlToBytes(token);
+  if (data.length !== COMPACT_TOKEN_BODY_BYTES + COMPACT_TOKEN_MAC_BYTES || data[0] !== COMPACT_TOKEN_VERSION) {
+    throw new Error("Malformed token");
+  }
+  const body = data.slice(0, COMPACT_TOKEN_BODY_BYTES);
+  const digest = await signBytes(secret, body);
+  if (!timingSafeEqualBytes(digest.slice(0, COMPACT_TOKEN_MAC_BYTES), data.slice(COMPACT_TOKEN_BODY_BYTES))) {
+    throw new Error("Invalid token signature");
+  }
+  const tg = Number(new DataView(body.buffer, body.byteOffset, body.byteLength).getBigUint64(1));
+  const nonce = Array.from(body.slice(9), (byte) => byte.toString(16).padStart(2, "0")).join("");
+  return { tg, nonce };
+}
+
 async function signPayload(secret: string, payload: string): Promise<string> {
+  return bytesToBase64Url(await signBytes(secret, new TextEncoder().encode(payload)));
+}
+
+async function signBytes(secret: string, data: Uint8Array): Promise<Uint8Array> {
   const key = await crypto.subtle.importKey(
     "raw",
     new TextEncoder().encode(secret),
@@ -103,8 +129,8 @@ async function signPayload(secret: string, payload: string): Promise<string> {
     false,
     ["sign"],
   );
-  const digest = await crypto.subtle.sign("HMAC", key, new TextEncoder().encode(payload));
-  return bytesToBase64Url(new Uint8Array(digest));
+  const digest = await crypto.subtle.sign("HMAC", key, data);
+  return new Uint8Array(digest);
 }
 
 function classifyTrackRequest(
@@ -285,3 +311,14 @@ function timingSafeEqual(left: string, right: string): boolean {
   }
   return result === 0;
 }
+
+function timingSafeEqualBytes(left: Uint8Array, right: Uint8Array): boolean {
+  if (left.length !== right.length) {
+    return false;
+  }
+  let result = 0;
+  for (let index = 0; index < left.length; index += 1) {
+    result |= left[index] ^ right[index];
+  }
+  return result === 0;
+}
@@ -2,17 +2,32 @@ from __future__ import annotations
 
 import asyncio
 import base64
+import email
+import email.message
+import email.policy
+import hashlib
+import hmac
 import json
+import re
+import sqlite3
+import subprocess
+import sys
 import tempfile
+import threading
 import unittest
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
 from types import SimpleNamespace
+from typing import Any, List
 from unittest.mock import AsyncMock, patch
 
+from google.oauth2.credentials import Credentials
 from googleapiclient.errors import HttpError
 
 from tg_email import (
+    AttachmentCache,
+    BOT_CONFIG_ALIASES,
+    EDITABLE_DASHBOARD_FIELDS,
     GMAIL_INITIAL_SYNC_KEY,
     GMAIL_HISTORY_ID_KEY,
     GOOGLE_OAUTH_STATE_KEY,
@@ -22,6 +37,8 @@ from tg_email import (
     DEFAULT_PROMPT,
     EmailState,
     GmailClient,
+    LRUCache,
+    ParsedMessage,
     StateStore,
     TrackedEmail,
     build_candidate_config,
@@ -29,8 +46,15 @@ from tg_email import (
     claim_owner,
     append_tracking_to_raw,
     build_raw,
+    bootstrap_services,
+    build_tracking_markup_for_message_id,
     create_web_app,
     draft_headers_from_raw,
+    format_email_text,
+    format_user_datetime,
+    drain_pending_gmail_pushes,
+    gmail_forward,
+    gmail_recent_monitored_ids,
     gmail_initial_sync_pending,
     help_message_text,
     google_oauth_state_payload,
@@ -44,10 +68,29 @@ from tg_email import (
     is_authorized_update,
     google_oauth_authorization_response,
     parse_google_oauth_state_payload,
+    parse_tracking_token,
     payload_text,
+    persist_refreshed_gmail_token,
+    BOOT_GMAIL_PUSH_QUEUE_SIZE,
+    BootTimer,
+    GmailExecutor,
+    CONFIG_OVERRIDE_FIELDS,
+    CredentialFileTracker,
+    apply_runtime_overrides,
+    LabelIndex,
+    kb_tag,
+    gmail_discovery_document,
+    PIXEL_ASSET_TEMPLATES,
+    PixelEvent,
+    PixelEventDeduper,
+    PixelFastPath,
     pixel_asset_response,
+    pixel_event_notification_text,
+    prepare_tracked_raw,
     save_runtime_settings,
+    send_email_attachment,
     setup_keyboard,
+    user_datetime_formatter,
     setup_message_text,
     split_unseen_inbox_ids,
     start_google_oauth,
@@ -56,10 +99,27 @@ from tg_email import (
     format_tracked_email_text,
     tracked_email_status_summary,
     tracked_stats_text,
+    tracking_markup_template,
+    tracking_token_signer,
     verify_dashboard_token,
 )
 
 
+def build_test_runtime(cfg: Config, store: Any, **overrides: Any) -> Runtime:
+    fields: dict[str, Any] = {
+        "base_config": cfg,
+        "config": cfg,
+        "startup_overrides": {},
+        "store": store,
+        "gmail": SimpleNamespace(config=cfg, invalidate=lambda: None),
+        "model": None,
+        "shutdown_event": SimpleNamespace(),
+        "mode": "polling",
+    }
+    fields.update(overrides)
+    return Runtime(**fields)
+
+
 class ConfigTests(unittest.TestCase):
     def test_from_env_builds_default_storage_paths(self) -> None:
         with tempfile.TemporaryDirectory() as tmpdir:
@@ -119,6 +179,47 @@ class ConfigTests(unittest.TestCase):
             stored = json.loads(cfg.gmail_token_path.read_text())
             self.assertEqual(stored["refresh_token"], "fresh-refresh-token")
 
+    def test_credential_tracker_skips_disk_when_source_is_unchanged(self) -> None:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            tracker = CredentialFileTracker()
+            path = Path(tmpdir) / "nested" / "token.json"
+
+            self.assertTrue(tracker.materialize(path, '{"token": "a"}'))
+            with patch.object(Path, "read_text", side_effect=AssertionError("disk read")):
+                self.assertFalse(tracker.materialize(path, '{"token": "a"}'))
+            self.assertEqual(tracker.stats(), {"reads": 1, "writes": 1, "reads_avoided": 1, "writes_avoided": 1})
+
+            self.assertTrue(tracker.materialize(path, '{"token": "b"}'))
+            path.unlink()
+            self.assertTrue(tracker.materialize(path, '{"token": "b"}'))
+            self.assertEqual(json.loads(path.read_text()), {"token": "b"})
+            self.assertEqual(list(path.parent.glob("*.tmp")), [])
+            self.assertEqual(tracker.writes, 3)
+
+    def test_refreshed_gmail_token_is_written_back_to_settings(self) -> None:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cfg = Config.from_env(
+                {
+                    "TELEGRAM_BOT_TOKEN": "token",
+                    "DATA_DIR": tmpdir,
+                    "GOOGLE_OAUTH_TOKEN_JSON": '{"token": "old", "refresh_token": "refresh"}',
+                }
+            )
+            cfg.materialize_gmail_token()
+            runtime = build_test_runtime(cfg, StateStore(Path(tmpdir) / "state.db"))
+            try:
+                cfg.gmail_token_path.write_text('{"token": "new", "refresh_token": "refresh"}', encoding="utf-8")
+                persist_refreshed_gmail_token(runtime)
+
+                saved = runtime.store.get_app_settings()["GOOGLE_OAUTH_TOKEN_JSON"]
+                self.assertEqual(json.loads(saved)["token"], "new")
+                self.assertIs(runtime.gmail.config, runtime.config)
+                restarted = cfg.with_overrides(runtime.store.get_app_settings())
+                restarted.materialize_gmail_token(force=True)
+                self.assertEqual(json.loads(cfg.gmail_token_path.read_text())["token"], "new")
+            finally:
+                runtime.store.close()
+
     def test_system_prompt_defaults_and_override(self) -> None:
         cfg = Config.from_env({"TELEGRAM_BOT_TOKEN": "token"})
         self.assertEqual(cfg.system_prompt, DEFAULT_PROMPT)
@@ -126,6 +227,22 @@ class ConfigTests(unittest.TestCase):
         overridden = cfg.with_overrides({"SYSTEM_PROMPT": "Prompt custom"})
         self.assertEqual(overridden.system_prompt, "Prompt custom")
 
+    def test_override_registry_covers_every_bot_config_key(self) -> None:
+        cfg = Config.from_env({"TELEGRAM_BOT_TOKEN": "token"})
+        self.assertEqual(
+            set(CONFIG_OVERRIDE_FIELDS),
+            set(BOT_CONFIG_ALIASES.values()) | {field.key for field in EDITABLE_DASHBOARD_FIELDS},
+        )
+        for key, spec in CONFIG_OVERRIDE_FIELDS.items():
+            self.assertTrue(hasattr(cfg, spec.attr), key)
+        overridden = cfg.with_overrides(
+            {"PORT": "9000", "ENABLE_PIXEL": "0", "LANG": "", "GMAIL_MONITOR_LABELS": "[]", "UNKNOWN": "x"}
+        )
+        self.assertEqual(overridden.port, 9000)
+        self.assertEqual(overridden.lang, cfg.lang)
+        self.assertEqual(overridden.gmail_monitor_labels, ["INBOX"])
+        self.assertEqual(overridden.changed_fields(cfg), {"port"})
+
     def test_gmail_monitor_labels_override(self) -> None:
         cfg = Config.from_env({"TELEGRAM_BOT_TOKEN": "token"})
         overridden = cfg.with_overrides(
@@ -458,6 +575,205 @@ class StateStoreTests(unittest.TestCase):
             self.assertIn("riapertura probabile 1 volta", tracked_email_status_summary(updated))
             store.close()
 
+    def test_epoch_ms_columns_migrate_pre_epoch_schema(self) -> None:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = Path(tmpdir) / "state.db"
+            legacy = sqlite3.connect(path)
+            with legacy:
+                legacy.execute(
+                    """
+                    CREATE TABLE tracked_emails (
+                        tg_message_id INTEGER PRIMARY KEY,
+                        draft_id TEXT,
+                        recipient TEXT NOT NULL,
+                        subject TEXT NOT NULL,
+                        open_count INTEGER NOT NULL DEFAULT 0,
+                        first_opened_at TEXT,
+                        last_opened_at TEXT,
+                        last_classification TEXT,
+                        last_layer TEXT,
+                        last_dimensions TEXT,
+                        last_confidence REAL,
+                        created_at TEXT NOT NULL,
+                        updated_at TEXT NOT NULL
+                    )
+                    """
+                )
+                legacy.executemany(
+                    "INSERT INTO tracked_emails (tg_message_id, recipient, subject, created_at, updated_at) "
+                    "VALUES (?, 'lead@example.com', 'Tracked', '', ?)",
+                    [
+                        (1, "2030-01-01T09:00:00+02:00"),
+                        (2, "2030-01-01T08:30:00+00:00"),
+                        (3, ""),
+                    ],
+                )
+            legacy.close()
+
+            store = StateStore(path)
+            updated_ms = dict(
+                store._conn.execute("SELECT tg_message_id, updated_ms FROM tracked_emails").fetchall()  # noqa: SLF001 - test only
+            )
+
+            self.assertEqual(updated_ms, {1: 1893481200000, 2: 1893486600000, 3: None})
+            self.assertEqual([tracked.tg_message_id for tracked in store.list_tracked_emails()], [2, 1, 3])
+
+            with store._conn:  # noqa: SLF001 - test only
+                store._conn.execute(
+                    "UPDATE tracked_emails SET updated_at = '2000-01-01T01:00:00+02:00' WHERE tg_message_id = 1"
+                )
+            store.purge_old_rows(days=30)
+            self.assertIsNone(store.get_tracked_email(1))
+            self.assertIsNotNone(store.get_tracked_email(2))
+            self.assertIsNone(store.get_tracked_email(3))
+            store.close()
+
+    def test_columnar_session_counts_match_per_row_metrics(self) -> None:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            store = StateStore(Path(tmpdir) / "state.db")
+            classifications = [
+                ("human_browser", 1),
+                ("font_loader", 1),
+                ("gmail_proxy", 0),
+                ("prefetch_proxy", 0),
+                ("unknown_proxy", None),
+            ]
+            base = datetime(2026, 3, 1, 12, 0, tzinfo=timezone.utc)
+            events = []
+            for tg_message_id in range(1, 6):
+                store.upsert_tracked_email(
+                    TrackedEmail(
+                        tg_message_id=tg_message_id,
+                        draft_id=f"draft-{tg_message_id}",
+                        recipient="lead@example.com",
+                        subject="Rescore",
+                        open_count=0,
+                        first_opened_at="",
+                        last_opened_at="",
+                        last_classification="",
+                        last_layer="",
+                        last_dimensions="",
+                        last_confidence=None,
+                    )
+                )
+                offset = 0.0
+                for index in range(12 * tg_message_id):
+                    offset += (index * 37 + tg_message_id * 13) % 140 + 0.25
+                    classification, is_user_open = classifications[(index * tg_message_id) % len(classifications)]
+                    created_at = (base + timedelta(seconds=offset)).isoformat()
+                    if index % 5 == 0:
+                        created_at = (base + timedelta(seconds=offset)).astimezone(timezone(timedelta(hours=2))).isoformat()
+                    if tg_message_id == 4 and index == 3:
+                        created_at = "not-a-date"
+                    events.append((tg_message_id, classification, "img", "2x1", 0.5, is_user_open, "", created_at))
+            with store._conn:  # noqa: SLF001 - test only
+                store._conn.executemany(
+                    """
+                    INSERT INTO pixel_events (
+                        tg_message_id, classification, layer, dimensions, confidence,
+                        is_user_open, email_subject, created_at
+                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                    """,
+                    events,
+                )
+
+            counts = store.tracked_session_counts()
+            for tg_message_id in range(1, 6):
+                expected = store.get_tracked_email(tg_message_id)
+                assert expected is not None
+                self.assertEqual(
+                    counts[tg_message_id],
+                    {
+                        "open_count": expected.open_count,
+                        "proxy_count": expected.proxy_count,
+                        "raw_event_count": expected.raw_event_count,
+                    },
+                )
+            self.assertEqual(store.rescore_tracked_emails(window_seconds=3600), 5)
+            self.assertEqual(store.tracked_session_counts(window_seconds=3600)[1]["open_count"], 1)
+            store.close()
+
+    def test_readers_see_rescored_open_counts(self) -> None:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = Path(tmpdir) / "state.db"
+            store = StateStore(path)
+            store.upsert_tracked_email(
+                TrackedEmail(
+                    tg_message_id=1,
+                    draft_id="draft-1",
+                    recipient="lead@example.com",
+                    subject="Rescore",
+                    open_count=0,
+                    first_opened_at="",
+                    last_opened_at="",
+                    last_classification="",
+                    last_layer="",
+                    last_dimensions="",
+                    last_confidence=None,
+                )
+            )
+            base = datetime(2026, 3, 1, 12, 0, tzinfo=timezone.utc)
+            with store._conn:  # noqa: SLF001 - test only
+                store._conn.executemany(
+                    """
+                    INSERT INTO pixel_events (
+                        tg_message_id, classification, layer, dimensions, confidence,
+                        is_user_open, email_subject, created_at
+                    ) VALUES (1, 'human_browser', 'img', '2x1', 0.9, 1, '', ?)
+                    """,
+                    [((base + timedelta(minutes=10 * index)).isoformat(),) for index in range(5)],
+                )
+            self.assertEqual(store.get_tracked_email(1).open_count, 5)
+
+            store.rescore_tracked_emails(window_seconds=3600)
+            stored = store._conn.execute("SELECT open_count FROM tracked_emails").fetchone()[0]  # noqa: SLF001 - test only
+            self.assertEqual(stored, 1)
+            self.assertEqual(store.get_tracked_email(1).open_count, 1)
+            self.assertEqual([tracked.open_count for tracked in store.list_tracked_emails()], [1])
+            store.close()
+
+            reopened = StateStore(path)
+            self.assertEqual(reopened.get_tracked_email(1).open_count, 1)
+            self.assertEqual(reopened.tracked_session_counts()[1]["open_count"], 1)
+            reopened.close()
+
+    def test_batched_pixel_events_keep_their_received_at(self) -> None:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            store = StateStore(Path(tmpdir) / "state.db")
+            store.upsert_tracked_email(
+                TrackedEmail(
+                    tg_message_id=404,
+                    draft_id="draft-4",
+                    recipient="lead@example.com",
+                    subject="Buffered",
+                    open_count=0,
+                    first_opened_at="",
+                    last_opened_at="",
+                    last_classification="",
+                    last_layer="",
+                    last_dimensions="",
+                    last_confidence=None,
+                )
+            )
+            events = [
+                PixelEvent.from_payload(
+                    {
+                        "tg_msg_id": 404,
+                        "classification": "human_browser",
+                        "is_user_open": True,
+                        "received_at": received_at,
+                    }
+                )
+                for received_at in ("2026-03-01T12:00:00+00:00", "2026-03-01T16:00:00+02:00")
+            ]
+
+            updated = store.record_pixel_events(events)[404]
+
+            self.assertEqual(updated.open_count, 2)
+            self.assertEqual(updated.first_opened_at, "2026-03-01T12:00:00+00:00")
+            self.assertEqual(updated.last_opened_at, "2026-03-01T14:00:00+00:00")
+            store.close()
+
 
 class SelfHostedSetupTests(unittest.TestCase):
     def test_claim_owner_persists_in_sqlite(self) -> None:
@@ -486,6 +802,60 @@ class SelfHostedSetupTests(unittest.TestCase):
             self.assertEqual(store.get_app_settings()["TELEGRAM_CHAT_ID"], "555")
             store.close()
 
+    def test_user_datetime_formatter_is_cached_per_lang_and_timezone(self) -> None:
+        value = "2026-03-14T09:05:00+00:00"
+        formatter = user_datetime_formatter("it", "Europe/Rome")
+        self.assertIs(user_datetime_formatter("it", "Europe/Rome"), formatter)
+        self.assertTrue(
+            format_user_datetime(value, lang="it", timezone_name="Europe/Rome").startswith("14 mar 2026, 10:05 CET (")
+        )
+        self.assertTrue(
+            format_user_datetime(value, lang="en", timezone_name="America/New_York").startswith("Mar 14, 2026, 5:05 AM EDT (")
+        )
+        self.assertEqual(format_user_datetime("garbage", lang="it", timezone_name=""), "")
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cfg = Config.from_env({"TELEGRAM_BOT_TOKEN": "token", "DATA_DIR": tmpdir})
+            runtime = build_test_runtime(cfg, StateStore(Path(tmpdir) / "state.db"))
+            try:
+                save_runtime_settings(runtime, {"WATCH_INTERVAL": "30"})
+                self.assertIs(user_datetime_formatter("it", "Europe/Rome"), formatter)
+                save_runtime_settings(runtime, {"TIMEZONE": "Europe/London"})
+                self.assertIsNot(user_datetime_formatter("it", "Europe/Rome"), formatter)
+            finally:
+                runtime.store.close()
+
+    def test_apply_runtime_overrides_only_reruns_side_effects_for_changed_fields(self) -> None:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cfg = Config.from_env({"TELEGRAM_BOT_TOKEN": "token", "DATA_DIR": tmpdir})
+            invalidations: List[int] = []
+            runtime = build_test_runtime(
+                cfg,
+                StateStore(Path(tmpdir) / "state.db"),
+                gmail=SimpleNamespace(config=cfg, invalidate=lambda: invalidations.append(1)),
+            )
+            try:
+                save_runtime_settings(runtime, {"WATCH_INTERVAL": "45"})
+                self.assertEqual(runtime.config.watch_interval, 45)
+                self.assertEqual(invalidations, [])
+                self.assertFalse(cfg.gmail_token_path.exists())
+
+                save_runtime_settings(runtime, {"GOOGLE_OAUTH_TOKEN_JSON": '{"token": "abc"}'})
+                self.assertEqual(json.loads(cfg.gmail_token_path.read_text()), {"token": "abc"})
+                self.assertEqual(invalidations, [1])
+
+                self.assertEqual(apply_runtime_overrides(runtime), set())
+                self.assertEqual(invalidations, [1])
+
+                cfg.gmail_token_path.write_text("broken", encoding="utf-8")
+                runtime.store.set_bot_state(GMAIL_HISTORY_ID_KEY, "99")
+                save_runtime_settings(runtime, {"GOOGLE_OAUTH_TOKEN_JSON": '{"token": "abc"}'})
+                self.assertEqual(json.loads(cfg.gmail_token_path.read_text()), {"token": "abc"})
+                self.assertEqual(invalidations, [1, 1])
+                self.assertEqual(runtime.store.get_bot_state(GMAIL_HISTORY_ID_KEY), "")
+            finally:
+                runtime.store.close()
+
     def test_google_web_client_config_requires_web_key(self) -> None:
         with tempfile.TemporaryDirectory() as tmpdir:
             cfg = Config.from_env(
@@ -602,7 +972,7 @@ class SelfHostedSetupTests(unittest.TestCase):
                     return "https://accounts.google.com/auth?state=oauth-state", "oauth-state"
 
             try:
-                with patch("tg_email.Flow.from_client_config", return_value=FakeFlow()) as mocked:
+                with patch("google_auth_oauthlib.flow.Flow.from_client_config", return_value=FakeFlow()) as mocked:
                     auth_url = start_google_oauth(runtime)
                 self.assertIn("oauth-state", auth_url)
                 state_payload = parse_google_oauth_state_payload(
@@ -783,6 +1153,129 @@ class EmailRenderingTests(unittest.TestCase):
         self.assertIn("[immagine: promo banner]", rendered)
         self.assertNotIn("alert", rendered)
 
+    def test_parsed_message_collects_headers_body_and_attachments_in_one_pass(self) -> None:
+        def encoded(text: str) -> str:
+            return base64.urlsafe_b64encode(text.encode()).decode()
+
+        message = {
+            "id": "gmail-1",
+            "threadId": "thread-1",
+            "labelIds": ["INBOX", "STARRED"],
+            "payload": {
+                "mimeType": "multipart/mixed",
+                "headers": [
+                    {"name": "Subject", "value": "=?utf-8?q?Offerta_speciale?="},
+                    {"name": "From", "value": "Shop <shop@example.com>"},
+                    {"name": "Received", "value": "first"},
+                    {"name": "received", "value": "second"},
+                ],
+                "parts": [
+                    {
+                        "mimeType": "multipart/alternative",
+                        "parts": [
+                            {"mimeType": "text/plain", "body": {"data": encoded("Ciao, ecco la nostra offerta di oggi.")}},
+                            {"mimeType": "text/html", "body": {"data": encoded("<p>Ciao</p>")}},
+                        ],
+                    },
+                    {
+                        "mimeType": "application/pdf",
+                        "filename": "offerta.pdf",
+                        "body": {"attachmentId": "att-1", "size": 1200},
+                    },
+                ],
+            },
+        }
+
+        parsed = ParsedMessage.from_message(message)
+
+        self.assertEqual(parsed.gmail_message_id, "gmail-1")
+        self.assertEqual(parsed.thread_id, "thread-1")
+        self.assertEqual(parsed.subject, "Offerta speciale")
+        self.assertEqual(parsed.sender, "shop@example.com")
+        self.assertEqual(parsed.header("RECEIVED"), "first")
+        self.assertTrue(parsed.starred)
+        self.assertEqual(parsed.body_text(), "Ciao, ecco la nostra offerta di oggi.")
+        self.assertEqual(parsed.html, "<p>Ciao</p>")
+        self.assertEqual(
+            parsed.attachments,
+            [{"id": "att-1", "data": None, "filename": "offerta.pdf", "size": 1200}],
+        )
+
+    def test_gmail_forward_attaches_original_without_decoding_body(self) -> None:
+        cfg = Config.from_env({"TELEGRAM_BOT_TOKEN": "token"})
+        original = (
+            b"From: Alice <alice@example.com>\r\n"
+            b"Subject: =?utf-8?q?Rapporto_mensile?=\r\n"
+            b"Content-Type: text/plain; charset=utf-8\r\n"
+            b"Content-Transfer-Encoding: base64\r\n"
+            b"\r\n"
+            + base64.encodebytes("Testo originale già codificato.".encode())
+        )
+        sent: list[str] = []
+        runtime = build_test_runtime(
+            cfg,
+            SimpleNamespace(),
+            gmail=SimpleNamespace(
+                get_raw_message=lambda gmail_message_id: {"raw": base64.urlsafe_b64encode(original).decode()},
+                send_raw_message=lambda raw, thread_id: sent.append(raw),
+            ),
+        )
+
+        gmail_forward(runtime, "gmail-1", "boss@example.com")
+
+        forwarded = email.message_from_bytes(base64.urlsafe_b64decode(sent[0]), policy=email.policy.default)
+        self.assertEqual(forwarded["To"], "boss@example.com")
+        self.assertEqual(forwarded["Subject"], "Fwd: Rapporto mensile")
+        attached = [part for part in forwarded.iter_attachments() if part.get_content_type() == "message/rfc822"]
+        self.assertEqual(len(attached), 1)
+        self.assertIn(original, base64.urlsafe_b64decode(sent[0]))
+        self.assertEqual(attached[0].get_content()["Subject"], "Rapporto mensile")
+
+        runtime.parsed_messages.put(
+            "gmail-1",
+            ParsedMessage(
+                gmail_message_id="gmail-1",
+                thread_id="thread-1",
+                label_ids=[],
+                headers={"subject": "Oggetto già noto"},
+                plain=None,
+                html=None,
+                attachments=[],
+            ),
+        )
+        gmail_forward(runtime, "gmail-1", "boss@example.com")
+        forwarded = email.message_from_bytes(base64.urlsafe_b64decode(sent[1]), policy=email.policy.default)
+        self.assertEqual(forwarded["Subject"], "Fwd: Oggetto già noto")
+
+    def test_format_email_text_reuses_escaped_fragments(self) -> None:
+        state = EmailState(
+            tg_message_id=9001,
+            gmail_message_id="gmail",
+            gmail_thread_id="thread",
+            sender="sender@example.com",
+            subject="Q3 <budget> & co",
+            body="Totale < 5 & > 3",
+            header="",
+            attachments=[],
+            starred=False,
+            lang="it",
+        )
+
+        self.assertEqual(
+            format_email_text(state, status_line="Stato <ok>"),
+            "📧 <b>Q3 &lt;budget&gt; &amp; co</b>\n\nTotale &lt; 5 &amp; &gt; 3\n\n---\nStato &lt;ok&gt;",
+        )
+        render = state.render
+        self.assertIsNotNone(render)
+        self.assertEqual(format_email_text(state, body_override="Ciao <"), "📧 <b>Q3 &lt;budget&gt; &amp; co</b>\n\nCiao &lt;")
+        self.assertEqual(format_email_text(state, body_override="Ciao <b> &"), "📧 <b>Q3 &lt;budget&gt; &amp; co</b>\n\nCiao &lt;b&gt; &amp;")
+        self.assertEqual(format_email_text(state, body_override="Altro"), "📧 <b>Q3 &lt;budget&gt; &amp; co</b>\n\nAltro")
+        self.assertIs(state.render, render)
+
+        state.body = "Nuovo corpo"
+        self.assertEqual(format_email_text(state), "📧 <b>Q3 &lt;budget&gt; &amp; co</b>\n\nNuovo corpo")
+        self.assertIsNot(state.render, render)
+
     def test_pixel_asset_response_sets_aggressive_no_cache_headers(self) -> None:
         response = pixel_asset_response("image")
         self.assertIn("no-store", response.headers["cache-control"])
@@ -790,6 +1283,21 @@ class EmailRenderingTests(unittest.TestCase):
         self.assertEqual(response.headers["pragma"], "no-cache")
         self.assertEqual(response.headers["surrogate-control"], "no-store")
 
+    def test_pixel_notification_falls_back_for_untracked_messages(self) -> None:
+        cfg = Config.from_env({"TELEGRAM_BOT_TOKEN": "token", "DATA_DIR": tempfile.mkdtemp()})
+        event = PixelEvent.from_payload({"tg_msg_id": 404, "classification": "gmail_proxy", "email_subject": "Ciao"})
+        text = pixel_event_notification_text(SimpleNamespace(config=cfg), event, None, None, None)
+        self.assertIn("Ciao", text)
+        self.assertIn("Original text unavailable", text)
+
+    def test_pixel_asset_response_reuses_prebuilt_template(self) -> None:
+        font = pixel_asset_response("font")
+        image = pixel_asset_response("unknown")
+        self.assertEqual(font.headers["content-type"], "font/woff2")
+        self.assertEqual(image.headers["content-type"], "image/png")
+        self.assertEqual(image.headers["content-length"], str(len(PIXEL_ASSET_TEMPLATES["image"].body)))
+        self.assertEqual(asyncio.run(font.get_data()), PIXEL_ASSET_TEMPLATES["font"].body)
+
     def test_append_tracking_to_raw_adds_markup_without_changing_headers(self) -> None:
         original_raw = build_raw(
             "lead@example.com",
@@ -805,6 +1313,179 @@ class EmailRenderingTests(unittest.TestCase):
         self.assertEqual(recipient, "lead@example.com")
         self.assertIn("tracker.example/p.png", base64.urlsafe_b64decode(updated_raw + "=" * (-len(updated_raw) % 4)).decode("utf-8", "replace"))
 
+    def test_prepare_tracked_raw_splices_html_and_keeps_inline_images_verbatim(self) -> None:
+        message = email.message.EmailMessage(policy=email.policy.SMTP)
+        message["To"] = "Lead <lead@example.com>"
+        message["Subject"] = "Proposta è pronta"
+        message.set_content("Buongiorno")
+        message.add_alternative('<p>Buongiorno</p><img src="cid:logo">', subtype="html")
+        message.get_payload()[1].add_related(b"\x89PNG" + bytes(range(256)) * 40, "image", "png", cid="<logo>")
+        original_bytes = message.as_bytes()
+        image_section = original_bytes[original_bytes.index(b"Content-Type: image/png") :]
+        raw = base64.urlsafe_b64encode(original_bytes).decode()
+        markup = '<img src="https://tracker.example/p.png">'
+
+        prepared = prepare_tracked_raw(raw, markup)
+
+        self.assertEqual(prepared.subject, "Proposta è pronta")
+        self.assertEqual(prepared.recipient, "lead@example.com")
+        updated_bytes = base64.urlsafe_b64decode(prepared.raw)
+        self.assertTrue(updated_bytes.endswith(image_section))
+        parsed = email.message_from_bytes(updated_bytes, policy=email.policy.default)
+        html_part = next(part for part in parsed.walk() if part.get_content_type() == "text/html")
+        self.assertIn(markup, html_part.get_content())
+        self.assertEqual(prepare_tracked_raw(prepared.raw, markup).raw, prepared.raw)
+
+    def test_tracking_markup_template_fills_every_slot(self) -> None:
+        cfg = Config.from_env(
+            {
+                "TELEGRAM_BOT_TOKEN": "token",
+                "ENABLE_PIXEL": "true",
+                "PIXEL_WEBHOOK_SECRET": "secret",
+                "PIXEL_BASE_URL": "https://pixel.example",
+            }
+        )
+
+        markup = build_tracking_markup_for_message_id(cfg, 42)
+
+        self.assertNotIn("\x00", markup)
+        urls = re.findall(r"https://pixel\.example/track/[^'\" ]+", markup)
+        self.assertEqual(
+            {url.split("/")[4] for url in urls},
+            {"img", "bg", "dark", "font"},
+        )
+        tokens = set(re.findall(r"/track/[a-z]+/(?:[0-9]x1/)?([^/?]+)\.(?:png|woff2)\?", markup))
+        self.assertEqual(len(tokens), 1)
+        self.assertEqual(parse_tracking_token(cfg, tokens.pop())["tg"], 42)
+        nonces = set(re.findall(r"gr-(?:bg|dark|font)-([0-9a-f]{10})", markup))
+        self.assertEqual(len(nonces), 1)
+
+    def test_rotating_pixel_secret_clears_secret_keyed_caches(self) -> None:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cfg = Config.from_env(
+                {
+                    "TELEGRAM_BOT_TOKEN": "token",
+                    "DATA_DIR": tmpdir,
+                    "ENABLE_PIXEL": "true",
+                    "PIXEL_WEBHOOK_SECRET": "old-secret",
+                    "PIXEL_BASE_URL": "https://pixel.example",
+                }
+            )
+            runtime = build_test_runtime(cfg, StateStore(Path(tmpdir) / "state.db"))
+            try:
+                build_tracking_markup_for_message_id(cfg, 1)
+                runtime.tracking_tokens.put("token", {"tg": 1})
+                save_runtime_settings(runtime, {"PIXEL_WEBHOOK_SECRET": "new-secret"})
+                self.assertEqual(tracking_markup_template.cache_info().currsize, 0)
+                self.assertEqual(tracking_token_signer.cache_info().currsize, 0)
+                self.assertEqual(len(runtime.tracking_tokens), 0)
+            finally:
+                runtime.store.close()
+
+
+class TrackingTokenCacheTests(unittest.TestCase):
+    def test_verified_tokens_are_cached_until_ttl_expires(self) -> None:
+        cfg = Config.from_env(
+            {"TELEGRAM_BOT_TOKEN": "token", "ENABLE_PIXEL": "true", "PIXEL_WEBHOOK_SECRET": "secret"}
+        )
+        cache = LRUCache(16, ttl_seconds=60)
+        token = make_tracking_token(cfg, 77)
+
+        with patch("tg_email.time.monotonic", return_value=1000.0):
+            self.assertEqual(parse_tracking_token(cfg, token, cache)["tg"], 77)
+        with patch("tg_email.time.monotonic", return_value=1030.0), patch("tg_email.hmac.new") as hmac_new:
+            self.assertEqual(parse_tracking_token(cfg, token, cache)["tg"], 77)
+            hmac_new.assert_not_called()
+        self.assertEqual(cache.stats(), {"size": 1, "hits": 1, "misses": 1})
+
+        with patch("tg_email.time.monotonic", return_value=1061.0):
+            self.assertEqual(parse_tracking_token(cfg, token, cache)["tg"], 77)
+        self.assertEqual(cache.stats(), {"size": 1, "hits": 1, "misses": 2})
+
+        with self.assertRaises(ConfigError):
+            parse_tracking_token(cfg, token[:-2] + "xx", cache)
+        self.assertEqual(cache.stats()["size"], 1)
+
+    def test_compact_tokens_are_short_and_legacy_tokens_still_parse(self) -> None:
+        cfg = Config.from_env(
+            {"TELEGRAM_BOT_TOKEN": "token", "ENABLE_PIXEL": "true", "PIXEL_WEBHOOK_SECRET": "secret"}
+        )
+        token = make_tracking_token(cfg, 1234567)
+        payload = parse_tracking_token(cfg, token)
+
+        self.assertEqual(len(token), 36)
+        self.assertNotIn(".", token)
+        self.assertEqual(payload["tg"], 1234567)
+        self.assertEqual(len(payload["nonce"]), 12)
+
+        legacy_payload = base64.urlsafe_b64encode(b'{"tg":99,"nonce":"abc"}').decode().rstrip("=")
+        legacy_signature = base64.urlsafe_b64encode(
+            hmac.new(b"secret", legacy_payload.encode(), hashlib.sha256).digest()
+        ).decode().rstrip("=")
+        self.assertEqual(parse_tracking_token(cfg, f"{legacy_payload}.{legacy_signature}")["tg"], 99)
+
+        tampered = bytearray(base64.urlsafe_b64decode(token))
+        tampered[4] ^= 1
+        with self.assertRaises(ConfigError):
+            parse_tracking_token(cfg, base64.urlsafe_b64encode(bytes(tampered)).decode())
+        with self.assertRaises(ConfigError):
+            parse_tracking_token(cfg, token[:-4])
+
+
+class PixelEventDeduperTests(unittest.TestCase):
+    def test_duplicate_fetches_inside_window_are_suppressed(self) -> None:
+        now = [100.0]
+        deduper = PixelEventDeduper(clock=lambda: now[0])
+        event = PixelEvent.from_payload(
+            {"tg_msg_id": 9, "pixel_id": "tok", "layer": "img", "dimensions": "2x1", "classification": "gmail_proxy"}
+        )
+        font = PixelEvent.from_payload({"tg_msg_id": 9, "pixel_id": "tok", "layer": "font", "dimensions": "font"})
+
+        self.assertFalse(deduper.seen(event, 30))
+        self.assertTrue(deduper.seen(event, 30))
+        self.assertFalse(deduper.seen(font, 30))
+        now[0] += 31
+        self.assertFalse(deduper.seen(event, 30))
+        self.assertFalse(deduper.seen(event, 0))
+        self.assertEqual(deduper.stats(), {"tracked": 1, "accepted": 4, "suppressed": 1})
+
+    def test_dedup_window_is_configurable(self) -> None:
+        cfg = Config.from_env({"TELEGRAM_BOT_TOKEN": "token", "TELEGRAM_CHAT_ID": "1", "PIXEL_DEDUP_WINDOW_SECONDS": "5"})
+        self.assertEqual(cfg.pixel_dedup_window_seconds, 5)
+        self.assertEqual(cfg.with_overrides({"PIXEL_DEDUP_WINDOW_SECONDS": "0"}).pixel_dedup_window_seconds, 0)
+        with self.assertRaises(ConfigError):
+            Config.from_env({"TELEGRAM_BOT_TOKEN": "token", "TELEGRAM_CHAT_ID": "1", "PIXEL_DEDUP_WINDOW_SECONDS": "x"})
+
+
+class ImportTimeTests(unittest.TestCase):
+    HEAVY_SDK_MODULES = (
+        "google.auth.transport.requests",
+        "google.generativeai",
+        "google_auth_oauthlib.flow",
+        "googleapiclient.discovery",
+        "hypercorn.asyncio",
+        "hypercorn.config",
+        "quart",
+        "telegram.ext",
+    )
+
+    def test_heavy_sdks_are_not_imported_with_tg_email(self) -> None:
+        result = subprocess.run(
+            [sys.executable, "-X", "importtime", "-c", "import tg_email"],
+            cwd=Path(__file__).resolve().parents[1],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        imported = {
+            line.rsplit("|", 1)[-1].strip()
+            for line in result.stderr.splitlines()
+            if line.startswith("import time:")
+        }
+        self.assertIn("tg_email", imported)
+        for module_name in self.HEAVY_SDK_MODULES:
+            self.assertNotIn(module_name, imported)
+
 
 class WebAppSmokeTests(unittest.TestCase):
     def test_root_and_dashboard_auth(self) -> None:
@@ -894,7 +1575,7 @@ class WebAppSmokeTests(unittest.TestCase):
 
                 fake_flow = FakeFlow()
                 try:
-                    with patch("tg_email.Flow.from_client_config", return_value=fake_flow) as mocked:
+                    with patch("google_auth_oauthlib.flow.Flow.from_client_config", return_value=fake_flow) as mocked:
                         response = await client.get("/oauth/google/callback?state=oauth-state&code=abc")
                     self.assertEqual(response.status_code, 200)
                     self.assertEqual(
@@ -1058,6 +1739,93 @@ class WebAppSmokeTests(unittest.TestCase):
 
         asyncio.run(run())
 
+    def test_gmail_push_is_queued_until_fast_boot_is_ready(self) -> None:
+        async def run() -> None:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                cfg = Config.from_env(
+                    {
+                        "TELEGRAM_BOT_TOKEN": "token",
+                        "TELEGRAM_CHAT_ID": "123",
+                        "PUBLIC_BASE_URL": "https://glassyreply-bot.fly.dev",
+                        "GMAIL_PUSH_TOPIC": "projects/demo/topics/glassyreply-mail",
+                        "GMAIL_PUSH_WEBHOOK_SECRET": "push-secret",
+                        "GOOGLE_OAUTH_CREDENTIALS_JSON": '{"web":{"client_id":"x","project_id":"p","auth_uri":"https://accounts.google.com/o/oauth2/auth","token_uri":"https://oauth2.googleapis.com/token","client_secret":"secret"}}',
+                        "GOOGLE_OAUTH_TOKEN_JSON": '{"refresh_token":"refresh","client_id":"client","client_secret":"secret","token_uri":"https://oauth2.googleapis.com/token"}',
+                        "DATA_DIR": tmpdir,
+                    }
+                )
+                store = StateStore(Path(tmpdir) / "state.db")
+                boot = BootTimer()
+                runtime = build_test_runtime(cfg, store, shutdown_event=asyncio.Event(), boot=boot)
+                app = build_application(runtime)
+                client = create_web_app(runtime, app).test_client()
+                pubsub_body = {
+                    "message": {
+                        "data": base64.urlsafe_b64encode(
+                            json.dumps({"emailAddress": "me@example.com", "historyId": "205"}).encode()
+                        ).decode()
+                    }
+                }
+                try:
+                    with boot.phase("telegram"):
+                        pass
+                    with patch("tg_email.handle_gmail_push_notification", new_callable=AsyncMock) as handled:
+                        response = await client.post("/gmail/push?secret=push-secret", json=pubsub_body)
+                        health = await (await client.get("/healthz")).get_json()
+                        self.assertEqual(response.status_code, 202)
+                        self.assertEqual((await response.get_json())["status"], "queued")
+                        self.assertFalse(health["boot"]["ready"])
+                        self.assertEqual(health["boot"]["queued_gmail_pushes"], 1)
+                        handled.assert_not_awaited()
+
+                        boot.mark_ready()
+                        self.assertEqual(await drain_pending_gmail_pushes(runtime, app), 1)
+                        handled.assert_awaited_once()
+                        self.assertEqual(handled.await_args.args[2]["historyId"], "205")
+                    self.assertIn("telegram", boot.report()["phases_ms"])
+                    self.assertIsNotNone(boot.report()["ready_ms"])
+                finally:
+                    store.close()
+
+        asyncio.run(run())
+
+    def test_failed_boot_releases_waiters_with_503(self) -> None:
+        async def run() -> None:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                cfg = Config.from_env(
+                    {
+                        "TELEGRAM_BOT_TOKEN": "token",
+                        "TELEGRAM_CHAT_ID": "123",
+                        "PIXEL_WEBHOOK_SECRET": "secret",
+                        "DATA_DIR": tmpdir,
+                    }
+                )
+                store = StateStore(Path(tmpdir) / "state.db")
+                boot = BootTimer()
+                runtime = build_test_runtime(cfg, store, shutdown_event=asyncio.Event(), boot=boot)
+                app = build_application(runtime)
+                client = create_web_app(runtime, app).test_client()
+                try:
+                    pending = asyncio.create_task(
+                        client.post("/pixel_status", headers={"X-Pixel-Secret": "secret"}, json={"tg_msg_id": 1})
+                    )
+                    with patch("tg_email.bootstrap_telegram", new_callable=AsyncMock, side_effect=RuntimeError("down")):
+                        with self.assertRaises(RuntimeError):
+                            await bootstrap_services(runtime, app, "polling", concurrent=True)
+                    response = await asyncio.wait_for(pending, 5)
+                    self.assertEqual(response.status_code, 503)
+                    self.assertEqual(boot.report()["error"], "down")
+                    self.assertFalse(boot.report()["ready"])
+
+                    for history_id in range(BOOT_GMAIL_PUSH_QUEUE_SIZE + 1):
+                        boot.pending_gmail_pushes.append({"historyId": str(history_id)})
+                    self.assertEqual(len(boot.pending_gmail_pushes), BOOT_GMAIL_PUSH_QUEUE_SIZE)
+                    self.assertEqual(boot.pending_gmail_pushes[0]["historyId"], "1")
+                finally:
+                    store.close()
+
+        asyncio.run(run())
+
     def test_gmail_push_route_processes_history_notifications(self) -> None:
         async def run() -> None:
             with tempfile.TemporaryDirectory() as tmpdir:
@@ -1195,6 +1963,174 @@ class WebAppSmokeTests(unittest.TestCase):
 
         asyncio.run(run())
 
+    def test_pixel_status_batch_records_once_and_dedupes(self) -> None:
+        async def run() -> None:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                cfg = Config.from_env(
+                    {
+                        "TELEGRAM_BOT_TOKEN": "token",
+                        "TELEGRAM_CHAT_ID": "123",
+                        "PIXEL_WEBHOOK_SECRET": "secret",
+                        "DATA_DIR": tmpdir,
+                    }
+                )
+                store = StateStore(Path(tmpdir) / "state.db")
+                runtime = build_test_runtime(cfg, store, shutdown_event=asyncio.Event())
+                store.upsert_tracked_email(
+                    TrackedEmail(
+                        tg_message_id=555,
+                        draft_id="draft-2",
+                        recipient="lead@example.com",
+                        subject="Batch pixel",
+                        open_count=0,
+                        first_opened_at="",
+                        last_opened_at="",
+                        last_classification="",
+                        last_layer="",
+                        last_dimensions="",
+                        last_confidence=None,
+                    )
+                )
+                app = build_application(runtime)
+                client = create_web_app(runtime, app).test_client()
+                user_open = {
+                    "tg_msg_id": 555,
+                    "pixel_id": "tok",
+                    "layer": "img",
+                    "dimensions": "2x1",
+                    "classification": "human_browser",
+                    "confidence": 0.82,
+                    "is_user_open": True,
+                }
+                proxy = {**user_open, "layer": "font", "dimensions": "font", "classification": "gmail_proxy", "is_user_open": False}
+
+                with patch.object(type(app.bot), "edit_message_text", new_callable=AsyncMock) as mocked:
+                    unauthorized = await client.post("/pixel_status/batch", json=[user_open])
+                    response = await client.post(
+                        "/pixel_status/batch",
+                        headers={"X-Pixel-Secret": "secret"},
+                        json={"events": [user_open, dict(user_open), proxy, {"layer": "img"}]},
+                    )
+                    ndjson = await client.post(
+                        "/pixel_status/batch",
+                        headers={"X-Pixel-Secret": "secret", "Content-Type": "application/x-ndjson"},
+                        data=json.dumps({**user_open, "pixel_id": "tok-2"}) + "\n\n" + json.dumps(proxy) + "\n",
+                    )
+
+                self.assertEqual(unauthorized.status_code, 401)
+                body = await response.get_json()
+                self.assertEqual(
+                    {key: body[key] for key in ("received", "recorded", "duplicates", "invalid", "notified")},
+                    {"received": 4, "recorded": 2, "duplicates": 1, "invalid": 1, "notified": 1},
+                )
+                ndjson_body = await ndjson.get_json()
+                self.assertEqual((ndjson_body["recorded"], ndjson_body["duplicates"]), (1, 1))
+                self.assertEqual(mocked.await_count, 2)
+                tracked = store.get_tracked_email(555)
+                assert tracked is not None
+                self.assertEqual(tracked.raw_event_count, 3)
+                self.assertEqual(tracked.open_count, 1)
+                store.close()
+
+        asyncio.run(run())
+
+    def test_pixel_fast_path_serves_asset_and_queues_event(self) -> None:
+        async def run() -> None:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                cfg = Config.from_env(
+                    {
+                        "TELEGRAM_BOT_TOKEN": "token",
+                        "TELEGRAM_CHAT_ID": "123",
+                        "PUBLIC_BASE_URL": "https://glassyreply-bot.fly.dev",
+                        "PIXEL_WEBHOOK_SECRET": "secret",
+                        "ENABLE_PIXEL": "1",
+                        "DATA_DIR": tmpdir,
+                    }
+                )
+                store = StateStore(Path(tmpdir) / "state.db")
+                runtime = build_test_runtime(cfg, store, shutdown_event=asyncio.Event())
+                fallback = AsyncMock()
+                fast_path = PixelFastPath(fallback, runtime, SimpleNamespace())
+                token = make_tracking_token(cfg, 777)
+
+                async def request(path: str, method: str = "GET") -> list[dict]:
+                    sent: list[dict] = []
+
+                    async def send(message: dict) -> None:
+                        sent.append(message)
+
+                    scope = {
+                        "type": "http",
+                        "method": method,
+                        "path": path,
+                        "query_string": b"",
+                        "headers": [(b"user-agent", b"GoogleImageProxy")],
+                    }
+                    await fast_path(scope, AsyncMock(), send)
+                    return sent
+
+                with patch("tg_email.apply_pixel_event", new_callable=AsyncMock) as applied:
+                    font = await request(f"/track/font/{token}.woff2")
+                    head = await request(f"/track/img/2x1/{token}.png", "HEAD")
+                    rejected = await request("/track/img/2x1/forged.png")
+                    legacy = await request("/pixel")
+                    await request("/healthz")
+                    await fast_path.close()
+
+                self.assertEqual(font[0]["status"], 200)
+                self.assertIn((b"content-type", b"font/woff2"), font[0]["headers"])
+                self.assertEqual(font[1]["body"], PIXEL_ASSET_TEMPLATES["font"].body)
+                self.assertEqual(head[1]["body"], b"")
+                self.assertEqual(rejected[0]["status"], 404)
+                self.assertEqual(legacy[0]["status"], 404)
+                fallback.assert_awaited_once()
+                self.assertEqual(applied.await_count, 2)
+                event = applied.await_args_list[0].args[2]
+                self.assertEqual(event["tg_msg_id"], 777)
+                self.assertEqual(event["classification"], "gmail_proxy")
+                self.assertEqual(fast_path.stats(), {"served": 2, "rejected": 2, "dropped": 0, "queued": 0})
+                store.close()
+
+        asyncio.run(run())
+
+    def test_pixel_fast_path_discards_queued_events_after_failed_boot(self) -> None:
+        async def run() -> None:
+            with tempfile.TemporaryDirectory() as tmpdir:
+                cfg = Config.from_env(
+                    {
+                        "TELEGRAM_BOT_TOKEN": "token",
+                        "TELEGRAM_CHAT_ID": "123",
+                        "PUBLIC_BASE_URL": "https://glassyreply-bot.fly.dev",
+                        "PIXEL_WEBHOOK_SECRET": "secret",
+                        "ENABLE_PIXEL": "1",
+                        "DATA_DIR": tmpdir,
+                    }
+                )
+                store = StateStore(Path(tmpdir) / "state.db")
+                boot = BootTimer()
+                runtime = build_test_runtime(cfg, store, shutdown_event=asyncio.Event(), boot=boot)
+                fast_path = PixelFastPath(AsyncMock(), runtime, SimpleNamespace())
+                scope = {
+                    "type": "http",
+                    "method": "GET",
+                    "path": f"/track/img/2x1/{make_tracking_token(cfg, 777)}.png",
+                    "query_string": b"",
+                    "headers": [(b"user-agent", b"GoogleImageProxy")],
+                }
+
+                with patch("tg_email.apply_pixel_event", new_callable=AsyncMock) as applied:
+                    await fast_path(scope, AsyncMock(), AsyncMock())
+                    boot.error = "down"
+                    boot.mark_ready()
+                    await fast_path.close()
+
+                applied.assert_not_awaited()
+                self.assertEqual(fast_path.stats()["dropped"], 1)
+                self.assertEqual(fast_path.stats()["queued"], 0)
+                store.close()
+
+        asyncio.run(run())
+
 
 class GmailClientTests(unittest.TestCase):
     class _Response:
@@ -1304,6 +2240,271 @@ class GmailClientTests(unittest.TestCase):
 
         self.assertEqual(merged, ["m3", "m2", "m1"])
 
+    def test_recent_monitored_ids_fan_out_through_gmail_executor(self) -> None:
+        cfg = Config.from_env({"TELEGRAM_BOT_TOKEN": "token"})
+        label_payloads = {
+            "INBOX": ["a9", "a5", "a3", "a1"],
+            "WORK": ["b8", "b4", "b2", "b0"],
+            "NEWS": ["c7", "c6", "c2", "c1"],
+        }
+        barrier = threading.Barrier(len(label_payloads), timeout=5)
+        dated: List[str] = []
+
+        def list_recent_label_ids(label_id: str, limit: int = 100) -> List[str]:
+            barrier.wait()
+            return label_payloads[label_id]
+
+        class Messages:
+            def get(self, **kwargs: Any) -> SimpleNamespace:
+                dated.append(kwargs["id"])
+                return SimpleNamespace(execute=lambda: {"internalDate": kwargs["id"][1:]})
+
+        service = SimpleNamespace(users=lambda: SimpleNamespace(messages=Messages))
+        client = GmailClient(cfg, service_factory=lambda: service)
+        executor = GmailExecutor(max_workers=len(label_payloads))
+        runtime = build_test_runtime(cfg, SimpleNamespace(), gmail=client, gmail_executor=executor)
+        try:
+            with patch.object(client, "list_recent_label_ids", side_effect=list_recent_label_ids):
+                merged = asyncio.run(gmail_recent_monitored_ids(runtime, list(label_payloads), limit=2))
+                self.assertEqual(merged, ["a9", "b8"])
+                self.assertEqual(dated, ["a9", "b8", "c7", "a5"])
+                self.assertEqual(executor.stats()["completed"], 3 + 1)
+
+                merged = asyncio.run(gmail_recent_monitored_ids(runtime, list(label_payloads), limit=3))
+        finally:
+            executor.shutdown()
+
+        self.assertEqual(merged, ["a9", "b8", "c7"])
+        self.assertEqual(dated, ["a9", "b8", "c7", "a5", "b4"])
+
+    def test_discovery_document_is_cached_as_text(self) -> None:
+        gmail_discovery_document.cache_clear()
+        document = gmail_discovery_document()
+
+        self.assertIsInstance(document, str)
+        self.assertEqual(json.loads(document)["version"], "v1")
+        self.assertIs(gmail_discovery_document(), document)
+
+    def test_build_service_uses_cached_discovery_document(self) -> None:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cfg = Config.from_env({"TELEGRAM_BOT_TOKEN": "token", "DATA_DIR": tmpdir})
+            creds = Credentials(token="access-token")
+            client = GmailClient(cfg)
+            gmail_discovery_document.cache_clear()
+
+            with patch.object(client, "_load_credentials", return_value=creds), patch(
+                "googleapiclient.discovery.build", side_effect=AssertionError("discovery fetch")
+            ):
+                service = client._build_service()
+
+            self.assertTrue(hasattr(service, "users"))
+            self.assertFalse((Path(tmpdir) / "gmail.v1.json").exists())
+
+    def test_refresh_credentials_renews_token_in_place_before_expiry(self) -> None:
+        class FakeCredentials:
+            refresh_token = "refresh"
+
+            def __init__(self, expires_in: int):
+                self.expiry = datetime.now(timezone.utc).replace(tzinfo=None) + timedelta(seconds=expires_in)
+                self.token = "old"
+                self.refreshes = 0
+
+            def refresh(self, request) -> None:  # noqa: ARG002
+                self.refreshes += 1
+                self.token = "new"
+                self.expiry = datetime.now(timezone.utc).replace(tzinfo=None) + timedelta(hours=1)
+
+            def to_json(self) -> str:
+                return json.dumps({"token": self.token})
+
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cfg = Config.from_env({"TELEGRAM_BOT_TOKEN": "token", "DATA_DIR": tmpdir})
+            service = SimpleNamespace()
+            client = GmailClient(cfg, service_factory=lambda: service)
+            self.assertIs(client.get_service(), service)
+
+            client._credentials = FakeCredentials(expires_in=3600)
+            self.assertFalse(client.refresh_credentials())
+
+            expiring = FakeCredentials(expires_in=30)
+            client._credentials = expiring
+            self.assertTrue(client.refresh_credentials())
+            self.assertFalse(client.refresh_credentials())
+
+            self.assertEqual(expiring.refreshes, 1)
+            self.assertEqual(json.loads(cfg.gmail_token_path.read_text()), {"token": "new"})
+            self.assertEqual(list(Path(tmpdir).glob("*.tmp")), [])
+            self.assertIs(client.get_service(), service)
+
+    def test_get_service_builds_one_transport_per_thread(self) -> None:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cfg = Config.from_env({"TELEGRAM_BOT_TOKEN": "token", "DATA_DIR": tmpdir})
+            built: List[str] = []
+
+            def factory() -> SimpleNamespace:
+                built.append(threading.current_thread().name)
+                return SimpleNamespace()
+
+            client = GmailClient(cfg, service_factory=factory)
+
+            main_service = client.get_service()
+            self.assertIs(client.get_service(), main_service)
+            worker_services: List[Any] = []
+            worker = threading.Thread(target=lambda: worker_services.append(client.get_service()), name="gmail-worker")
+            worker.start()
+            worker.join()
+
+            self.assertIsNot(worker_services[0], main_service)
+            self.assertEqual(built, [threading.current_thread().name, "gmail-worker"])
+            self.assertEqual(client.thread_services_built, 2)
+
+            rebuilt = client.get_service(force_reinit=True)
+            self.assertIsNot(rebuilt, main_service)
+            self.assertEqual(client.thread_services_built, 3)
+
+    def test_gmail_executor_bounds_workers_and_records_latency(self) -> None:
+        executor = GmailExecutor(max_workers=1)
+        release = threading.Event()
+
+        def slow_call() -> str:
+            release.wait(5)
+            return "ok"
+
+        def failing_call() -> None:
+            raise ValueError("boom")
+
+        async def scenario() -> tuple[List[Any], dict]:
+            first = asyncio.ensure_future(executor.run(slow_call))
+            second = asyncio.ensure_future(executor.run(slow_call))
+            await asyncio.sleep(0.05)
+            during = executor.stats()
+            release.set()
+            results = list(await asyncio.gather(first, second))
+            with self.assertRaises(ValueError):
+                await executor.run(failing_call)
+            return results, during
+
+        try:
+            results, during = asyncio.run(scenario())
+        finally:
+            executor.shutdown()
+
+        self.assertEqual(results, ["ok", "ok"])
+        self.assertEqual((during["active"], during["queued"]), (1, 1))
+        stats = executor.stats()
+        self.assertEqual((stats["completed"], stats["failed"], stats["queued"]), (2, 1, 0))
+        self.assertEqual(stats["latency_ms"]["slow_call"]["count"], 2)
+        self.assertEqual(sum(stats["latency_ms"]["failing_call"]["buckets"].values()), 1)
+
+    def test_label_index_is_cached_and_rebuilt_only_on_change(self) -> None:
+        labels = [
+            {"id": "INBOX", "name": "INBOX"},
+            {"id": "CATEGORY_SOCIAL", "name": "Social"},
+            {"id": "L2", "name": "beta"},
+            {"id": "L1", "name": "Alpha"},
+        ]
+        service = self._Service(labels_result={"labels": labels})
+        cfg = Config.from_env({"TELEGRAM_BOT_TOKEN": "token"})
+        client = GmailClient(cfg, service_factory=lambda: service)
+
+        index = client.label_index()
+        self.assertEqual(index.taggable, (("L1", "Alpha"), ("L2", "beta")))
+        self.assertIs(client.label_index(), index)
+        self.assertEqual(client.label_fetches, 1)
+
+        client._labels_fetched_at -= 3600
+        self.assertIs(client.label_index(), index)
+        self.assertEqual((client.label_fetches, client.label_changes), (2, 1))
+
+        labels.append({"id": "L3", "name": "gamma"})
+        refreshed = client.label_index(force=True)
+        self.assertIsNot(refreshed, index)
+        self.assertEqual(client.label_changes, 2)
+        self.assertEqual(client.refresh_labels()["L3"], "gamma")
+
+    def test_kb_tag_pages_through_precomputed_index(self) -> None:
+        index = LabelIndex.from_labels([{"id": f"L{i:03d}", "name": f"label {i:03d}"} for i in range(45)])
+
+        first = kb_tag(7, 0, index).inline_keyboard
+        second = kb_tag(7, 1, index).inline_keyboard
+
+        self.assertEqual(len(first), 31)
+        self.assertEqual(first[0][0].callback_data, "tagset|7|L000")
+        self.assertEqual([button.text for button in first[-1]], ["Next ➡️", "⬅️ Back"])
+        self.assertEqual(second[0][0].callback_data, "tagset|7|L030")
+        self.assertEqual([button.text for button in second[-1]], ["⬅️ Prev", "⬅️ Back"])
+
+
+class AttachmentCacheTests(unittest.TestCase):
+    def test_cache_evicts_least_recently_used_entries(self) -> None:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cache = AttachmentCache(Path(tmpdir) / "attachments", max_bytes=10)
+            cache.put("a", b"aaaa")
+            cache.put("b", b"bbbb")
+            self.assertEqual(cache.get("a"), b"aaaa")
+            cache.put("c", b"cccc")
+
+            self.assertIsNone(cache.get("b"))
+            self.assertEqual(cache.get("a"), b"aaaa")
+            self.assertEqual(cache.get("c"), b"cccc")
+            self.assertEqual(cache.total_bytes, 8)
+
+            reloaded = AttachmentCache(Path(tmpdir) / "attachments", max_bytes=10)
+            self.assertEqual(reloaded.get("c"), b"cccc")
+            self.assertEqual(reloaded.total_bytes, 8)
+
+    def test_send_email_attachment_uses_cache_then_telegram_file_id(self) -> None:
+        with tempfile.TemporaryDirectory() as tmpdir:
+            cfg = Config.from_env({"TELEGRAM_BOT_TOKEN": "token", "TELEGRAM_CHAT_ID": "123", "DATA_DIR": tmpdir})
+            store = StateStore(Path(tmpdir) / "state.db")
+            self.addCleanup(store.close)
+            fetches: list[tuple[str, str]] = []
+
+            def get_attachment_data(gmail_message_id: str, attachment_id: str) -> str:
+                fetches.append((gmail_message_id, attachment_id))
+                return base64.urlsafe_b64encode(b"%PDF-1.4").decode("ascii")
+
+            runtime = build_test_runtime(
+                cfg,
+                store,
+                gmail=SimpleNamespace(config=cfg, get_attachment_data=get_attachment_data),
+                attachment_cache=AttachmentCache(Path(tmpdir) / "attachments", max_bytes=1024),
+            )
+            state = EmailState(
+                tg_message_id=7,
+                gmail_message_id="gmail-7",
+                gmail_thread_id="thread-7",
+                sender="sender@example.com",
+                subject="Invoice",
+                body="Body",
+                header="Header",
+                attachments=[{"id": "att-1", "filename": "invoice.pdf", "size": 8}],
+                starred=False,
+                lang="it",
+            )
+            store.upsert_email_state(state)
+            bot = SimpleNamespace(
+                send_document=AsyncMock(
+                    side_effect=[
+                        SimpleNamespace(document=SimpleNamespace(file_id="tg-file-1")),
+                        SimpleNamespace(document=SimpleNamespace(file_id="tg-file-1")),
+                    ]
+                )
+            )
+
+            asyncio.run(send_email_attachment(bot, runtime, state, 0))
+            stored = store.get_email_state(7)
+            assert stored is not None
+            self.assertEqual(stored.attachments[0]["tg_file_id"], "tg-file-1")
+
+            asyncio.run(send_email_attachment(bot, runtime, stored, 0))
+            self.assertEqual(bot.send_document.await_args.kwargs["document"], "tg-file-1")
+
+            stored.attachments[0].pop("tg_file_id")
+            bot.send_document.side_effect = [SimpleNamespace(document=None)]
+            asyncio.run(send_email_attachment(bot, runtime, stored, 0))
+            self.assertEqual(fetches, [("gmail-7", "att-1")])
+
 
 if __name__ == "__main__":
     unittest.main()
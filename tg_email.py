@@ -2,10 +2,13 @@ from __future__ import annotations
 
 import argparse
 import asyncio
+from array import array
 import base64
 import email
 from email import policy
+import functools
 import hashlib
+import heapq
 import hmac
 import html as ihtml
 import json
@@ -14,42 +17,37 @@ import os
 import re
 import signal
 import sqlite3
+import struct
 import threading
-from urllib.parse import quote
-from dataclasses import dataclass, replace
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from urllib.parse import parse_qsl, quote
+from dataclasses import dataclass, field as dataclass_field, fields, replace
 from datetime import datetime, timedelta, timezone
-from email.header import decode_header
+from email.header import Header, decode_header
+from email.parser import BytesHeaderParser
 from email.utils import parseaddr
 from html.parser import HTMLParser
 from io import BytesIO
 from pathlib import Path
-from typing import Any, Callable, Dict, List, Mapping, Optional
+from typing import TYPE_CHECKING, Any, Callable, Dict, Iterable, Iterator, List, Mapping, Optional
 from uuid import uuid4
 from zoneinfo import ZoneInfo, ZoneInfoNotFoundError
 
 from dotenv import load_dotenv
-from google.auth.transport.requests import Request
 from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import Flow, InstalledAppFlow
-from googleapiclient.discovery import build
 from googleapiclient.errors import HttpError
-import google.generativeai as genai
-from hypercorn.asyncio import serve
-from hypercorn.config import Config as HypercornConfig
-from quart import Quart, Response, jsonify, request
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, InputFile, ReplyKeyboardMarkup, Update
 from telegram.constants import ParseMode
 from telegram.error import BadRequest
-from telegram.ext import (
-    Application,
-    CallbackQueryHandler,
-    CommandHandler,
-    ContextTypes,
-    MessageHandler,
-    filters,
-)
 from telegram.request import HTTPXRequest
 
+if TYPE_CHECKING:
+    from quart import Quart, Response
+    from telegram.ext import Application, ContextTypes
+
 LOGGER = logging.getLogger("glassyreply")
 
 AI_MODEL = "gemini-1.5-flash"
@@ -63,11 +61,30 @@ MAX_CHARS = 20_000
 TELEGRAM_MAX = 4_000
 PAGE_SIZE = 30
 STATE_RETENTION_DAYS = 30
+ATTACHMENT_CACHE_MAX_MB = 200
+PIXEL_DEDUP_WINDOW_SECONDS = 30
+PIXEL_DEDUP_MAX_KEYS = 8192
+GMAIL_WORKERS = 4
+GMAIL_LABEL_CACHE_TTL_SECONDS = 10 * 60
+UNTAGGABLE_LABEL_IDS = frozenset({"INBOX", "SENT", "TRASH", "SPAM", "DRAFT"})
+GMAIL_LATENCY_BUCKETS_MS = (10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+PARSED_MESSAGE_CACHE_SIZE = 64
+TRACKING_TOKEN_CACHE_SIZE = 4096
+INTERNAL_DATE_CACHE_SIZE = 1024
+TRACKING_TOKEN_CACHE_TTL_SECONDS = 15 * 60
+TRACKING_TOKEN_VERSION = 1
+TRACKING_TOKEN_STRUCT = struct.Struct(">BQ6s")
+TRACKING_TOKEN_MAC_BYTES = 12
+USER_DATETIME_CACHE_SIZE = 512
+PIXEL_EVENT_QUEUE_SIZE = 4096
+PIXEL_BATCH_MAX_EVENTS = 1000
+BOOT_GMAIL_PUSH_QUEUE_SIZE = 256
 LAST_SEEN_KEY = "last_seen_gmail_message_id"
 GMAIL_HISTORY_ID_KEY = "gmail_history_id"
 GMAIL_WATCH_EXPIRATION_KEY = "gmail_watch_expiration"
 GOOGLE_OAUTH_STATE_KEY = "google_oauth_pending_state"
 GMAIL_INITIAL_SYNC_KEY = "gmail_initial_sync_pending"
+TRACKING_SESSION_WINDOW_KEY = "tracking_session_window_seconds"
 PREDEF_FWD = ["redazione@example.com", "boss@example.com"]
 DEFAULT_PROMPT = (
     "Sei un assistente professionale. Scrivi una risposta "
@@ -79,6 +96,8 @@ TRACKED_DRAFT_RECIPIENT_KEY = "tracked_draft_recipient"
 TRACKED_DRAFT_SUBJECT_KEY = "tracked_draft_subject"
 GMAIL_PUSH_RENEW_MARGIN_SECONDS = 24 * 60 * 60
 GMAIL_PUSH_LOOP_INTERVAL_SECONDS = 60
+GMAIL_TOKEN_REFRESH_MARGIN_SECONDS = 5 * 60
+GMAIL_TOKEN_REFRESH_LOOP_SECONDS = 60
 MENU_TRACKED_EMAIL = "Email Tracciata"
 MENU_STATS = "Stats"
 MENU_SETTINGS = "Impostazioni"
@@ -87,6 +106,16 @@ TRACKED_DRAFT_EDITOR_NOTE = (
     "📨 Invia con tracking qui su Telegram."
 )
 TRACKING_SESSION_WINDOW_SECONDS = 90
+PIXEL_EVENT_MS_MISSING = -(2**63)
+EPOCH_MS_COLUMNS = (
+    ("email_state", "updated_at", "updated_ms"),
+    ("pending_actions", "created_at", "created_ms"),
+    ("interactive_prompts", "created_at", "created_ms"),
+    ("tracked_emails", "updated_at", "updated_ms"),
+    ("pixel_events", "created_at", "created_ms"),
+)
+EPOCH_MS_COLUMN_BY_TABLE = {table: ms_column for table, _source_column, ms_column in EPOCH_MS_COLUMNS}
+PIXEL_GROUP_CODES = {"user": 1, "proxy": 2}
 DEFAULT_TIMEZONE_BY_LANG = {
     "it": "Europe/Rome",
     "en": "UTC",
@@ -125,6 +154,14 @@ def utcnow_iso() -> str:
     return datetime.now(timezone.utc).isoformat()
 
 
+def epoch_ms_sql(column: str) -> str:
+    return f"CAST(ROUND((julianday({column}) - 2440587.5) * 86400000) AS INTEGER)"
+
+
+def datetime_to_epoch_ms(value: datetime) -> int:
+    return int(round(value.timestamp() * 1000))
+
+
 def utcnow() -> datetime:
     return datetime.now(timezone.utc)
 
@@ -205,6 +242,11 @@ def parse_iso_datetime(value: str | None) -> datetime | None:
     return parsed
 
 
+def pixel_event_time(event: PixelEvent, default: str) -> str:
+    received = parse_iso_datetime(event.received_at)
+    return received.astimezone(timezone.utc).isoformat() if received is not None else default
+
+
 def parse_epoch_millis(value: str | None) -> int | None:
     if value is None:
         return None
@@ -250,51 +292,66 @@ def pixel_event_group(classification: str, is_user_open: bool | None) -> str:
     return "other"
 
 
+class UserDatetimeFormatter:
+    def __init__(self, lang: str, timezone_name: str):
+        self.italian = normalized_lang(lang) == "it"
+        self.zone_name = resolve_timezone_name(timezone_name, lang)
+        try:
+            self.zone: Any = ZoneInfo(self.zone_name)
+        except ZoneInfoNotFoundError:
+            self.zone = timezone.utc
+        self.month_labels = tuple(MONTH_LABELS.get(normalized_lang(lang), MONTH_LABELS["en"]))
+        self._absolute = LRUCache(USER_DATETIME_CACHE_SIZE)
+
+    def absolute(self, value: str) -> tuple[datetime, str] | None:
+        cached = self._absolute.get(value)
+        if cached is not None:
+            return cached
+        parsed = parse_iso_datetime(value)
+        if parsed is None:
+            return None
+        local_dt = parsed.astimezone(self.zone)
+        month = self.month_labels[local_dt.month - 1]
+        tz_label = local_dt.tzname() or self.zone_name
+        if self.italian:
+            base = f"{local_dt.day} {month} {local_dt.year}, {local_dt:%H:%M} {tz_label}"
+        else:
+            hour = local_dt.strftime("%I").lstrip("0") or "0"
+            base = f"{month} {local_dt.day}, {local_dt.year}, {hour}:{local_dt:%M} {local_dt:%p} {tz_label}"
+        result = (parsed, base)
+        self._absolute.put(value, result)
+        return result
+
+    def relative(self, parsed: datetime) -> str:
+        seconds = abs(int((utcnow() - parsed).total_seconds()))
+        if seconds < 60:
+            return "adesso" if self.italian else "just now"
+        if seconds < 3600:
+            minutes = max(1, seconds // 60)
+            return f"{minutes} min fa" if self.italian else f"{minutes} min ago"
+        if seconds < 86400:
+            hours = max(1, seconds // 3600)
+            return f"{hours} h fa" if self.italian else f"{hours} h ago"
+        days = max(1, seconds // 86400)
+        return f"{days} g fa" if self.italian else f"{days} d ago"
+
+    def format(self, value: str | None) -> str:
+        if not value:
+            return ""
+        absolute = self.absolute(value)
+        if absolute is None:
+            return ""
+        parsed, base = absolute
+        return f"{base} ({self.relative(parsed)})"
+
+
+@functools.lru_cache(maxsize=32)
+def user_datetime_formatter(lang: str, timezone_name: str) -> UserDatetimeFormatter:
+    return UserDatetimeFormatter(lang, timezone_name)
+
+
 def format_user_datetime(value: str | None, *, lang: str, timezone_name: str) -> str:
-    parsed = parse_iso_datetime(value)
-    if parsed is None:
-        return ""
-    try:
-        zone = ZoneInfo(resolve_timezone_name(timezone_name, lang))
-    except ZoneInfoNotFoundError:
-        zone = timezone.utc
-    local_dt = parsed.astimezone(zone)
-    month_labels = MONTH_LABELS.get(normalized_lang(lang), MONTH_LABELS["en"])
-    month = month_labels[local_dt.month - 1]
-    tz_label = local_dt.tzname() or resolve_timezone_name(timezone_name, lang)
-    if normalized_lang(lang) == "it":
-        base = f"{local_dt.day} {month} {local_dt.year}, {local_dt:%H:%M} {tz_label}"
-    else:
-        hour = local_dt.strftime("%I").lstrip("0") or "0"
-        base = f"{month} {local_dt.day}, {local_dt.year}, {hour}:{local_dt:%M} {local_dt:%p} {tz_label}"
-
-    now_local = utcnow().astimezone(zone)
-    delta = now_local - local_dt
-    seconds = int(delta.total_seconds())
-    if abs(seconds) < 60:
-        relative = "adesso" if normalized_lang(lang) == "it" else "just now"
-    elif abs(seconds) < 3600:
-        minutes = max(1, abs(seconds) // 60)
-        relative = (
-            f"{minutes} min fa"
-            if normalized_lang(lang) == "it"
-            else f"{minutes} min ago"
-        )
-    elif abs(seconds) < 86400:
-        hours = max(1, abs(seconds) // 3600)
-        relative = (
-            f"{hours} h fa"
-            if normalized_lang(lang) == "it"
-            else f"{hours} h ago"
-        )
-    else:
-        days = max(1, abs(seconds) // 86400)
-        relative = (
-            f"{days} g fa"
-            if normalized_lang(lang) == "it"
-            else f"{days} d ago"
-        )
-    return f"{base} ({relative})"
+    return user_datetime_formatter(lang or "", timezone_name or "").format(value)
 
 
 def localized_manual_reply_placeholder(lang: str) -> str:
@@ -303,7 +360,99 @@ def localized_manual_reply_placeholder(lang: str) -> str:
     return "Write your reply here and finish it in Gmail."
 
 
-@dataclass(slots=True)
+@dataclass(frozen=True, slots=True)
+class ConfigOverride:
+    key: str
+    attr: str
+    parse: Callable[[str, Any], Any]
+
+
+def override_text(raw: str, current: Any) -> str:
+    return raw.strip()
+
+
+def override_text_or_current(raw: str, current: Any) -> Any:
+    return raw.strip() or current
+
+
+def override_monitor_labels(raw: str, current: List[str]) -> List[str]:
+    return parse_list(raw, current) or ["INBOX"]
+
+
+CONFIG_OVERRIDE_FIELDS: Dict[str, ConfigOverride] = {
+    spec.key: spec
+    for spec in (
+        ConfigOverride("TELEGRAM_CHAT_ID", "chat_id", parse_int),
+        ConfigOverride("GOOGLE_API_KEY", "google_api_key", override_text),
+        ConfigOverride("PUBLIC_BASE_URL", "public_base_url", override_text_or_current),
+        ConfigOverride("GOOGLE_OAUTH_CREDENTIALS_JSON", "google_oauth_credentials_json", override_text),
+        ConfigOverride("GOOGLE_OAUTH_TOKEN_JSON", "google_oauth_token_json", override_text),
+        ConfigOverride("ENABLE_PIXEL", "enable_pixel", parse_bool),
+        ConfigOverride("PIXEL_BASE_URL", "pixel_base_url", override_text),
+        ConfigOverride("PIXEL_WEBHOOK_SECRET", "pixel_webhook_secret", override_text),
+        ConfigOverride("PIXEL_WEBHOOK_URL", "pixel_webhook_url", override_text),
+        ConfigOverride("HOST", "host", override_text_or_current),
+        ConfigOverride("PORT", "port", parse_int),
+        ConfigOverride("WATCH_INTERVAL", "watch_interval", parse_int),
+        ConfigOverride("LANG", "lang", override_text_or_current),
+        ConfigOverride("TIMEZONE", "timezone_name", override_text),
+        ConfigOverride("AI_MODEL", "ai_model", override_text_or_current),
+        ConfigOverride("SYSTEM_PROMPT", "system_prompt", override_text_or_current),
+        ConfigOverride("GMAIL_MONITOR_LABELS", "gmail_monitor_labels", override_monitor_labels),
+        ConfigOverride("PREDEF_FWD", "predef_fwd", parse_list),
+        ConfigOverride("STATE_RETENTION_DAYS", "state_retention_days", parse_int),
+        ConfigOverride("PIXEL_DEDUP_WINDOW_SECONDS", "pixel_dedup_window_seconds", parse_int),
+        ConfigOverride("TELEGRAM_WEBHOOK_URL", "telegram_webhook_url", override_text),
+        ConfigOverride("TELEGRAM_WEBHOOK_SECRET", "telegram_webhook_secret", override_text),
+        ConfigOverride("GMAIL_PUSH_TOPIC", "gmail_push_topic", override_text),
+        ConfigOverride("GMAIL_PUSH_WEBHOOK_SECRET", "gmail_push_webhook_secret", override_text),
+    )
+}
+
+
+class CredentialFileTracker:
+    def __init__(self) -> None:
+        self._lock = threading.Lock()
+        self._fingerprints: Dict[Path, bytes] = {}
+        self.reads = 0
+        self.writes = 0
+        self.reads_avoided = 0
+        self.writes_avoided = 0
+
+    def materialize(self, path: Path, source_json: str, force: bool = False) -> bool:
+        fingerprint = hashlib.sha256(source_json.encode("utf-8")).digest()
+        with self._lock:
+            if not force and self._fingerprints.get(path) == fingerprint and path.exists():
+                self.reads_avoided += 1
+                self.writes_avoided += 1
+                return False
+            content = json.dumps(json.loads(source_json), indent=2, ensure_ascii=False) + "\n"
+            path.parent.mkdir(parents=True, exist_ok=True)
+            current = path.read_text() if path.exists() else ""
+            self.reads += 1
+            written = current != content
+            if written:
+                atomic_write_text(path, content)
+                self.writes += 1
+            else:
+                self.writes_avoided += 1
+            self._fingerprints[path] = fingerprint
+            return written
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {
+                "reads": self.reads,
+                "writes": self.writes,
+                "reads_avoided": self.reads_avoided,
+                "writes_avoided": self.writes_avoided,
+            }
+
+
+CREDENTIAL_FILES = CredentialFileTracker()
+
+
+@dataclass(frozen=True, slots=True)
 class Config:
     bot_token: str
     chat_id: int
@@ -333,6 +482,9 @@ class Config:
     telegram_webhook_secret: str
     gmail_push_topic: str
     gmail_push_webhook_secret: str
+    attachment_cache_max_mb: int
+    pixel_dedup_window_seconds: int
+    gmail_workers: int
 
     @classmethod
     def from_env(cls, env: Mapping[str, str] | None = None) -> "Config":
@@ -382,6 +534,13 @@ class Config:
         telegram_webhook_secret = source.get("TELEGRAM_WEBHOOK_SECRET", "").strip()
         gmail_push_topic = source.get("GMAIL_PUSH_TOPIC", "").strip()
         gmail_push_webhook_secret = source.get("GMAIL_PUSH_WEBHOOK_SECRET", "").strip()
+        attachment_cache_max_mb_raw = source.get(
+            "ATTACHMENT_CACHE_MAX_MB", str(ATTACHMENT_CACHE_MAX_MB)
+        ).strip()
+        pixel_dedup_window_raw = source.get(
+            "PIXEL_DEDUP_WINDOW_SECONDS", str(PIXEL_DEDUP_WINDOW_SECONDS)
+        ).strip()
+        gmail_workers_raw = source.get("GMAIL_WORKERS", str(GMAIL_WORKERS)).strip()
 
         if not bot_token:
             raise ConfigError("Missing TELEGRAM_BOT_TOKEN")
@@ -399,6 +558,18 @@ class Config:
             state_retention_days = int(state_retention_days_raw)
         except ValueError as exc:
             raise ConfigError("STATE_RETENTION_DAYS must be integer") from exc
+        try:
+            attachment_cache_max_mb = int(attachment_cache_max_mb_raw)
+        except ValueError as exc:
+            raise ConfigError("ATTACHMENT_CACHE_MAX_MB must be integer") from exc
+        try:
+            pixel_dedup_window_seconds = int(pixel_dedup_window_raw)
+        except ValueError as exc:
+            raise ConfigError("PIXEL_DEDUP_WINDOW_SECONDS must be integer") from exc
+        try:
+            gmail_workers = int(gmail_workers_raw)
+        except ValueError as exc:
+            raise ConfigError("GMAIL_WORKERS must be integer") from exc
         validate_timezone_name(timezone_name, lang)
 
         return cls(
@@ -430,6 +601,9 @@ class Config:
             telegram_webhook_secret=telegram_webhook_secret,
             gmail_push_topic=gmail_push_topic,
             gmail_push_webhook_secret=gmail_push_webhook_secret,
+            attachment_cache_max_mb=attachment_cache_max_mb,
+            pixel_dedup_window_seconds=pixel_dedup_window_seconds,
+            gmail_workers=gmail_workers,
         )
 
     def ensure_storage(self) -> None:
@@ -438,25 +612,17 @@ class Config:
         self.gmail_token_path.parent.mkdir(parents=True, exist_ok=True)
         self.gmail_credentials_path.parent.mkdir(parents=True, exist_ok=True)
 
-    def materialize_google_credentials(self) -> None:
+    def materialize_google_credentials(self, force: bool = False) -> None:
         self.ensure_storage()
         if not self.google_oauth_credentials_json:
             return
-        payload = json.loads(self.google_oauth_credentials_json)
-        content = json.dumps(payload, indent=2, ensure_ascii=False) + "\n"
-        current = self.gmail_credentials_path.read_text() if self.gmail_credentials_path.exists() else ""
-        if current != content:
-            self.gmail_credentials_path.write_text(content)
+        CREDENTIAL_FILES.materialize(self.gmail_credentials_path, self.google_oauth_credentials_json, force)
 
-    def materialize_gmail_token(self) -> None:
+    def materialize_gmail_token(self, force: bool = False) -> None:
         self.ensure_storage()
         if not self.google_oauth_token_json:
             return
-        payload = json.loads(self.google_oauth_token_json)
-        content = json.dumps(payload, indent=2, ensure_ascii=False) + "\n"
-        current = self.gmail_token_path.read_text() if self.gmail_token_path.exists() else ""
-        if current != content:
-            self.gmail_token_path.write_text(content)
+        CREDENTIAL_FILES.materialize(self.gmail_token_path, self.google_oauth_token_json, force)
 
     def validate_mode(self, mode: str) -> None:
         self.validate_effective(mode)
@@ -470,6 +636,10 @@ class Config:
             raise ConfigError("WATCH_INTERVAL must be > 0")
         if self.state_retention_days <= 0:
             raise ConfigError("STATE_RETENTION_DAYS must be > 0")
+        if self.pixel_dedup_window_seconds < 0:
+            raise ConfigError("PIXEL_DEDUP_WINDOW_SECONDS must be >= 0")
+        if self.gmail_workers <= 0:
+            raise ConfigError("GMAIL_WORKERS must be > 0")
         if not self.gmail_monitor_labels:
             raise ConfigError("GMAIL_MONITOR_LABELS must contain at least one label")
         if self.enable_pixel and not self.pixel_webhook_secret:
@@ -499,84 +669,15 @@ class Config:
         if not overrides:
             return self
 
-        data = {
-            "chat_id": self.chat_id,
-            "google_api_key": self.google_api_key,
-            "enable_pixel": self.enable_pixel,
-            "pixel_base_url": self.pixel_base_url,
-            "pixel_webhook_secret": self.pixel_webhook_secret,
-            "pixel_webhook_url": self.pixel_webhook_url,
-            "host": self.host,
-            "port": self.port,
-            "watch_interval": self.watch_interval,
-            "lang": self.lang,
-            "timezone_name": self.timezone_name,
-            "ai_model": self.ai_model,
-            "system_prompt": self.system_prompt,
-            "gmail_monitor_labels": list(self.gmail_monitor_labels),
-            "predef_fwd": list(self.predef_fwd),
-            "state_retention_days": self.state_retention_days,
-            "public_base_url": self.public_base_url,
-            "google_oauth_credentials_json": self.google_oauth_credentials_json,
-            "google_oauth_token_json": self.google_oauth_token_json,
-            "telegram_webhook_url": self.telegram_webhook_url,
-            "telegram_webhook_secret": self.telegram_webhook_secret,
-            "gmail_push_topic": self.gmail_push_topic,
-            "gmail_push_webhook_secret": self.gmail_push_webhook_secret,
-        }
-
-        if "TELEGRAM_CHAT_ID" in overrides:
-            data["chat_id"] = parse_int(overrides["TELEGRAM_CHAT_ID"], data["chat_id"])
-        if "GOOGLE_API_KEY" in overrides:
-            data["google_api_key"] = overrides["GOOGLE_API_KEY"].strip()
-        if "PUBLIC_BASE_URL" in overrides:
-            data["public_base_url"] = overrides["PUBLIC_BASE_URL"].strip() or data["public_base_url"]
-        if "GOOGLE_OAUTH_CREDENTIALS_JSON" in overrides:
-            data["google_oauth_credentials_json"] = overrides["GOOGLE_OAUTH_CREDENTIALS_JSON"].strip()
-        if "GOOGLE_OAUTH_TOKEN_JSON" in overrides:
-            data["google_oauth_token_json"] = overrides["GOOGLE_OAUTH_TOKEN_JSON"].strip()
-        if "ENABLE_PIXEL" in overrides:
-            data["enable_pixel"] = parse_bool(overrides["ENABLE_PIXEL"], data["enable_pixel"])
-        if "PIXEL_BASE_URL" in overrides:
-            data["pixel_base_url"] = overrides["PIXEL_BASE_URL"].strip()
-        if "PIXEL_WEBHOOK_SECRET" in overrides:
-            data["pixel_webhook_secret"] = overrides["PIXEL_WEBHOOK_SECRET"].strip()
-        if "PIXEL_WEBHOOK_URL" in overrides:
-            data["pixel_webhook_url"] = overrides["PIXEL_WEBHOOK_URL"].strip()
-        if "HOST" in overrides:
-            data["host"] = overrides["HOST"].strip() or data["host"]
-        if "PORT" in overrides:
-            data["port"] = parse_int(overrides["PORT"], data["port"])
-        if "WATCH_INTERVAL" in overrides:
-            data["watch_interval"] = parse_int(overrides["WATCH_INTERVAL"], data["watch_interval"])
-        if "LANG" in overrides:
-            data["lang"] = overrides["LANG"].strip() or data["lang"]
-        if "TIMEZONE" in overrides:
-            data["timezone_name"] = overrides["TIMEZONE"].strip()
-        if "AI_MODEL" in overrides:
-            data["ai_model"] = overrides["AI_MODEL"].strip() or data["ai_model"]
-        if "SYSTEM_PROMPT" in overrides:
-            data["system_prompt"] = overrides["SYSTEM_PROMPT"].strip() or data["system_prompt"]
-        if "GMAIL_MONITOR_LABELS" in overrides:
-            data["gmail_monitor_labels"] = parse_list(
-                overrides["GMAIL_MONITOR_LABELS"], data["gmail_monitor_labels"]
-            ) or ["INBOX"]
-        if "PREDEF_FWD" in overrides:
-            data["predef_fwd"] = parse_list(overrides["PREDEF_FWD"], data["predef_fwd"])
-        if "STATE_RETENTION_DAYS" in overrides:
-            data["state_retention_days"] = parse_int(
-                overrides["STATE_RETENTION_DAYS"], data["state_retention_days"]
-            )
-        if "TELEGRAM_WEBHOOK_URL" in overrides:
-            data["telegram_webhook_url"] = overrides["TELEGRAM_WEBHOOK_URL"].strip()
-        if "TELEGRAM_WEBHOOK_SECRET" in overrides:
-            data["telegram_webhook_secret"] = overrides["TELEGRAM_WEBHOOK_SECRET"].strip()
-        if "GMAIL_PUSH_TOPIC" in overrides:
-            data["gmail_push_topic"] = overrides["GMAIL_PUSH_TOPIC"].strip()
-        if "GMAIL_PUSH_WEBHOOK_SECRET" in overrides:
-            data["gmail_push_webhook_secret"] = overrides["GMAIL_PUSH_WEBHOOK_SECRET"].strip()
+        changes: Dict[str, Any] = {}
+        for key, raw in overrides.items():
+            spec = CONFIG_OVERRIDE_FIELDS.get(key)
+            if spec is not None:
+                changes[spec.attr] = spec.parse(raw, getattr(self, spec.attr))
+        return replace(self, **changes)
 
-        return replace(self, **data)
+    def changed_fields(self, other: "Config") -> set[str]:
+        return {item.name for item in fields(self) if getattr(self, item.name) != getattr(other, item.name)}
 
     def resolved_gmail_push_url(self) -> str:
         base = self.resolved_public_base_url().rstrip("/") + "/gmail/push"
@@ -585,6 +686,16 @@ class Config:
         return f"{base}?secret={quote(self.gmail_push_webhook_secret, safe='')}"
 
 
+@dataclass(slots=True)
+class EmailRender:
+    subject: str
+    body: str
+    header_html: str
+    body_html: str
+    override_source: str = ""
+    override_html: str = ""
+
+
 @dataclass(slots=True)
 class EmailState:
     tg_message_id: int
@@ -600,6 +711,7 @@ class EmailState:
     ai_body: str = ""
     created_at: str = ""
     updated_at: str = ""
+    render: EmailRender | None = dataclass_field(default=None, repr=False, compare=False)
 
     @classmethod
     def from_row(cls, row: sqlite3.Row) -> "EmailState":
@@ -620,6 +732,90 @@ class EmailState:
         )
 
 
+@dataclass(slots=True)
+class PixelEvent:
+    tg_message_id: int
+    classification: str
+    layer: str
+    dimensions: str
+    confidence: float | None
+    is_user_open: bool | None
+    email_subject: str
+    pixel_id: str
+    received_at: str
+
+    @classmethod
+    def from_payload(cls, event: Mapping[str, Any]) -> "PixelEvent":
+        try:
+            tg_message_id = int(event.get("tg_msg_id") or 0)
+        except (TypeError, ValueError) as exc:
+            raise ConfigError("tg_msg_id invalid") from exc
+        if not tg_message_id:
+            raise ConfigError("tg_msg_id missing")
+
+        confidence = event.get("confidence")
+        try:
+            confidence_value = float(confidence) if confidence not in (None, "") else None
+        except (TypeError, ValueError):
+            confidence_value = None
+
+        is_user_open = event.get("is_user_open")
+        if is_user_open is None:
+            is_user_open_value = None
+        elif isinstance(is_user_open, bool):
+            is_user_open_value = is_user_open
+        else:
+            is_user_open_value = parse_bool(str(is_user_open), default=False)
+
+        return cls(
+            tg_message_id=tg_message_id,
+            classification=str(event.get("classification") or ""),
+            layer=str(event.get("layer") or "img"),
+            dimensions=str(event.get("dimensions") or ""),
+            confidence=confidence_value,
+            is_user_open=is_user_open_value,
+            email_subject=str(event.get("email_subject") or ""),
+            pixel_id=str(event.get("pixel_id") or ""),
+            received_at=str(event.get("received_at") or utcnow_iso()),
+        )
+
+
+@dataclass(slots=True)
+class PixelEventColumns:
+    tg_message_ids: array
+    created_ms: array
+    groups: array
+
+    def __len__(self) -> int:
+        return len(self.tg_message_ids)
+
+
+def session_counts_from_columns(
+    columns: PixelEventColumns, window_seconds: float = TRACKING_SESSION_WINDOW_SECONDS
+) -> Dict[int, Dict[str, int]]:
+    window_ms = window_seconds * 1000
+    missing = PIXEL_EVENT_MS_MISSING
+    counts: Dict[int, Dict[str, int]] = {}
+    current: int | None = None
+    entry: Dict[str, int] = {}
+    user_start = proxy_start = missing
+    for tg_message_id, created_ms, group in zip(columns.tg_message_ids, columns.created_ms, columns.groups):
+        if tg_message_id != current:
+            current = tg_message_id
+            entry = counts[tg_message_id] = {"open_count": 0, "proxy_count": 0, "raw_event_count": 0}
+            user_start = proxy_start = missing
+        entry["raw_event_count"] += 1
+        if group == 1:
+            if created_ms == missing or user_start == missing or created_ms - user_start > window_ms:
+                entry["open_count"] += 1
+                user_start = created_ms
+        elif group == 2:
+            if created_ms == missing or proxy_start == missing or created_ms - proxy_start > window_ms:
+                entry["proxy_count"] += 1
+                proxy_start = created_ms
+    return counts
+
+
 @dataclass(slots=True)
 class TrackedEmail:
     tg_message_id: int
@@ -704,10 +900,14 @@ class StateStore:
         self._lock = threading.RLock()
         self._conn = sqlite3.connect(self.path, check_same_thread=False)
         self._conn.row_factory = sqlite3.Row
+        self._app_settings: Dict[str, str] | None = None
         with self._conn:
             self._conn.execute("PRAGMA journal_mode=WAL")
             self._conn.execute("PRAGMA foreign_keys=ON")
         self._init_schema()
+        self._session_window_seconds = float(
+            self.get_bot_state(TRACKING_SESSION_WINDOW_KEY) or TRACKING_SESSION_WINDOW_SECONDS
+        )
 
     def _init_schema(self) -> None:
         with self._lock, self._conn:
@@ -788,15 +988,37 @@ class StateStore:
                 ON pixel_events (tg_message_id);
                 """
             )
+            self._ensure_epoch_ms_columns()
+            self._conn.executescript(
+                """
+                CREATE INDEX IF NOT EXISTS idx_email_state_updated_ms ON email_state (updated_ms);
+                CREATE INDEX IF NOT EXISTS idx_pending_actions_created_ms ON pending_actions (created_ms);
+                CREATE INDEX IF NOT EXISTS idx_interactive_prompts_created_ms ON interactive_prompts (created_ms);
+                CREATE INDEX IF NOT EXISTS idx_tracked_emails_updated_ms ON tracked_emails (updated_ms);
+                CREATE INDEX IF NOT EXISTS idx_pixel_events_created_ms ON pixel_events (created_ms);
+                CREATE INDEX IF NOT EXISTS idx_pixel_events_tg_created_ms ON pixel_events (tg_message_id, created_ms);
+                """
+            )
+
+    def _ensure_epoch_ms_columns(self) -> None:
+        for table, source_column, ms_column in EPOCH_MS_COLUMNS:
+            columns = {row["name"] for row in self._conn.execute(f"PRAGMA table_xinfo({table})")}
+            if ms_column in columns:
+                continue
+            self._conn.execute(
+                f"ALTER TABLE {table} ADD COLUMN {ms_column} INTEGER "
+                f"GENERATED ALWAYS AS ({epoch_ms_sql(source_column)}) VIRTUAL"
+            )
 
     def purge_old_rows(self, days: int = STATE_RETENTION_DAYS) -> None:
-        cutoff = (utcnow() - timedelta(days=days)).isoformat()
+        cutoff_ms = datetime_to_epoch_ms(utcnow() - timedelta(days=days))
         with self._lock, self._conn:
-            self._conn.execute("DELETE FROM pending_actions WHERE created_at < ?", (cutoff,))
-            self._conn.execute("DELETE FROM interactive_prompts WHERE created_at < ?", (cutoff,))
-            self._conn.execute("DELETE FROM email_state WHERE updated_at < ?", (cutoff,))
-            self._conn.execute("DELETE FROM pixel_events WHERE created_at < ?", (cutoff,))
-            self._conn.execute("DELETE FROM tracked_emails WHERE updated_at < ?", (cutoff,))
+            for table in ("pending_actions", "interactive_prompts", "email_state", "pixel_events", "tracked_emails"):
+                ms_column = EPOCH_MS_COLUMN_BY_TABLE[table]
+                self._conn.execute(
+                    f"DELETE FROM {table} WHERE {ms_column} < ? OR {ms_column} IS NULL",
+                    (cutoff_ms,),
+                )
             self._conn.execute(
                 """
                 DELETE FROM pending_actions
@@ -845,6 +1067,13 @@ class StateStore:
                 ),
             )
 
+    def update_attachments(self, tg_message_id: int, attachments: List[dict]) -> None:
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE email_state SET attachments_json = ?, updated_at = ? WHERE tg_message_id = ?",
+                (json.dumps(attachments), utcnow_iso(), tg_message_id),
+            )
+
     def get_email_state(self, tg_message_id: int) -> EmailState | None:
         with self._lock:
             row = self._conn.execute(
@@ -905,14 +1134,30 @@ class StateStore:
     def list_tracked_emails(self, limit: int = 10) -> List[TrackedEmail]:
         with self._lock:
             rows = self._conn.execute(
-                "SELECT * FROM tracked_emails ORDER BY updated_at DESC, tg_message_id DESC LIMIT ?",
+                "SELECT * FROM tracked_emails ORDER BY updated_ms DESC, tg_message_id DESC LIMIT ?",
                 (limit,),
             ).fetchall()
-        return [self._tracked_email_from_row(row) for row in rows]
+            events: Dict[int, List[sqlite3.Row]] = {row["tg_message_id"]: [] for row in rows}
+            for event in self._conn.execute(
+                """
+                SELECT tg_message_id, id, classification, layer, dimensions, confidence, is_user_open, created_at, created_ms
+                FROM pixel_events
+                WHERE tg_message_id IN (
+                    SELECT tg_message_id FROM tracked_emails ORDER BY updated_ms DESC, tg_message_id DESC LIMIT ?
+                )
+                ORDER BY tg_message_id ASC, created_ms ASC, id ASC
+                """,
+                (limit,),
+            ):
+                events[event["tg_message_id"]].append(event)
+        return [self._tracked_email_from_row(row, events[row["tg_message_id"]]) for row in rows]
 
-    def _tracked_email_from_row(self, row: sqlite3.Row) -> TrackedEmail:
+    def _tracked_email_from_row(self, row: sqlite3.Row, events: List[sqlite3.Row] | None = None) -> TrackedEmail:
         tracked = TrackedEmail.from_row(row)
-        metrics = self._tracked_event_metrics(tracked.tg_message_id)
+        if events is None:
+            metrics = self._tracked_event_metrics(tracked.tg_message_id)
+        else:
+            metrics = self._tracked_event_metrics_from_rows(events)
         return replace(
             tracked,
             open_count=metrics["open_count"],
@@ -937,10 +1182,10 @@ class StateStore:
         with self._lock:
             rows = self._conn.execute(
                 """
-                SELECT id, classification, layer, dimensions, confidence, is_user_open, created_at
+                SELECT id, classification, layer, dimensions, confidence, is_user_open, created_at, created_ms
                 FROM pixel_events
                 WHERE tg_message_id = ?
-                ORDER BY created_at ASC, id ASC
+                ORDER BY created_ms ASC, id ASC
                 """,
                 (tg_message_id,),
             ).fetchall()
@@ -965,8 +1210,9 @@ class StateStore:
             "last_user_layer": "",
             "last_user_confidence": None,
         }
-        last_user_session_at: datetime | None = None
-        last_proxy_session_at: datetime | None = None
+        window_ms = self._session_window_seconds * 1000
+        last_user_session_ms: int | None = None
+        last_proxy_session_ms: int | None = None
 
         for row in rows:
             classification = str(row["classification"] or "")
@@ -980,7 +1226,7 @@ class StateStore:
             else:
                 is_user_open = bool(is_user_open_raw)
             created_at = str(row["created_at"] or "")
-            parsed = parse_iso_datetime(created_at)
+            created_ms = row["created_ms"]
 
             metrics["last_classification"] = classification
             metrics["last_layer"] = layer
@@ -995,25 +1241,61 @@ class StateStore:
                 metrics["last_user_confidence"] = confidence_value
                 if metrics["first_opened_at"] == "":
                     metrics["first_opened_at"] = created_at
-                if parsed is None or last_user_session_at is None:
-                    metrics["open_count"] += 1
-                    last_user_session_at = parsed
-                elif (parsed - last_user_session_at).total_seconds() > TRACKING_SESSION_WINDOW_SECONDS:
+                if created_ms is None or last_user_session_ms is None or created_ms - last_user_session_ms > window_ms:
                     metrics["open_count"] += 1
-                    last_user_session_at = parsed
+                    last_user_session_ms = created_ms
             elif group == "proxy":
                 metrics["last_proxy_at"] = created_at
                 metrics["last_proxy_classification"] = classification
                 metrics["last_proxy_layer"] = layer
                 metrics["last_proxy_confidence"] = confidence_value
-                if parsed is None or last_proxy_session_at is None:
+                if created_ms is None or last_proxy_session_ms is None or created_ms - last_proxy_session_ms > window_ms:
                     metrics["proxy_count"] += 1
-                    last_proxy_session_at = parsed
-                elif (parsed - last_proxy_session_at).total_seconds() > TRACKING_SESSION_WINDOW_SECONDS:
-                    metrics["proxy_count"] += 1
-                    last_proxy_session_at = parsed
+                    last_proxy_session_ms = created_ms
         return metrics
 
+    def load_pixel_event_columns(self) -> PixelEventColumns:
+        with self._lock:
+            cursor = self._conn.cursor()
+            cursor.row_factory = None
+            rows = cursor.execute(
+                """
+                SELECT tg_message_id, classification, is_user_open, COALESCE(created_ms, ?)
+                FROM pixel_events
+                ORDER BY tg_message_id ASC, created_ms ASC, id ASC
+                """,
+                (PIXEL_EVENT_MS_MISSING,),
+            ).fetchall()
+        group_codes = {
+            (classification, is_user_open): PIXEL_GROUP_CODES.get(
+                pixel_event_group(str(classification or ""), None if is_user_open is None else bool(is_user_open)), 0
+            )
+            for classification, is_user_open in {(row[1], row[2]) for row in rows}
+        }
+        return PixelEventColumns(
+            tg_message_ids=array("q", [row[0] for row in rows]),
+            created_ms=array("q", [row[3] for row in rows]),
+            groups=array("b", [group_codes[(row[1], row[2])] for row in rows]),
+        )
+
+    def tracked_session_counts(self, window_seconds: float | None = None) -> Dict[int, Dict[str, int]]:
+        return session_counts_from_columns(
+            self.load_pixel_event_columns(),
+            self._session_window_seconds if window_seconds is None else window_seconds,
+        )
+
+    def rescore_tracked_emails(self, window_seconds: float = TRACKING_SESSION_WINDOW_SECONDS) -> int:
+        counts = self.tracked_session_counts(window_seconds)
+        with self._lock, self._conn:
+            tracked_ids = [row[0] for row in self._conn.execute("SELECT tg_message_id FROM tracked_emails")]
+            self._conn.executemany(
+                "UPDATE tracked_emails SET open_count = ? WHERE tg_message_id = ?",
+                [(counts.get(tg_message_id, {}).get("open_count", 0), tg_message_id) for tg_message_id in tracked_ids],
+            )
+        self.set_bot_state(TRACKING_SESSION_WINDOW_KEY, str(window_seconds))
+        self._session_window_seconds = float(window_seconds)
+        return len(tracked_ids)
+
     def record_pixel_event(
         self,
         *,
@@ -1025,63 +1307,91 @@ class StateStore:
         is_user_open: bool | None,
         email_subject: str,
     ) -> TrackedEmail | None:
+        event = PixelEvent(
+            tg_message_id=tg_message_id,
+            classification=classification,
+            layer=layer,
+            dimensions=dimensions,
+            confidence=confidence,
+            is_user_open=is_user_open,
+            email_subject=email_subject,
+            pixel_id="",
+            received_at="",
+        )
+        return self.record_pixel_events([event]).get(tg_message_id)
+
+    def record_pixel_events(self, events: List[PixelEvent]) -> Dict[int, TrackedEmail]:
         event_time = utcnow_iso()
+        by_message: Dict[int, List[PixelEvent]] = {}
+        for event in events:
+            by_message.setdefault(event.tg_message_id, []).append(event)
+        recorded: List[int] = []
         with self._lock, self._conn:
-            tracked_row = self._conn.execute(
-                "SELECT * FROM tracked_emails WHERE tg_message_id = ?",
-                (tg_message_id,),
-            ).fetchone()
-            if tracked_row is None:
-                return None
-            self._conn.execute(
-                """
-                INSERT INTO pixel_events (
-                    tg_message_id, classification, layer, dimensions, confidence,
-                    is_user_open, email_subject, created_at
-                ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
-                """,
-                (
-                    tg_message_id,
-                    classification,
-                    layer,
-                    dimensions,
-                    confidence,
-                    None if is_user_open is None else int(is_user_open),
-                    email_subject,
-                    event_time,
-                ),
-            )
-            rows = self._conn.execute(
-                """
-                SELECT id, classification, layer, dimensions, confidence, is_user_open, created_at
-                FROM pixel_events
-                WHERE tg_message_id = ?
-                ORDER BY created_at ASC, id ASC
-                """,
-                (tg_message_id,),
-            ).fetchall()
-            metrics = self._tracked_event_metrics_from_rows(rows)
-            self._conn.execute(
-                """
-                UPDATE tracked_emails
-                SET open_count = ?, first_opened_at = ?, last_opened_at = ?,
-                    last_classification = ?, last_layer = ?, last_dimensions = ?,
-                    last_confidence = ?, updated_at = ?
-                WHERE tg_message_id = ?
-                """,
-                (
-                    metrics["open_count"],
-                    metrics["first_opened_at"],
-                    metrics["last_opened_at"],
-                    metrics["last_classification"],
-                    metrics["last_layer"],
-                    metrics["last_dimensions"],
-                    metrics["last_confidence"],
-                    event_time,
-                    tg_message_id,
-                ),
-            )
-        return self.get_tracked_email(tg_message_id)
+            for tg_message_id, message_events in by_message.items():
+                tracked_row = self._conn.execute(
+                    "SELECT 1 FROM tracked_emails WHERE tg_message_id = ?",
+                    (tg_message_id,),
+                ).fetchone()
+                if tracked_row is None:
+                    continue
+                self._conn.executemany(
+                    """
+                    INSERT INTO pixel_events (
+                        tg_message_id, classification, layer, dimensions, confidence,
+                        is_user_open, email_subject, created_at
+                    ) VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+                    """,
+                    [
+                        (
+                            tg_message_id,
+                            event.classification,
+                            event.layer,
+                            event.dimensions,
+                            event.confidence,
+                            None if event.is_user_open is None else int(event.is_user_open),
+                            event.email_subject,
+                            pixel_event_time(event, event_time),
+                        )
+                        for event in message_events
+                    ],
+                )
+                rows = self._conn.execute(
+                    """
+                    SELECT id, classification, layer, dimensions, confidence, is_user_open, created_at, created_ms
+                    FROM pixel_events
+                    WHERE tg_message_id = ?
+                    ORDER BY created_ms ASC, id ASC
+                    """,
+                    (tg_message_id,),
+                ).fetchall()
+                metrics = self._tracked_event_metrics_from_rows(rows)
+                self._conn.execute(
+                    """
+                    UPDATE tracked_emails
+                    SET open_count = ?, first_opened_at = ?, last_opened_at = ?,
+                        last_classification = ?, last_layer = ?, last_dimensions = ?,
+                        last_confidence = ?, updated_at = ?
+                    WHERE tg_message_id = ?
+                    """,
+                    (
+                        metrics["open_count"],
+                        metrics["first_opened_at"],
+                        metrics["last_opened_at"],
+                        metrics["last_classification"],
+                        metrics["last_layer"],
+                        metrics["last_dimensions"],
+                        metrics["last_confidence"],
+                        event_time,
+                        tg_message_id,
+                    ),
+                )
+                recorded.append(tg_message_id)
+        result: Dict[int, TrackedEmail] = {}
+        for tg_message_id in recorded:
+            tracked = self.get_tracked_email(tg_message_id)
+            if tracked is not None:
+                result[tg_message_id] = tracked
+        return result
 
     def update_ai_body(self, tg_message_id: int, ai_body: str) -> None:
         with self._lock, self._conn:
@@ -1208,32 +1518,111 @@ class StateStore:
                 """,
                 (key, value, utcnow_iso()),
             )
+            self._app_settings = None
 
     def delete_app_setting(self, key: str) -> None:
         with self._lock, self._conn:
             self._conn.execute("DELETE FROM app_settings WHERE key = ?", (key,))
+            self._app_settings = None
 
     def get_app_settings(self) -> Dict[str, str]:
         with self._lock:
-            rows = self._conn.execute("SELECT key, value FROM app_settings ORDER BY key").fetchall()
-        return {row["key"]: row["value"] or "" for row in rows}
+            if self._app_settings is None:
+                rows = self._conn.execute("SELECT key, value FROM app_settings ORDER BY key").fetchall()
+                self._app_settings = {row["key"]: row["value"] or "" for row in rows}
+            return dict(self._app_settings)
 
     def close(self) -> None:
         with self._lock:
             self._conn.close()
 
 
+def atomic_write_text(path: Path, content: str) -> None:
+    temp_path = path.with_suffix(f".{uuid4().hex}.tmp")
+    try:
+        temp_path.write_text(content, encoding="utf-8")
+        os.replace(temp_path, path)
+    finally:
+        temp_path.unlink(missing_ok=True)
+
+
+@functools.lru_cache(maxsize=1)
+def gmail_discovery_document() -> str | None:
+    from googleapiclient.discovery_cache import get_static_doc
+
+    return get_static_doc("gmail", "v1") or None
+
+
+@dataclass(frozen=True, slots=True)
+class LabelIndex:
+    names: Dict[str, str]
+    taggable: tuple[tuple[str, str], ...]
+    fingerprint: str
+
+    @classmethod
+    def from_labels(cls, labels: List[dict]) -> "LabelIndex":
+        names = {item["id"]: item["name"] for item in labels}
+        digest = hashlib.sha1()
+        for label_id, name in sorted(names.items()):
+            digest.update(f"{label_id}\0{name}\0".encode("utf-8"))
+        taggable = tuple(
+            sorted(
+                (
+                    (label_id, name)
+                    for label_id, name in names.items()
+                    if label_id not in UNTAGGABLE_LABEL_IDS and not label_id.startswith("CATEGORY_")
+                ),
+                key=lambda item: (item[1].casefold(), item[0]),
+            )
+        )
+        return cls(names=names, taggable=taggable, fingerprint=digest.hexdigest())
+
+
 def gmail_http_status(exc: HttpError) -> int | None:
     response = getattr(exc, "resp", None)
     return getattr(response, "status", None)
 
 
+def monitored_label_listing_limit(limit: int) -> int:
+    return max(10, min(limit, 30))
+
+
+def merge_label_listings(listings: List[List[str]], internal_date: Callable[[str], int], limit: int) -> List[str]:
+    heap = [(-internal_date(listing[0]), index, 0) for index, listing in enumerate(listings) if listing]
+    heapq.heapify(heap)
+    seen: set[str] = set()
+    merged: List[str] = []
+    while heap and len(merged) < limit:
+        _, index, position = heapq.heappop(heap)
+        listing = listings[index]
+        if listing[position] not in seen:
+            seen.add(listing[position])
+            merged.append(listing[position])
+            if len(merged) >= limit:
+                break
+        position += 1
+        while position < len(listing) and listing[position] in seen:
+            position += 1
+        if position < len(listing):
+            heapq.heappush(heap, (-internal_date(listing[position]), index, position))
+    return merged
+
+
 class GmailClient:
     def __init__(self, config: Config, service_factory: Callable[[], Any] | None = None):
         self.config = config
         self._lock = threading.RLock()
         self._service: Any = None
-        self._labels: Dict[str, str] = {}
+        self._label_index: LabelIndex | None = None
+        self._labels_fetched_at = 0.0
+        self.label_fetches = 0
+        self.label_changes = 0
+        self._credentials: Credentials | None = None
+        self._refresh_lock = threading.Lock()
+        self._local = threading.local()
+        self._generation = 0
+        self._internal_dates = LRUCache(INTERNAL_DATE_CACHE_SIZE)
+        self.thread_services_built = 0
         self._service_factory = service_factory or self._build_service
 
     def _load_credentials(self) -> Credentials:
@@ -1248,8 +1637,10 @@ class GmailClient:
             return creds
 
         if creds and creds.expired and creds.refresh_token:
+            from google.auth.transport.requests import Request
+
             creds.refresh(Request())
-            self.config.gmail_token_path.write_text(creds.to_json())
+            atomic_write_text(self.config.gmail_token_path, creds.to_json())
             return creds
 
         if not self.config.gmail_credentials_path.exists():
@@ -1257,39 +1648,98 @@ class GmailClient:
                 f"Missing Gmail credentials file at {self.config.gmail_credentials_path}"
             )
 
+        from google_auth_oauthlib.flow import InstalledAppFlow
+
         flow = InstalledAppFlow.from_client_secrets_file(
             str(self.config.gmail_credentials_path),
             SCOPES,
         )
         creds = flow.run_local_server(port=0)
-        self.config.gmail_token_path.write_text(creds.to_json())
+        atomic_write_text(self.config.gmail_token_path, creds.to_json())
         return creds
 
     def _build_service(self) -> Any:
-        creds = self._load_credentials()
-        return build("gmail", "v1", credentials=creds, cache_discovery=False)
+        from googleapiclient.discovery import build, build_from_document
+
+        with self._lock:
+            creds = self._credentials
+        if creds is None:
+            creds = self._load_credentials()
+            with self._lock:
+                self._credentials = creds
+        document = gmail_discovery_document()
+        if document is None:
+            return build("gmail", "v1", credentials=creds, cache_discovery=False)
+        return build_from_document(document, credentials=creds)
 
     def invalidate(self) -> None:
         with self._lock:
             self._service = None
-            self._labels = {}
+            self._label_index = None
+            self._credentials = None
+
+    def refresh_credentials(self, margin_seconds: int = GMAIL_TOKEN_REFRESH_MARGIN_SECONDS) -> bool:
+        with self._lock:
+            creds = self._credentials
+        if creds is None or not creds.refresh_token or creds.expiry is None:
+            return False
+
+        def due() -> bool:
+            remaining = creds.expiry - datetime.now(timezone.utc).replace(tzinfo=None)
+            return remaining <= timedelta(seconds=margin_seconds)
+
+        if not due():
+            return False
+        from google.auth.transport.requests import Request
+
+        with self._refresh_lock:
+            if not due():
+                return False
+            creds.refresh(Request())
+            atomic_write_text(self.config.gmail_token_path, creds.to_json())
+        return True
 
     def get_service(self, force_reinit: bool = False) -> Any:
+        local = self._local
         with self._lock:
             if force_reinit or self._service is None:
+                self._credentials = None
                 self._service = self._service_factory()
-                self._labels = {}
-            return self._service
-
-    def refresh_labels(self, force: bool = False) -> Dict[str, str]:
+                self._label_index = None
+                self._generation += 1
+                self.thread_services_built += 1
+                local.service = self._service
+                local.generation = self._generation
+            generation = self._generation
+        if getattr(local, "generation", None) != generation:
+            service = self._service_factory()
+            with self._lock:
+                self.thread_services_built += 1
+            local.service = service
+            local.generation = generation
+        return local.service
+
+    def _store_labels(self, labels: List[dict]) -> LabelIndex:
+        index = LabelIndex.from_labels(labels)
         with self._lock:
-            if self._labels and not force:
-                return dict(self._labels)
-        labels = self.call(self._fetch_labels_once)
-        mapping = {item["id"]: item["name"] for item in labels}
+            self.label_fetches += 1
+            self._labels_fetched_at = time.monotonic()
+            if self._label_index is not None and self._label_index.fingerprint == index.fingerprint:
+                return self._label_index
+            self.label_changes += 1
+            self._label_index = index
+            return index
+
+    def label_index(self, force: bool = False) -> LabelIndex:
         with self._lock:
-            self._labels = mapping
-        return dict(mapping)
+            index = self._label_index
+            fresh = time.monotonic() - self._labels_fetched_at < GMAIL_LABEL_CACHE_TTL_SECONDS
+            if index is not None and fresh and not force:
+                return index
+        return self._store_labels(self.call(self._fetch_labels_once))
+
+    def refresh_labels(self, force: bool = False) -> Dict[str, str]:
+        return dict(self.label_index(force).names)
 
     @staticmethod
     def _fetch_labels_once(service: Any) -> list[dict]:
@@ -1308,9 +1758,7 @@ class GmailClient:
                     LOGGER.warning("Gmail auth failed with %s. Reinitializing service.", status)
                     reinitialized = self.get_service(force_reinit=True)
                     try:
-                        labels = self._fetch_labels_once(reinitialized)
-                        with self._lock:
-                            self._labels = {item["id"]: item["name"] for item in labels}
+                        self._store_labels(self._fetch_labels_once(reinitialized))
                     except Exception:
                         LOGGER.exception("Failed to refresh Gmail label cache after reinit.")
                     continue
@@ -1354,6 +1802,9 @@ class GmailClient:
         return self.call(fetch)
 
     def get_internal_date(self, gmail_message_id: str) -> int:
+        cached = self._internal_dates.get(gmail_message_id)
+        if cached is not None:
+            return cached
         payload = self.call(
             lambda svc: svc.users()
             .messages()
@@ -1361,29 +1812,23 @@ class GmailClient:
             .execute()
         )
         try:
-            return int(payload.get("internalDate", "0"))
+            internal_date = int(payload.get("internalDate", "0"))
         except (TypeError, ValueError):
             return 0
+        self._internal_dates.put(gmail_message_id, internal_date)
+        return internal_date
 
     def list_recent_monitored_ids(self, label_ids: List[str], limit: int = 100) -> List[str]:
         labels = [label for label in label_ids if label] or ["INBOX"]
         if len(labels) == 1:
             return self.list_recent_label_ids(labels[0], limit=limit)
 
-        per_label_limit = max(10, min(limit, 30))
-        seen: set[str] = set()
-        candidates: List[str] = []
-        for label_id in labels:
-            for message_id in self.list_recent_label_ids(label_id, limit=per_label_limit):
-                if message_id not in seen:
-                    seen.add(message_id)
-                    candidates.append(message_id)
-        ranked = sorted(
-            candidates,
-            key=self.get_internal_date,
-            reverse=True,
-        )
-        return ranked[:limit]
+        per_label_limit = monitored_label_listing_limit(limit)
+        listings = [self.list_recent_label_ids(label_id, limit=per_label_limit) for label_id in labels]
+        return self.merge_recent_listings(listings, limit)
+
+    def merge_recent_listings(self, listings: List[List[str]], limit: int) -> List[str]:
+        return merge_label_listings(listings, self.get_internal_date, limit)
 
     def get_full_message(self, gmail_message_id: str) -> dict:
         return self.call(
@@ -1512,6 +1957,302 @@ class GmailClient:
         return self.call(fetch)
 
 
+class LRUCache:
+    def __init__(self, maxsize: int, ttl_seconds: float | None = None):
+        self.maxsize = max(1, maxsize)
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._items: OrderedDict[Any, tuple[float, Any]] = OrderedDict()
+
+    def get(self, key: Any) -> Any:
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            expires_at, value = item
+            if self.ttl_seconds is not None and expires_at <= time.monotonic():
+                del self._items[key]
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key: Any, value: Any) -> None:
+        expires_at = time.monotonic() + self.ttl_seconds if self.ttl_seconds is not None else 0.0
+        with self._lock:
+            self._items[key] = (expires_at, value)
+            self._items.move_to_end(key)
+            while len(self._items) > self.maxsize:
+                self._items.popitem(last=False)
+
+    def pop(self, key: Any) -> Any:
+        with self._lock:
+            item = self._items.pop(key, None)
+        return item[1] if item is not None else None
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"size": len(self._items), "hits": self.hits, "misses": self.misses}
+
+    def clear(self) -> None:
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self) -> int:
+        with self._lock:
+            return len(self._items)
+
+
+class BootTimer:
+    def __init__(self, clock: Callable[[], float] = time.perf_counter):
+        self._clock = clock
+        self.started_at = clock()
+        self.phases: Dict[str, float] = {}
+        self.ready = asyncio.Event()
+        self.ready_ms: float | None = None
+        self.error: str | None = None
+        self.pending_gmail_pushes: deque[Mapping[str, Any]] = deque(maxlen=BOOT_GMAIL_PUSH_QUEUE_SIZE)
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        started = self._clock()
+        try:
+            yield
+        finally:
+            self.phases[name] = round((self._clock() - started) * 1000, 1)
+
+    def mark_ready(self) -> None:
+        self.ready_ms = round((self._clock() - self.started_at) * 1000, 1)
+        self.ready.set()
+        LOGGER.info(
+            "Boot %s in %.1f ms (%s).",
+            "failed" if self.error else "ready",
+            self.ready_ms,
+            ", ".join(f"{name}={elapsed:.1f}ms" for name, elapsed in self.phases.items()),
+        )
+
+    @property
+    def failed(self) -> bool:
+        return self.error is not None
+
+    def report(self) -> Dict[str, Any]:
+        return {
+            "ready": self.ready.is_set() and not self.failed,
+            "ready_ms": self.ready_ms,
+            "error": self.error,
+            "phases_ms": dict(self.phases),
+            "queued_gmail_pushes": len(self.pending_gmail_pushes),
+        }
+
+
+class PixelEventDeduper:
+    def __init__(self, max_keys: int = PIXEL_DEDUP_MAX_KEYS, clock: Callable[[], float] = time.monotonic):
+        self.max_keys = max(1, max_keys)
+        self.accepted = 0
+        self.suppressed = 0
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._expires: OrderedDict[tuple[str, str, str, str], float] = OrderedDict()
+
+    def seen(self, event: PixelEvent, window_seconds: float) -> bool:
+        if window_seconds <= 0 or not event.pixel_id:
+            with self._lock:
+                self.accepted += 1
+            return False
+        key = (event.pixel_id, event.layer, event.dimensions, event.classification)
+        now = self._clock()
+        with self._lock:
+            while self._expires:
+                oldest_key, oldest_expiry = next(iter(self._expires.items()))
+                if oldest_expiry > now:
+                    break
+                del self._expires[oldest_key]
+            expires_at = self._expires.get(key)
+            if expires_at is not None and expires_at > now:
+                self.suppressed += 1
+                return True
+            self._expires[key] = now + window_seconds
+            self._expires.move_to_end(key)
+            while len(self._expires) > self.max_keys:
+                self._expires.popitem(last=False)
+            self.accepted += 1
+            return False
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return {"tracked": len(self._expires), "accepted": self.accepted, "suppressed": self.suppressed}
+
+
+class GmailExecutor:
+    def __init__(self, max_workers: int = GMAIL_WORKERS):
+        self.max_workers = max(1, max_workers)
+        self.completed = 0
+        self.failed = 0
+        self._queued = 0
+        self._active = 0
+        self._lock = threading.Lock()
+        self._latency: Dict[str, List[int]] = {}
+        self._latency_sum_ms: Dict[str, float] = {}
+        self._pool = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix="gmail")
+
+    def _observe(self, name: str, elapsed_ms: float, ok: bool) -> None:
+        buckets = self._latency.get(name)
+        if buckets is None:
+            buckets = self._latency[name] = [0] * (len(GMAIL_LATENCY_BUCKETS_MS) + 1)
+            self._latency_sum_ms[name] = 0.0
+        index = next(
+            (i for i, bound in enumerate(GMAIL_LATENCY_BUCKETS_MS) if elapsed_ms <= bound),
+            len(GMAIL_LATENCY_BUCKETS_MS),
+        )
+        buckets[index] += 1
+        self._latency_sum_ms[name] += elapsed_ms
+        if ok:
+            self.completed += 1
+        else:
+            self.failed += 1
+
+    async def run(self, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        name = getattr(fn, "__name__", "call")
+
+        def invoke() -> Any:
+            with self._lock:
+                self._queued -= 1
+                self._active += 1
+            started = time.perf_counter()
+            ok = False
+            try:
+                result = fn(*args, **kwargs)
+                ok = True
+                return result
+            finally:
+                elapsed_ms = (time.perf_counter() - started) * 1000
+                with self._lock:
+                    self._active -= 1
+                    self._observe(name, elapsed_ms, ok)
+
+        with self._lock:
+            self._queued += 1
+        try:
+            future = self._pool.submit(invoke)
+        except BaseException:
+            with self._lock:
+                self._queued -= 1
+            raise
+        return await asyncio.wrap_future(future)
+
+    def shutdown(self) -> None:
+        self._pool.shutdown(wait=False, cancel_futures=True)
+
+    def stats(self) -> Dict[str, Any]:
+        labels = [f"le_{bound}" for bound in GMAIL_LATENCY_BUCKETS_MS] + ["le_inf"]
+        with self._lock:
+            return {
+                "workers": self.max_workers,
+                "queued": self._queued,
+                "active": self._active,
+                "completed": self.completed,
+                "failed": self.failed,
+                "latency_ms": {
+                    name: {
+                        "count": sum(buckets),
+                        "sum": round(self._latency_sum_ms[name], 1),
+                        "buckets": dict(zip(labels, buckets)),
+                    }
+                    for name, buckets in sorted(self._latency.items())
+                },
+            }
+
+
+class AttachmentCache:
+    def __init__(self, root: Path, max_bytes: int):
+        self.root = root
+        self.max_bytes = max(0, max_bytes)
+        self._lock = threading.Lock()
+        self._entries: OrderedDict[str, int] = OrderedDict()
+        self._total_bytes = 0
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._load_index()
+
+    @staticmethod
+    def cache_key(gmail_message_id: str, attachment_id: str) -> str:
+        return hashlib.sha256(f"{gmail_message_id}:{attachment_id}".encode("utf-8")).hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.root / f"{key}.bin"
+
+    def _load_index(self) -> None:
+        for leftover in self.root.glob("*.tmp"):
+            leftover.unlink(missing_ok=True)
+        files = []
+        for path in self.root.glob("*.bin"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            files.append((stat.st_mtime, path.stem, stat.st_size))
+        with self._lock:
+            for _, key, size in sorted(files):
+                self._entries[key] = size
+                self._total_bytes += size
+            evicted = self._evict_locked()
+        self._unlink(evicted)
+
+    def _evict_locked(self) -> List[str]:
+        evicted: List[str] = []
+        while self._entries and self._total_bytes > self.max_bytes:
+            key, size = self._entries.popitem(last=False)
+            self._total_bytes -= size
+            evicted.append(key)
+        return evicted
+
+    def _unlink(self, keys: List[str]) -> None:
+        for key in keys:
+            self._path(key).unlink(missing_ok=True)
+
+    @property
+    def total_bytes(self) -> int:
+        with self._lock:
+            return self._total_bytes
+
+    def get(self, key: str) -> bytes | None:
+        with self._lock:
+            if key not in self._entries:
+                return None
+            self._entries.move_to_end(key)
+        path = self._path(key)
+        try:
+            data = path.read_bytes()
+            os.utime(path)
+        except FileNotFoundError:
+            with self._lock:
+                size = self._entries.pop(key, None)
+                if size is not None:
+                    self._total_bytes -= size
+            return None
+        return data
+
+    def put(self, key: str, data: bytes) -> None:
+        size = len(data)
+        if size > self.max_bytes:
+            return
+        path = self._path(key)
+        temp_path = path.with_suffix(f".{uuid4().hex}.tmp")
+        temp_path.write_bytes(data)
+        os.replace(temp_path, path)
+        with self._lock:
+            previous = self._entries.pop(key, None)
+            if previous is not None:
+                self._total_bytes -= previous
+            self._entries[key] = size
+            self._total_bytes += size
+            evicted = self._evict_locked()
+        self._unlink(evicted)
+
+
 @dataclass(slots=True)
 class Runtime:
     base_config: Config
@@ -1523,6 +2264,31 @@ class Runtime:
     shutdown_event: asyncio.Event
     mode: str
     gmail_push_lock: asyncio.Lock | None = None
+    pixel_fast_path: PixelFastPath | None = None
+    boot: BootTimer | None = None
+    attachment_cache: AttachmentCache | None = None
+    parsed_messages: LRUCache = dataclass_field(default_factory=lambda: LRUCache(PARSED_MESSAGE_CACHE_SIZE))
+    tracking_tokens: LRUCache = dataclass_field(
+        default_factory=lambda: LRUCache(TRACKING_TOKEN_CACHE_SIZE, ttl_seconds=TRACKING_TOKEN_CACHE_TTL_SECONDS)
+    )
+    pixel_deduper: PixelEventDeduper = dataclass_field(default_factory=PixelEventDeduper)
+    gmail_executor: GmailExecutor = dataclass_field(default_factory=GmailExecutor)
+
+
+async def gmail_io(runtime: Runtime, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+    return await runtime.gmail_executor.run(fn, *args, **kwargs)
+
+
+async def gmail_recent_monitored_ids(runtime: Runtime, label_ids: List[str], limit: int = 100) -> List[str]:
+    labels = [label for label in label_ids if label] or ["INBOX"]
+    if len(labels) == 1:
+        return await gmail_io(runtime, runtime.gmail.list_recent_label_ids, labels[0], limit)
+
+    per_label_limit = monitored_label_listing_limit(limit)
+    listings = await asyncio.gather(
+        *(gmail_io(runtime, runtime.gmail.list_recent_label_ids, label_id, per_label_limit) for label_id in labels)
+    )
+    return await gmail_io(runtime, runtime.gmail.merge_recent_listings, list(listings), limit)
 
 
 @dataclass(frozen=True, slots=True)
@@ -1679,24 +2445,95 @@ def is_useful_email_text(text: str) -> bool:
     return alpha_count >= min(20, len(compact) // 4)
 
 
-def payload_text(payload: dict) -> str:
-    plain: str | None = None
-    html: str | None = None
+@dataclass(slots=True)
+class ParsedMessage:
+    gmail_message_id: str
+    thread_id: str
+    label_ids: List[str]
+    headers: Dict[str, str]
+    plain: str | None
+    html: str | None
+    attachments: List[dict]
+    cached_body_text: str | None = dataclass_field(default=None, repr=False)
 
-    def visit(part: dict) -> None:
-        nonlocal plain, html
-        mime = part.get("mimeType", "")
-        text = decode_base64_body(part.get("body", {}).get("data"))
-        if text:
-            if mime.startswith("text/plain") and plain is None:
-                plain = text
-            elif mime.startswith("text/html") and html is None:
-                html = text
-        for child in part.get("parts", []):
-            visit(child)
+    @classmethod
+    def from_message(cls, message: Mapping[str, Any], gmail_message_id: str = "") -> "ParsedMessage":
+        return cls.from_payload(
+            message.get("payload") or {},
+            gmail_message_id=gmail_message_id or str(message.get("id") or ""),
+            thread_id=str(message.get("threadId") or ""),
+            label_ids=list(message.get("labelIds") or []),
+        )
+
+    @classmethod
+    def from_payload(
+        cls,
+        payload: Mapping[str, Any],
+        *,
+        gmail_message_id: str = "",
+        thread_id: str = "",
+        label_ids: List[str] | None = None,
+    ) -> "ParsedMessage":
+        headers: Dict[str, str] = {}
+        for item in payload.get("headers") or []:
+            headers.setdefault(str(item.get("name", "")).lower(), item.get("value", ""))
+        plain: str | None = None
+        html: str | None = None
+        attachments: List[dict] = []
+        stack = [payload]
+        while stack:
+            part = stack.pop()
+            body = part.get("body") or {}
+            filename = part.get("filename")
+            if filename:
+                attachments.append(
+                    {
+                        "id": body.get("attachmentId"),
+                        "data": body.get("data"),
+                        "filename": filename,
+                        "size": body.get("size", 0),
+                    }
+                )
+            mime = part.get("mimeType", "")
+            if plain is None and mime.startswith("text/plain"):
+                plain = decode_base64_body(body.get("data")) or None
+            elif html is None and mime.startswith("text/html"):
+                html = decode_base64_body(body.get("data")) or None
+            children = part.get("parts")
+            if children:
+                stack.extend(reversed(children))
+        return cls(
+            gmail_message_id=gmail_message_id,
+            thread_id=thread_id,
+            label_ids=label_ids or [],
+            headers=headers,
+            plain=plain,
+            html=html,
+            attachments=attachments,
+        )
+
+    def header(self, name: str, default: str = "") -> str:
+        return self.headers.get(name.lower(), default)
+
+    @property
+    def subject(self) -> str:
+        return decode_hdr(self.header("subject", "(senza oggetto)")) or "(senza oggetto)"
 
-    visit(payload)
+    @property
+    def sender(self) -> str:
+        return parseaddr(self.header("from", ""))[1]
 
+    @property
+    def starred(self) -> bool:
+        return "STARRED" in self.label_ids
+
+    def body_text(self) -> str:
+        if self.cached_body_text is None:
+            self.cached_body_text = select_body_text(self.plain, self.html)
+        return self.cached_body_text
+
+
+def select_body_text(plain: str | None, html: str | None) -> str:
     normalized_plain = normalize_email_text(plain) if plain else ""
     if normalized_plain and is_useful_email_text(normalized_plain):
         return normalized_plain
@@ -1709,31 +2546,8 @@ def payload_text(payload: dict) -> str:
     return "(corpo non disponibile)"
 
 
-def list_attachments(payload: dict) -> List[dict]:
-    attachments: List[dict] = []
-
-    def visit(part: dict) -> None:
-        filename = part.get("filename")
-        body = part.get("body", {})
-        if filename:
-            attachments.append(
-                {
-                    "id": body.get("attachmentId"),
-                    "data": body.get("data"),
-                    "filename": filename,
-                    "size": body.get("size", 0),
-                }
-            )
-        for child in part.get("parts", []):
-            visit(child)
-
-    visit(payload)
-    return attachments
-
-
-def extract_header(headers: List[dict], name: str, default: str = "") -> str:
-    match = next((item.get("value", "") for item in headers if item.get("name", "").lower() == name.lower()), None)
-    return match if match is not None else default
+def payload_text(payload: dict) -> str:
+    return ParsedMessage.from_payload(payload).body_text()
 
 
 def build_raw(
@@ -1768,25 +2582,96 @@ def encode_raw_email_message(message: email.message.EmailMessage) -> str:
     return base64.urlsafe_b64encode(message.as_bytes()).decode()
 
 
-def append_tracking_to_raw(raw: str, tracking_markup: str) -> str:
-    message = parse_raw_email_message(raw)
+@dataclass(slots=True)
+class PreparedOutbound:
+    raw: str
+    subject: str
+    recipient: str
+
+
+def header_block_end(data: bytes, start: int, end: int) -> tuple[int, int] | None:
+    crlf = data.find(b"\r\n\r\n", start, end)
+    lf = data.find(b"\n\n", start, end)
+    if crlf != -1 and (lf == -1 or crlf < lf):
+        return crlf, crlf + 4
+    if lf != -1:
+        return lf, lf + 2
+    return None
+
+
+def find_html_leaf(data: bytes, start: int, end: int, depth: int = 0) -> tuple[int, int] | None:
+    bounds = header_block_end(data, start, end)
+    if bounds is None or depth > 8:
+        return None
+    headers = BytesHeaderParser(policy=policy.default).parsebytes(data[start : bounds[0]])
+    content_type = headers.get_content_type()
+    if content_type == "text/html":
+        return start, end
+    boundary = headers.get_boundary() if headers.get_content_maintype() == "multipart" else None
+    if not boundary:
+        return None
+    delimiter = b"--" + boundary.encode("ascii")
+    positions: List[int] = []
+    cursor = bounds[1]
+    while True:
+        position = data.find(delimiter, cursor, end)
+        if position == -1:
+            break
+        trailer = data[position + len(delimiter) : position + len(delimiter) + 1]
+        at_line_start = position == bounds[1] or data[position - 1 : position] == b"\n"
+        if at_line_start and trailer in {b"\r", b"\n", b"-", b" ", b"\t", b""}:
+            positions.append(position)
+        cursor = position + len(delimiter)
+    for current, following in zip(positions, positions[1:]):
+        if data.startswith(b"--", current + len(delimiter)):
+            break
+        line_end = data.find(b"\n", current, following)
+        if line_end == -1:
+            return None
+        part_end = following - 1
+        if data[part_end - 1 : part_end] == b"\r":
+            part_end -= 1
+        found = find_html_leaf(data, line_end + 1, part_end, depth + 1)
+        if found is not None:
+            return found
+    return None
+
+
+def splice_tracking_into_raw_bytes(data: bytes, tracking_markup: str) -> bytes | None:
+    top = header_block_end(data, 0, len(data))
+    if top is None:
+        return None
+    leaf = find_html_leaf(data, 0, len(data))
+    if leaf is None or leaf[0] == 0:
+        return None
+    linesep = "\r\n" if data[: top[1]].endswith(b"\r\n\r\n") else "\n"
+    part_policy = policy.default.clone(linesep=linesep)
+    html_part = email.message_from_bytes(data[leaf[0] : leaf[1]], _class=email.message.MIMEPart, policy=part_policy)
+    html_body = html_part.get_content()
+    if tracking_markup in html_body:
+        return data
+    charset = html_part.get_content_charset() or "utf-8"
+    html_part.set_content(html_body + tracking_markup, subtype="html", charset=charset)
+    rendered = html_part.as_bytes(policy=part_policy).rstrip(b"\r\n")
+    return b"".join([data[: leaf[0]], rendered, data[leaf[1] :]])
+
+
+def inject_tracking_into_message(message: email.message.EmailMessage, tracking_markup: str) -> None:
     html_part: email.message.EmailMessage | None = None
+    plain_part: email.message.EmailMessage | None = None
     for part in message.walk():
         if part.is_multipart():
             continue
-        if part.get_content_type() == "text/html":
+        content_type = part.get_content_type()
+        if content_type == "text/html":
             html_part = part
             break
+        if content_type == "text/plain" and plain_part is None:
+            plain_part = part
 
     if html_part is None:
-        plain_text = ""
-        for part in message.walk():
-            if part.is_multipart():
-                continue
-            if part.get_content_type() == "text/plain":
-                plain_text = part.get_content()
-                break
         if message.is_multipart():
+            plain_text = plain_part.get_content() if plain_part is not None else ""
             html_part = email.message.EmailMessage()
             html_part.set_content(
                 ihtml.escape(plain_text).replace("\n", "<br>") + tracking_markup,
@@ -1801,19 +2686,46 @@ def append_tracking_to_raw(raw: str, tracking_markup: str) -> str:
                 ihtml.escape(body_text).replace("\n", "<br>") + tracking_markup,
                 subtype="html",
             )
-        return encode_raw_email_message(message)
+        return
 
     html_body = html_part.get_content()
     if tracking_markup not in html_body:
         html_body += tracking_markup
         charset = html_part.get_content_charset() or "utf-8"
         html_part.set_content(html_body, subtype="html", charset=charset)
-    return encode_raw_email_message(message)
+
+
+def prepare_tracked_raw(raw: str, tracking_markup: str) -> PreparedOutbound:
+    data = b64url_decode(raw)
+    try:
+        spliced = splice_tracking_into_raw_bytes(data, tracking_markup)
+    except (ValueError, LookupError):
+        LOGGER.warning("Could not splice tracking markup into raw draft. Falling back to full MIME rewrite.")
+        spliced = None
+    if spliced is not None:
+        top = header_block_end(spliced, 0, len(spliced))
+        headers = BytesHeaderParser(policy=policy.default).parsebytes(spliced[: top[1]] if top else spliced)
+        return PreparedOutbound(
+            raw=raw if spliced is data else base64.urlsafe_b64encode(spliced).decode(),
+            subject=decode_hdr(headers.get("Subject") or ""),
+            recipient=parseaddr(headers.get("To") or "")[1].strip(),
+        )
+    message = parse_raw_email_message(raw)
+    inject_tracking_into_message(message, tracking_markup)
+    return PreparedOutbound(
+        raw=encode_raw_email_message(message),
+        subject=decode_hdr(message.get("Subject") or ""),
+        recipient=parseaddr(message.get("To") or "")[1].strip(),
+    )
+
+
+def append_tracking_to_raw(raw: str, tracking_markup: str) -> str:
+    return prepare_tracked_raw(raw, tracking_markup).raw
 
 
 def draft_headers_from_raw(raw: str) -> tuple[str, str]:
-    message = parse_raw_email_message(raw)
-    return decode_hdr(message.get("Subject") or ""), parseaddr(message.get("To") or "")[1].strip()
+    headers = BytesHeaderParser(policy=policy.default).parsebytes(b64url_decode(raw))
+    return decode_hdr(headers.get("Subject") or ""), parseaddr(headers.get("To") or "")[1].strip()
 
 
 def tracked_email_enabled(config: Config) -> bool:
@@ -1890,14 +2802,74 @@ def gmail_call(runtime: Runtime, fn: Callable[[Any], Any]) -> Any:
     return runtime.gmail.call(fn)
 
 
+def encode_header_value(value: str) -> str:
+    value = " ".join(value.splitlines())
+    if value.isascii():
+        return value
+    return Header(value, "utf-8").encode()
+
+
+def build_forward_raw(to_addr: str, subject: str, original: bytes) -> str:
+    boundary = f"=_glassyreply_{uuid4().hex}"
+    head = "\r\n".join(
+        [
+            f"To: {encode_header_value(to_addr)}",
+            f"Subject: {encode_header_value('Fwd: ' + subject)}",
+            "MIME-Version: 1.0",
+            f'Content-Type: multipart/mixed; boundary="{boundary}"',
+            "",
+            f"--{boundary}",
+            "Content-Type: text/plain; charset=utf-8",
+            "Content-Transfer-Encoding: 8bit",
+            "",
+            "Inoltro automatico. Messaggio originale in allegato.",
+            f"--{boundary}",
+            "Content-Type: message/rfc822",
+            'Content-Disposition: attachment; filename="original.eml"',
+            "",
+            "",
+        ]
+    )
+    tail = f"\r\n--{boundary}--\r\n"
+    return base64.urlsafe_b64encode(b"".join([head.encode("utf-8"), original, tail.encode("ascii")])).decode()
+
+
 def gmail_forward(runtime: Runtime, gmail_message_id: str, to_addr: str) -> None:
     payload = runtime.gmail.get_raw_message(gmail_message_id)
-    original = email.message_from_bytes(base64.urlsafe_b64decode(payload["raw"].encode()))
-    body = "Inoltro automatico.\n\n--- Messaggio originale ---\n" + payload_text(payload["payload"])
-    raw = build_raw(to_addr, "Fwd: " + original.get("Subject", ""), body, None)
-    runtime.gmail.call(
-        lambda svc: svc.users().messages().send(userId="me", body={"raw": raw}).execute()
+    original = b64url_decode(payload["raw"])
+    parsed = runtime.parsed_messages.get(gmail_message_id)
+    if parsed is not None:
+        subject = parsed.subject
+    else:
+        headers = BytesHeaderParser(policy=policy.default).parsebytes(original)
+        subject = str(headers.get("Subject", "") or "")
+    runtime.gmail.send_raw_message(build_forward_raw(to_addr, subject, original), "")
+
+
+def email_render(state: EmailState) -> EmailRender:
+    render = state.render
+    if render is not None and render.subject == state.subject and render.body == state.body:
+        return render
+    render = EmailRender(
+        subject=state.subject,
+        body=state.body,
+        header_html=f"📧 <b>{ihtml.escape(state.subject or '(senza oggetto)')}</b>",
+        body_html=ihtml.escape(state.body[:TELEGRAM_MAX]),
     )
+    state.render = render
+    return render
+
+
+def rendered_body_override(render: EmailRender, body_override: str) -> str:
+    body_text = body_override[:TELEGRAM_MAX]
+    previous = render.override_source
+    if previous and body_text.startswith(previous):
+        if len(body_text) != len(previous):
+            render.override_html += ihtml.escape(body_text[len(previous):])
+    else:
+        render.override_html = ihtml.escape(body_text)
+    render.override_source = body_text
+    return render.override_html
 
 
 def format_email_text(
@@ -1906,15 +2878,14 @@ def format_email_text(
     body_override: str | None = None,
     status_line: str | None = None,
 ) -> str:
-    body_text = (body_override if body_override is not None else state.body)[:TELEGRAM_MAX]
-    parts = [
-        f"📧 <b>{ihtml.escape(state.subject or '(senza oggetto)')}</b>",
-        "",
-        ihtml.escape(body_text),
-    ]
+    render = email_render(state)
+    if body_override is None:
+        body_html = render.body_html
+    else:
+        body_html = rendered_body_override(render, body_override)
     if status_line:
-        parts.extend(["", "---", ihtml.escape(status_line)])
-    return "\n".join(parts)
+        return f"{render.header_html}\n\n{body_html}\n\n---\n{ihtml.escape(status_line)}"
+    return f"{render.header_html}\n\n{body_html}"
 
 
 def settings_message_text(runtime: Runtime) -> str:
@@ -2052,21 +3023,20 @@ def b64url_decode(data: str) -> bytes:
     return base64.urlsafe_b64decode(data + padding)
 
 
+@functools.lru_cache(maxsize=8)
+def tracking_token_signer(secret: str) -> hmac.HMAC:
+    return hmac.new(secret.encode(), digestmod=hashlib.sha256)
+
+
+def mint_tracking_token(secret: str, tg_message_id: int) -> str:
+    body = TRACKING_TOKEN_STRUCT.pack(TRACKING_TOKEN_VERSION, tg_message_id, os.urandom(6))
+    signer = tracking_token_signer(secret).copy()
+    signer.update(body)
+    return b64url_encode(body + signer.digest()[:TRACKING_TOKEN_MAC_BYTES])
+
+
 def make_tracking_token(config: Config, tg_message_id: int) -> str:
-    payload = b64url_encode(
-        json.dumps(
-            {"tg": tg_message_id, "nonce": uuid4().hex},
-            separators=(",", ":"),
-        ).encode()
-    )
-    signature = b64url_encode(
-        hmac.new(
-            config.pixel_webhook_secret.encode(),
-            payload.encode(),
-            hashlib.sha256,
-        ).digest()
-    )
-    return f"{payload}.{signature}"
+    return mint_tracking_token(config.pixel_webhook_secret, tg_message_id)
 
 
 def make_dashboard_token(config: Config) -> str:
@@ -2112,15 +3082,28 @@ def timing_safe_equal(left: str, right: str) -> bool:
     return hmac.compare_digest(left, right)
 
 
-def parse_tracking_token(config: Config, token: str) -> dict:
-    if not config.pixel_webhook_secret:
-        raise ConfigError("Missing PIXEL_WEBHOOK_SECRET")
-    if "." not in token:
+def parse_compact_tracking_token(secret: str, token: str) -> dict:
+    try:
+        data = b64url_decode(token)
+    except ValueError as exc:
+        raise ConfigError("Malformed pixel token") from exc
+    body_size = TRACKING_TOKEN_STRUCT.size
+    if len(data) != body_size + TRACKING_TOKEN_MAC_BYTES or data[0] != TRACKING_TOKEN_VERSION:
         raise ConfigError("Malformed pixel token")
+    body = data[:body_size]
+    signer = tracking_token_signer(secret).copy()
+    signer.update(body)
+    if not hmac.compare_digest(signer.digest()[:TRACKING_TOKEN_MAC_BYTES], data[body_size:]):
+        raise ConfigError("Invalid pixel token signature")
+    _, tg_message_id, nonce = TRACKING_TOKEN_STRUCT.unpack(body)
+    return {"tg": tg_message_id, "nonce": nonce.hex(), "v": TRACKING_TOKEN_VERSION}
+
+
+def parse_legacy_tracking_token(secret: str, token: str) -> dict:
     payload_part, signature_part = token.rsplit(".", 1)
     expected_signature = b64url_encode(
         hmac.new(
-            config.pixel_webhook_secret.encode(),
+            secret.encode(),
             payload_part.encode(),
             hashlib.sha256,
         ).digest()
@@ -2133,6 +3116,23 @@ def parse_tracking_token(config: Config, token: str) -> dict:
     return payload
 
 
+def parse_tracking_token(config: Config, token: str, cache: LRUCache | None = None) -> dict:
+    if not config.pixel_webhook_secret:
+        raise ConfigError("Missing PIXEL_WEBHOOK_SECRET")
+    cache_key = (config.pixel_webhook_secret, token)
+    if cache is not None:
+        cached = cache.get(cache_key)
+        if cached is not None:
+            return dict(cached)
+    if "." in token:
+        payload = parse_legacy_tracking_token(config.pixel_webhook_secret, token)
+    else:
+        payload = parse_compact_tracking_token(config.pixel_webhook_secret, token)
+    if cache is not None:
+        cache.put(cache_key, dict(payload))
+    return payload
+
+
 def parse_track_request_path(path: str) -> dict | None:
     parts = [part for part in path.split("/") if part]
     if not parts:
@@ -2236,71 +3236,102 @@ def classify_pixel_request(
     }
 
 
-def pixel_asset_response(kind: str) -> Response:
-    headers = {
-        "cache-control": "private, no-cache, no-store, max-age=0, s-maxage=0, must-revalidate, proxy-revalidate",
-        "pragma": "no-cache",
-        "expires": "0",
-        "surrogate-control": "no-store",
-        "cdn-cache-control": "no-store",
-        "cloudflare-cdn-cache-control": "no-store",
-        "vary": "User-Agent, Accept, Accept-Language, Sec-Fetch-Dest, Sec-Fetch-Mode, Sec-Fetch-Site, Purpose, Sec-Purpose, X-Gmail-Fetch-Info",
-        "x-content-type-options": "nosniff",
-        "access-control-allow-origin": "*",
-        "timing-allow-origin": "*",
-        "accept-ranges": "none",
-    }
-    if kind == "font":
-        return Response(
-            PIXEL_PROBE_FONT,
-            headers={**headers, "content-type": "font/woff2"},
-        )
-    return Response(
-        TRANSPARENT_PNG_2X1,
-        headers={**headers, "content-type": "image/png"},
+def pixel_asset_event(
+    config: Config,
+    track_request: Mapping[str, str],
+    headers: Mapping[str, str],
+    args: Mapping[str, str],
+    path: str,
+    cache: LRUCache | None = None,
+) -> Dict[str, Any]:
+    if track_request["kind"] == "legacy":
+        tg_message_id = int(args.get("tg_msg_id", "0") or "0")
+        pixel_id = args.get("id") or uuid4().hex
+    else:
+        payload = parse_tracking_token(config, track_request["token"], cache)
+        tg_message_id = int(payload["tg"])
+        pixel_id = track_request["token"]
+    if not tg_message_id:
+        raise ConfigError("tg_msg_id missing")
+    return classify_pixel_request(
+        headers,
+        tg_message_id=tg_message_id,
+        layer=track_request["layer"],
+        dimensions=track_request["dimensions"],
+        path=path,
+        pixel_id=pixel_id,
     )
 
 
-async def apply_pixel_event(runtime: Runtime, application: Application, event: Mapping[str, Any]) -> None:
-    tg_message_id = int(event.get("tg_msg_id") or 0)
-    if not tg_message_id:
-        raise ConfigError("tg_msg_id missing")
+@dataclass(frozen=True, slots=True)
+class PixelAssetTemplate:
+    body: bytes
+    headers: tuple[tuple[str, str], ...]
+    asgi_headers: tuple[tuple[bytes, bytes], ...]
+
+
+PIXEL_ASSET_HEADERS = (
+    ("cache-control", "private, no-cache, no-store, max-age=0, s-maxage=0, must-revalidate, proxy-revalidate"),
+    ("pragma", "no-cache"),
+    ("expires", "0"),
+    ("surrogate-control", "no-store"),
+    ("cdn-cache-control", "no-store"),
+    ("cloudflare-cdn-cache-control", "no-store"),
+    (
+        "vary",
+        "User-Agent, Accept, Accept-Language, Sec-Fetch-Dest, Sec-Fetch-Mode, Sec-Fetch-Site, Purpose, Sec-Purpose, X-Gmail-Fetch-Info",
+    ),
+    ("x-content-type-options", "nosniff"),
+    ("access-control-allow-origin", "*"),
+    ("timing-allow-origin", "*"),
+    ("accept-ranges", "none"),
+)
 
-    confidence = event.get("confidence")
-    try:
-        confidence_value = float(confidence) if confidence not in (None, "") else None
-    except (TypeError, ValueError):
-        confidence_value = None
-
-    is_user_open = event.get("is_user_open")
-    if is_user_open is None:
-        is_user_open_value = None
-    elif isinstance(is_user_open, bool):
-        is_user_open_value = is_user_open
-    else:
-        is_user_open_value = parse_bool(str(is_user_open), default=False)
 
-    original = runtime.store.get_email_state(tg_message_id)
-    tracked_before = runtime.store.get_tracked_email(tg_message_id)
-    email_subject = event.get("email_subject") or ""
-    classification = str(event.get("classification") or "")
-    layer = str(event.get("layer") or "img")
-    dimensions = str(event.get("dimensions") or "")
-    event_group = pixel_event_group(classification, is_user_open_value)
+def build_pixel_asset_template(content_type: str, body: bytes) -> PixelAssetTemplate:
+    headers = PIXEL_ASSET_HEADERS + (("content-type", content_type), ("content-length", str(len(body))))
+    return PixelAssetTemplate(
+        body=body,
+        headers=headers,
+        asgi_headers=tuple((name.encode("latin-1"), value.encode("latin-1")) for name, value in headers),
+    )
+
+
+PIXEL_ASSET_TEMPLATES = {
+    "image": build_pixel_asset_template("image/png", TRANSPARENT_PNG_2X1),
+    "font": build_pixel_asset_template("font/woff2", PIXEL_PROBE_FONT),
+}
+
+
+def pixel_asset_template(kind: str) -> PixelAssetTemplate:
+    return PIXEL_ASSET_TEMPLATES["font" if kind == "font" else "image"]
+
+
+def pixel_asset_response(kind: str) -> Response:
+    from quart import Response
+
+    template = pixel_asset_template(kind)
+    return Response(template.body, headers=template.headers)
+
+
+def pixel_event_notification_text(
+    runtime: Runtime,
+    event: PixelEvent,
+    original: EmailState | None,
+    tracked_before: TrackedEmail | None,
+    tracked: TrackedEmail | None,
+) -> str:
+    email_subject = event.email_subject
+    classification = event.classification
+    layer = event.layer
+    dimensions = event.dimensions
+    confidence_value = event.confidence
+    event_group = pixel_event_group(classification, event.is_user_open)
     event_time_text = format_user_datetime(
-        str(event.get("received_at") or utcnow_iso()),
+        event.received_at,
         lang=runtime.config.lang,
         timezone_name=runtime.config.resolved_timezone_name(),
     )
-    tracked = runtime.store.record_pixel_event(
-        tg_message_id=tg_message_id,
-        classification=classification,
-        layer=layer,
-        dimensions=dimensions,
-        confidence=confidence_value,
-        is_user_open=is_user_open_value,
-        email_subject=email_subject,
-    )
     if not email_subject:
         if original:
             email_subject = original.subject
@@ -2348,7 +3379,7 @@ async def apply_pixel_event(runtime: Runtime, application: Application, event: M
         text = format_tracked_email_text(tracked, runtime.config, note=note)
     else:
         fallback = EmailState(
-            tg_message_id=tg_message_id,
+            tg_message_id=event.tg_message_id,
             gmail_message_id="",
             gmail_thread_id="",
             sender="",
@@ -2360,7 +3391,10 @@ async def apply_pixel_event(runtime: Runtime, application: Application, event: M
             lang="it",
         )
         text = format_email_text(fallback)
+    return text
+
 
+async def notify_pixel_event(runtime: Runtime, application: Application, tg_message_id: int, text: str) -> None:
     await application.bot.edit_message_text(
         chat_id=runtime.config.chat_id,
         message_id=tg_message_id,
@@ -2370,20 +3404,126 @@ async def apply_pixel_event(runtime: Runtime, application: Application, event: M
     )
 
 
-def apply_runtime_overrides(runtime: Runtime) -> None:
+async def apply_pixel_event(runtime: Runtime, application: Application, event: Mapping[str, Any]) -> None:
+    pixel_event = PixelEvent.from_payload(event)
+    if runtime.pixel_deduper.seen(pixel_event, runtime.config.pixel_dedup_window_seconds):
+        return
+    tg_message_id = pixel_event.tg_message_id
+    original = runtime.store.get_email_state(tg_message_id)
+    tracked_before = runtime.store.get_tracked_email(tg_message_id)
+    tracked = runtime.store.record_pixel_events([pixel_event]).get(tg_message_id)
+    text = pixel_event_notification_text(runtime, pixel_event, original, tracked_before, tracked)
+    await notify_pixel_event(runtime, application, tg_message_id, text)
+
+
+def parse_pixel_event_batch(raw: str) -> List[Any]:
+    text = raw.strip()
+    if not text:
+        return []
+    try:
+        data = json.loads(text)
+    except json.JSONDecodeError:
+        data = None
+        events: List[Any] = []
+        for line_number, line in enumerate(text.splitlines(), start=1):
+            if not line.strip():
+                continue
+            try:
+                events.append(json.loads(line))
+            except json.JSONDecodeError as exc:
+                raise ConfigError(f"Invalid NDJSON at line {line_number}") from exc
+        return events
+    if isinstance(data, dict) and isinstance(data.get("events"), list):
+        return data["events"]
+    if isinstance(data, list):
+        return data
+    if isinstance(data, dict):
+        return [data]
+    raise ConfigError("Unsupported batch payload")
+
+
+async def apply_pixel_events(
+    runtime: Runtime, application: Application, events: List[Mapping[str, Any]]
+) -> Dict[str, int]:
+    summary = {"received": len(events), "recorded": 0, "duplicates": 0, "invalid": 0, "notified": 0, "failed": 0}
+    seen: set[tuple[str, str, str]] = set()
+    accepted: List[PixelEvent] = []
+    for payload in events:
+        try:
+            pixel_event = PixelEvent.from_payload(payload if isinstance(payload, Mapping) else {})
+        except ConfigError:
+            summary["invalid"] += 1
+            continue
+        if pixel_event.pixel_id:
+            key = (pixel_event.pixel_id, pixel_event.layer, pixel_event.dimensions)
+            if key in seen:
+                summary["duplicates"] += 1
+                continue
+            seen.add(key)
+        if runtime.pixel_deduper.seen(pixel_event, runtime.config.pixel_dedup_window_seconds):
+            summary["duplicates"] += 1
+            continue
+        accepted.append(pixel_event)
+    if not accepted:
+        return summary
+
+    latest: Dict[int, PixelEvent] = {}
+    for pixel_event in accepted:
+        latest[pixel_event.tg_message_id] = pixel_event
+    originals = {tg_message_id: runtime.store.get_email_state(tg_message_id) for tg_message_id in latest}
+    tracked_before = {tg_message_id: runtime.store.get_tracked_email(tg_message_id) for tg_message_id in latest}
+    tracked_after = runtime.store.record_pixel_events(accepted)
+    summary["recorded"] = sum(1 for pixel_event in accepted if pixel_event.tg_message_id in tracked_after)
+
+    for tg_message_id, pixel_event in latest.items():
+        text = pixel_event_notification_text(
+            runtime,
+            pixel_event,
+            originals[tg_message_id],
+            tracked_before[tg_message_id],
+            tracked_after.get(tg_message_id),
+        )
+        try:
+            await notify_pixel_event(runtime, application, tg_message_id, text)
+            summary["notified"] += 1
+        except Exception:
+            LOGGER.exception("Pixel batch notification failed for %s.", tg_message_id)
+            summary["failed"] += 1
+    return summary
+
+
+def build_gemini_model(api_key: str, model_name: str) -> Any:
+    import google.generativeai as genai
+
+    genai.configure(api_key=api_key)
+    return genai.GenerativeModel(model_name)
+
+
+def apply_runtime_overrides(runtime: Runtime, touched: Iterable[str] = ()) -> set[str]:
     overrides = runtime.store.get_app_settings()
     merged = runtime.base_config.with_overrides(runtime.startup_overrides).with_overrides(overrides)
     merged.validate_effective(runtime.mode)
+    changed = merged.changed_fields(runtime.config) | set(touched)
     runtime.config = merged
     runtime.gmail.config = runtime.config
-    runtime.config.materialize_google_credentials()
-    runtime.config.materialize_gmail_token()
-    runtime.gmail.invalidate()
-    if runtime.config.google_api_key:
-        genai.configure(api_key=runtime.config.google_api_key)
-        runtime.model = genai.GenerativeModel(runtime.config.ai_model)
-    else:
-        runtime.model = None
+    if "google_oauth_credentials_json" in changed:
+        runtime.config.materialize_google_credentials(force=True)
+    if "google_oauth_token_json" in changed:
+        runtime.config.materialize_gmail_token(force=True)
+    if {"google_oauth_credentials_json", "google_oauth_token_json"} & changed:
+        runtime.gmail.invalidate()
+    if {"google_api_key", "ai_model"} & changed:
+        if runtime.config.google_api_key:
+            runtime.model = build_gemini_model(runtime.config.google_api_key, runtime.config.ai_model)
+        else:
+            runtime.model = None
+    if {"lang", "timezone_name"} & changed:
+        user_datetime_formatter.cache_clear()
+    if {"pixel_webhook_secret", "pixel_base_url", "public_base_url"} & changed:
+        tracking_markup_template.cache_clear()
+        tracking_token_signer.cache_clear()
+        runtime.tracking_tokens.clear()
+    return changed
 
 
 def build_candidate_config(runtime: Runtime, overrides: Mapping[str, str]) -> Config:
@@ -2680,17 +3820,20 @@ def save_runtime_settings(runtime: Runtime, updates: Mapping[str, str]) -> None:
         json.loads(updates["GOOGLE_OAUTH_TOKEN_JSON"])
     for key, value in updates.items():
         runtime.store.set_app_setting(key, value)
-    apply_runtime_overrides(runtime)
-    if "GMAIL_MONITOR_LABELS" in updates:
+    changed = apply_runtime_overrides(
+        runtime,
+        {CONFIG_OVERRIDE_FIELDS[key].attr for key in updates if key in CONFIG_OVERRIDE_FIELDS},
+    )
+    if "gmail_monitor_labels" in changed:
         mark_gmail_initial_sync_pending(runtime)
     if {
-        "PUBLIC_BASE_URL",
-        "GOOGLE_OAUTH_CREDENTIALS_JSON",
-        "GOOGLE_OAUTH_TOKEN_JSON",
-        "GMAIL_PUSH_TOPIC",
-        "GMAIL_PUSH_WEBHOOK_SECRET",
-        "GMAIL_MONITOR_LABELS",
-    } & set(updates):
+        "public_base_url",
+        "google_oauth_credentials_json",
+        "google_oauth_token_json",
+        "gmail_push_topic",
+        "gmail_push_webhook_secret",
+        "gmail_monitor_labels",
+    } & changed:
         runtime.store.set_bot_state(GMAIL_HISTORY_ID_KEY, "")
         runtime.store.set_bot_state(GMAIL_WATCH_EXPIRATION_KEY, "")
 
@@ -2731,6 +3874,8 @@ def parse_google_oauth_state_payload(raw: str) -> dict:
 
 
 def start_google_oauth(runtime: Runtime) -> str:
+    from google_auth_oauthlib.flow import Flow
+
     client_config = google_web_client_config(runtime.config)
     flow = Flow.from_client_config(
         client_config,
@@ -2766,6 +3911,7 @@ BOT_CONFIG_ALIASES = {
     "gmail_monitor_labels": "GMAIL_MONITOR_LABELS",
     "predef_fwd": "PREDEF_FWD",
     "state_retention_days": "STATE_RETENTION_DAYS",
+    "pixel_dedup_window_seconds": "PIXEL_DEDUP_WINDOW_SECONDS",
     "telegram_webhook_url": "TELEGRAM_WEBHOOK_URL",
     "telegram_webhook_secret": "TELEGRAM_WEBHOOK_SECRET",
     "gmail_push_topic": "GMAIL_PUSH_TOPIC",
@@ -2783,12 +3929,7 @@ def normalize_bot_config_key(raw: str) -> str:
     return normalized
 
 
-def build_tracking_markup_for_message_id(config: Config, tg_message_id: int) -> str:
-    if not config.enable_pixel:
-        return ""
-    base_url = config.resolved_pixel_base_url()
-    token = make_tracking_token(config, tg_message_id)
-    nonce = uuid4().hex[:10]
+def tracking_markup_layout(base_url: str, token: str, nonce: str) -> str:
     img_url = f"{base_url}/track/img/2x1/{token}.png?v={nonce}a"
     retina_img_url = f"{base_url}/track/img/4x1/{token}.png?v={nonce}b"
     bg_url = f"{base_url}/track/bg/2x1/{token}.png?v={nonce}c"
@@ -2821,6 +3962,40 @@ def build_tracking_markup_for_message_id(config: Config, tg_message_id: int) ->
     )
 
 
+class TrackingMarkupTemplate:
+    SLOT_PATTERN = re.compile("\x00(token|nonce)\x00")
+
+    def __init__(self, base_url: str, secret: str):
+        self.base_url = base_url
+        self.secret = secret
+        pieces = self.SLOT_PATTERN.split(tracking_markup_layout(base_url, "\x00token\x00", "\x00nonce\x00"))
+        self._chunks = pieces
+        self._token_slots = [index for index in range(1, len(pieces), 2) if pieces[index] == "token"]
+        self._nonce_slots = [index for index in range(1, len(pieces), 2) if pieces[index] == "nonce"]
+
+    def render(self, tg_message_id: int) -> str:
+        chunks = list(self._chunks)
+        token = mint_tracking_token(self.secret, tg_message_id)
+        nonce = uuid4().hex[:10]
+        for index in self._token_slots:
+            chunks[index] = token
+        for index in self._nonce_slots:
+            chunks[index] = nonce
+        return "".join(chunks)
+
+
+@functools.lru_cache(maxsize=8)
+def tracking_markup_template(base_url: str, secret: str) -> TrackingMarkupTemplate:
+    return TrackingMarkupTemplate(base_url, secret)
+
+
+def build_tracking_markup_for_message_id(config: Config, tg_message_id: int) -> str:
+    if not config.enable_pixel:
+        return ""
+    template = tracking_markup_template(config.resolved_pixel_base_url(), config.pixel_webhook_secret)
+    return template.render(tg_message_id)
+
+
 def build_tracking_markup(config: Config, state: EmailState) -> str:
     return build_tracking_markup_for_message_id(config, state.tg_message_id)
 
@@ -2892,6 +4067,31 @@ def message_matches_monitored_labels(payload: dict, label_ids: List[str]) -> boo
     return bool(labels & monitored)
 
 
+def runtime_boot_ready(runtime: Runtime) -> bool:
+    return runtime.boot is None or runtime.boot.ready.is_set()
+
+
+async def wait_for_boot(runtime: Runtime) -> bool:
+    if runtime.boot is None:
+        return True
+    await runtime.boot.ready.wait()
+    return not runtime.boot.failed
+
+
+async def drain_pending_gmail_pushes(runtime: Runtime, application: Application) -> int:
+    if runtime.boot is None:
+        return 0
+    drained = 0
+    while runtime.boot.pending_gmail_pushes:
+        payload = runtime.boot.pending_gmail_pushes.popleft()
+        try:
+            await handle_gmail_push_notification(runtime, application, payload)
+            drained += 1
+        except Exception:
+            LOGGER.exception("Queued Gmail push failed after boot.")
+    return drained
+
+
 def runtime_gmail_push_lock(runtime: Runtime) -> asyncio.Lock:
     lock = runtime.gmail_push_lock
     if lock is None:
@@ -2907,7 +4107,8 @@ async def ensure_gmail_push_watch(
 ) -> dict | None:
     if not gmail_push_ready(runtime.config):
         return None
-    response = await asyncio.to_thread(
+    response = await gmail_io(
+        runtime,
         runtime.gmail.watch_mailbox,
         runtime.config.gmail_push_topic,
         runtime.config.gmail_monitor_labels,
@@ -2925,10 +4126,7 @@ async def recover_gmail_push_history(
     runtime: Runtime,
     application: Application,
 ) -> str | None:
-    recent_ids = await asyncio.to_thread(
-        runtime.gmail.list_recent_monitored_ids,
-        runtime.config.gmail_monitor_labels,
-    )
+    recent_ids = await gmail_recent_monitored_ids(runtime, runtime.config.gmail_monitor_labels)
     last_seen = runtime.store.get_bot_state(LAST_SEEN_KEY)
     unseen_ids, newest_seen = split_unseen_inbox_ids(recent_ids, last_seen)
     for gmail_message_id in unseen_ids:
@@ -2960,7 +4158,8 @@ async def handle_gmail_push_notification(
             return {"status": "primed", "historyId": incoming_history_id, "processed": 0}
 
         try:
-            history_payload = await asyncio.to_thread(
+            history_payload = await gmail_io(
+                runtime,
                 runtime.gmail.list_history,
                 current_history_id,
                 label_ids=runtime.config.gmail_monitor_labels,
@@ -2980,7 +4179,7 @@ async def handle_gmail_push_notification(
         history_rows = history_payload.get("history") or []
         processed_ids: List[str] = []
         for gmail_message_id in extract_history_message_ids(history_rows):
-            payload_full = await asyncio.to_thread(runtime.gmail.get_full_message, gmail_message_id)
+            payload_full = await gmail_io(runtime, runtime.gmail.get_full_message, gmail_message_id)
             if not message_matches_monitored_labels(payload_full, runtime.config.gmail_monitor_labels):
                 continue
             await process_new_email(application, runtime, gmail_message_id, payload=payload_full)
@@ -3116,6 +4315,13 @@ EDITABLE_DASHBOARD_FIELDS = [
         kind="number",
         help_text="Rows older than this are purged from SQLite.",
     ),
+    DashboardField(
+        key="PIXEL_DEDUP_WINDOW_SECONDS",
+        attr="pixel_dedup_window_seconds",
+        label="Pixel dedup window (seconds)",
+        kind="number",
+        help_text="Repeated fetches of the same pixel layer within this window are counted but not stored. 0 disables.",
+    ),
     DashboardField(
         key="TELEGRAM_WEBHOOK_URL",
         attr="telegram_webhook_url",
@@ -3602,13 +4808,8 @@ def kb_main(tg_message_id: int, starred: bool, attachments: List[dict]) -> Inlin
     return InlineKeyboardMarkup(rows)
 
 
-def kb_tag(tg_message_id: int, page: int, labels: Dict[str, str]) -> InlineKeyboardMarkup:
-    valid = [
-        (label_id, name)
-        for label_id, name in labels.items()
-        if label_id not in {"INBOX", "SENT", "TRASH", "SPAM", "DRAFT"}
-        and not label_id.startswith("CATEGORY_")
-    ]
+def kb_tag(tg_message_id: int, page: int, labels: LabelIndex) -> InlineKeyboardMarkup:
+    valid = labels.taggable
     start = page * PAGE_SIZE
     chunk = valid[start : start + PAGE_SIZE]
     rows = [
@@ -3871,7 +5072,7 @@ async def create_tracked_draft(
         include_html_alternative=True,
     )
     try:
-        draft_payload = await asyncio.to_thread(runtime.gmail.create_draft, raw, "")
+        draft_payload = await gmail_io(runtime, runtime.gmail.create_draft, raw, "")
     except Exception as exc:
         LOGGER.exception("Tracked draft creation failed.")
         await safe_edit(
@@ -3914,15 +5115,15 @@ async def send_tracked_draft_from_telegram(
     if not tracked.draft_id:
         raise ConfigError("Questa bozza risulta gia' inviata o non disponibile.")
 
-    raw = await asyncio.to_thread(runtime.gmail.get_draft_raw, tracked.draft_id)
+    raw = await gmail_io(runtime, runtime.gmail.get_draft_raw, tracked.draft_id)
     if not raw:
         raise ConfigError("Gmail non ha restituito il contenuto della bozza.")
     tracking_markup = build_tracking_markup_for_message_id(runtime.config, tg_message_id)
-    final_raw = append_tracking_to_raw(raw, tracking_markup)
-    subject, recipient = draft_headers_from_raw(final_raw)
-    await asyncio.to_thread(runtime.gmail.send_raw_message, final_raw, "")
+    prepared = await asyncio.to_thread(prepare_tracked_raw, raw, tracking_markup)
+    subject, recipient = prepared.subject, prepared.recipient
+    await gmail_io(runtime, runtime.gmail.send_raw_message, prepared.raw, "")
     try:
-        await asyncio.to_thread(runtime.gmail.delete_draft, tracked.draft_id)
+        await gmail_io(runtime, runtime.gmail.delete_draft, tracked.draft_id)
     except Exception:
         LOGGER.exception("Failed to delete tracked draft after send.")
     runtime.store.update_tracked_draft_reference(
@@ -4501,7 +5702,7 @@ async def txt_followup(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
                 disable_web_page_preview=True,
             )
         elif pending.action_kind == "forward":
-            await asyncio.to_thread(gmail_forward, runtime, state.gmail_message_id, message.text.strip())
+            await gmail_io(runtime, gmail_forward, runtime, state.gmail_message_id, message.text.strip())
             await context.bot.send_message(
                 chat_id=runtime.config.chat_id,
                 text=f"Inoltrata a {message.text.strip()}",
@@ -4521,6 +5722,57 @@ async def txt_followup(update: Update, context: ContextTypes.DEFAULT_TYPE) -> No
         )
 
 
+async def load_attachment_bytes(runtime: Runtime, state: EmailState, attachment: dict) -> bytes:
+    data64 = attachment.get("data")
+    if data64:
+        return base64.urlsafe_b64decode(data64)
+    attachment_id = attachment.get("id")
+    if not attachment_id:
+        raise RuntimeError("Attachment data unavailable")
+    cache = runtime.attachment_cache
+    cache_key = AttachmentCache.cache_key(state.gmail_message_id, attachment_id)
+    if cache is not None:
+        cached = await asyncio.to_thread(cache.get, cache_key)
+        if cached is not None:
+            return cached
+    data64 = await gmail_io(
+        runtime,
+        runtime.gmail.get_attachment_data,
+        state.gmail_message_id,
+        attachment_id,
+    )
+    if not data64:
+        raise RuntimeError("Attachment data unavailable")
+    decoded = base64.urlsafe_b64decode(data64)
+    if cache is not None:
+        try:
+            await asyncio.to_thread(cache.put, cache_key, decoded)
+        except OSError:
+            LOGGER.exception("Failed to store attachment in cache.")
+    return decoded
+
+
+async def send_email_attachment(bot: Any, runtime: Runtime, state: EmailState, index: int) -> None:
+    attachment = state.attachments[index]
+    file_id = str(attachment.get("tg_file_id") or "")
+    if file_id:
+        try:
+            await bot.send_document(chat_id=runtime.config.chat_id, document=file_id)
+            return
+        except BadRequest:
+            LOGGER.warning("Telegram rejected cached file_id for attachment. Uploading again.")
+    decoded = await load_attachment_bytes(runtime, state, attachment)
+    sent = await bot.send_document(
+        chat_id=runtime.config.chat_id,
+        document=InputFile(BytesIO(decoded), filename=attachment["filename"]),
+    )
+    document = getattr(sent, "document", None)
+    new_file_id = getattr(document, "file_id", None)
+    if new_file_id and new_file_id != file_id:
+        attachment["tg_file_id"] = new_file_id
+        runtime.store.update_attachments(state.tg_message_id, state.attachments)
+
+
 async def cb_btn(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     if not await ensure_authorized(update, context):
         return
@@ -4581,17 +5833,17 @@ async def cb_btn(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
     if action == "tag":
         page = int(parts[2])
-        labels = await asyncio.to_thread(runtime.gmail.refresh_labels)
+        labels = await gmail_io(runtime, runtime.gmail.label_index)
         await safe_edit(message, markup=kb_tag(tg_message_id, page, labels))
         await query.answer()
         return
 
     if action == "tagset":
         label_id = parts[2]
-        labels = await asyncio.to_thread(runtime.gmail.refresh_labels)
-        await asyncio.to_thread(runtime.gmail.modify_message, state.gmail_message_id, [label_id], None)
+        labels = await gmail_io(runtime, runtime.gmail.label_index)
+        await gmail_io(runtime, runtime.gmail.modify_message, state.gmail_message_id, [label_id], None)
         await safe_edit(message, markup=kb_main(tg_message_id, state.starred, state.attachments))
-        await query.answer(f"🏷️ {labels.get(label_id, label_id)}")
+        await query.answer(f"🏷️ {labels.names.get(label_id, label_id)}")
         return
 
     if action == "back":
@@ -4633,7 +5885,7 @@ async def cb_btn(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         new_state = not state.starred
         add = ["STARRED"] if new_state else None
         rem = None if new_state else ["STARRED"]
-        await asyncio.to_thread(runtime.gmail.modify_message, state.gmail_message_id, add, rem)
+        await gmail_io(runtime, runtime.gmail.modify_message, state.gmail_message_id, add, rem)
         state.starred = new_state
         runtime.store.update_starred(tg_message_id, new_state)
         await safe_edit(message, markup=kb_main(tg_message_id, state.starred, state.attachments))
@@ -4647,22 +5899,8 @@ async def cb_btn(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
 
     if action == "att":
         index = int(parts[2])
-        attachment = state.attachments[index]
         try:
-            data64 = attachment.get("data")
-            if not data64 and attachment.get("id"):
-                data64 = await asyncio.to_thread(
-                    runtime.gmail.get_attachment_data,
-                    state.gmail_message_id,
-                    attachment["id"],
-                )
-            if not data64:
-                raise RuntimeError("Attachment data unavailable")
-            decoded = base64.urlsafe_b64decode(data64)
-            await context.bot.send_document(
-                chat_id=runtime.config.chat_id,
-                document=InputFile(BytesIO(decoded), filename=attachment["filename"]),
-            )
+            await send_email_attachment(context.bot, runtime, state, index)
             await query.answer()
         except Exception as exc:
             LOGGER.exception("Attachment download failed.")
@@ -4675,7 +5913,7 @@ async def cb_btn(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
         return
 
     if action == "fwdto":
-        await asyncio.to_thread(gmail_forward, runtime, state.gmail_message_id, parts[2])
+        await gmail_io(runtime, gmail_forward, runtime, state.gmail_message_id, parts[2])
         await safe_edit(message, markup=kb_main(tg_message_id, state.starred, state.attachments))
         await query.answer("Inoltrata")
         return
@@ -4697,12 +5935,13 @@ async def cb_btn(update: Update, context: ContextTypes.DEFAULT_TYPE) -> None:
     try:
         if action == "send":
             raw = build_raw(state.sender, "Re: " + state.subject, body_to_send, tracking_markup)
-            await asyncio.to_thread(runtime.gmail.send_raw_message, raw, state.gmail_thread_id)
+            await gmail_io(runtime, runtime.gmail.send_raw_message, raw, state.gmail_thread_id)
         elif action == "draft":
             raw = build_raw(state.sender, "Re: " + state.subject, body_to_send, tracking_markup)
-            await asyncio.to_thread(runtime.gmail.create_draft, raw, state.gmail_thread_id)
+            await gmail_io(runtime, runtime.gmail.create_draft, raw, state.gmail_thread_id)
         elif action == "trash":
-            await asyncio.to_thread(
+            await gmail_io(
+                runtime,
                 runtime.gmail.modify_message,
                 state.gmail_message_id,
                 ["TRASH"],
@@ -4734,26 +5973,26 @@ async def process_new_email(
         return
     lang = runtime.config.lang
     if payload is None:
-        payload = await asyncio.to_thread(runtime.gmail.get_full_message, gmail_message_id)
-    message_payload = payload["payload"]
-    headers = message_payload.get("headers", [])
-    subject = decode_hdr(extract_header(headers, "subject", "(senza oggetto)")) or "(senza oggetto)"
-    body = payload_text(message_payload)
-    attachments = list_attachments(message_payload)
-    sender = parseaddr(extract_header(headers, "from", ""))[1]
+        payload = await gmail_io(runtime, runtime.gmail.get_full_message, gmail_message_id)
+    parsed = ParsedMessage.from_message(payload, gmail_message_id)
+    runtime.parsed_messages.put(gmail_message_id, parsed)
+    subject = parsed.subject
+    body = parsed.body_text()
+    attachments = parsed.attachments
+    sender = parsed.sender
     tg_message = await application.bot.send_message(
         chat_id=runtime.config.chat_id,
         text=format_email_text(
             EmailState(
                 tg_message_id=0,
                 gmail_message_id=gmail_message_id,
-                gmail_thread_id=payload.get("threadId", ""),
+                gmail_thread_id=parsed.thread_id,
                 sender=sender,
                 subject=subject,
                 body=body,
                 header=f"📧 {subject}",
                 attachments=attachments,
-                starred="STARRED" in payload.get("labelIds", []),
+                starred=parsed.starred,
                 lang=lang,
             ),
             status_line="Premi 🤖 Analizza AI o ✏️ Scrivi manuale. Puoi anche usare 💾 Bozza per completare la reply in Gmail.",
@@ -4764,13 +6003,13 @@ async def process_new_email(
     state = EmailState(
         tg_message_id=tg_message.message_id,
         gmail_message_id=gmail_message_id,
-        gmail_thread_id=payload.get("threadId", ""),
+        gmail_thread_id=parsed.thread_id,
         sender=sender,
         subject=subject,
         body=body,
         header=f"📧 {subject}",
         attachments=attachments,
-        starred="STARRED" in payload.get("labelIds", []),
+        starred=parsed.starred,
         lang=lang,
     )
     runtime.store.upsert_email_state(state)
@@ -4785,11 +6024,7 @@ async def bootstrap_gmail_mailbox(runtime: Runtime, application: Application) ->
     if not gmail_ready_for_watch(runtime.config):
         return None
     try:
-        recent_ids = await asyncio.to_thread(
-            runtime.gmail.list_recent_monitored_ids,
-            runtime.config.gmail_monitor_labels,
-            1,
-        )
+        recent_ids = await gmail_recent_monitored_ids(runtime, runtime.config.gmail_monitor_labels, 1)
         if recent_ids:
             if gmail_initial_sync_pending(runtime):
                 await process_new_email(application, runtime, recent_ids[0])
@@ -4802,6 +6037,33 @@ async def bootstrap_gmail_mailbox(runtime: Runtime, application: Application) ->
     return last_seen
 
 
+def persist_refreshed_gmail_token(runtime: Runtime) -> None:
+    if not runtime.config.google_oauth_token_json:
+        return
+    token_json = runtime.config.gmail_token_path.read_text(encoding="utf-8")
+    runtime.store.set_app_setting("GOOGLE_OAUTH_TOKEN_JSON", token_json)
+    runtime.config = replace(runtime.config, google_oauth_token_json=token_json)
+    runtime.gmail.config = runtime.config
+    runtime.config.materialize_gmail_token()
+
+
+async def gmail_token_refresher(runtime: Runtime) -> None:
+    while not runtime.shutdown_event.is_set():
+        if gmail_ready_for_watch(runtime.config):
+            try:
+                if await gmail_io(runtime, runtime.gmail.refresh_credentials):
+                    persist_refreshed_gmail_token(runtime)
+                    LOGGER.info("Gmail access token refreshed ahead of expiry.")
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                LOGGER.exception("Gmail token refresh failed.")
+        try:
+            await asyncio.wait_for(runtime.shutdown_event.wait(), timeout=GMAIL_TOKEN_REFRESH_LOOP_SECONDS)
+        except asyncio.TimeoutError:
+            continue
+
+
 async def watcher(runtime: Runtime, application: Application) -> None:
     if not gmail_ready_for_watch(runtime.config):
         LOGGER.info("Watcher waiting for owner/Gmail setup.")
@@ -4839,10 +6101,7 @@ async def watcher(runtime: Runtime, application: Application) -> None:
                 continue
             continue
         try:
-            recent_ids = await asyncio.to_thread(
-                runtime.gmail.list_recent_monitored_ids,
-                runtime.config.gmail_monitor_labels,
-            )
+            recent_ids = await gmail_recent_monitored_ids(runtime, runtime.config.gmail_monitor_labels)
             if recent_ids:
                 unseen_ids, newest_seen = split_unseen_inbox_ids(recent_ids, last_seen)
                 if unseen_ids:
@@ -4880,6 +6139,9 @@ async def on_err(update: object, context: ContextTypes.DEFAULT_TYPE) -> None:
 
 
 def create_web_app(runtime: Runtime, application: Application) -> Quart:
+    from google_auth_oauthlib.flow import Flow
+    from quart import Quart, jsonify, request
+
     app = Quart(__name__)
 
     def dashboard_token_from_request() -> str | None:
@@ -4903,6 +6165,12 @@ def create_web_app(runtime: Runtime, application: Application) -> Quart:
                 "mode": runtime.mode,
                 "gmail_push_ready": gmail_push_ready(runtime.config),
                 "gmail_push_topic": bool(runtime.config.gmail_push_topic),
+                "tracking_token_cache": runtime.tracking_tokens.stats(),
+                "pixel_fast_path": runtime.pixel_fast_path.stats() if runtime.pixel_fast_path else None,
+                "pixel_dedup": runtime.pixel_deduper.stats(),
+                "gmail_executor": runtime.gmail_executor.stats(),
+                "credential_files": CREDENTIAL_FILES.stats(),
+                "boot": runtime.boot.report() if runtime.boot else None,
             }
         )
 
@@ -5020,20 +6288,13 @@ def create_web_app(runtime: Runtime, application: Application) -> Quart:
         if not track_request:
             return "Not Found", 404
         try:
-            if track_request["kind"] == "legacy":
-                tg_message_id = int(request.args.get("tg_msg_id", "0") or "0")
-                pixel_id = request.args.get("id") or uuid4().hex
-            else:
-                payload = parse_tracking_token(runtime.config, track_request["token"])
-                tg_message_id = int(payload["tg"])
-                pixel_id = track_request["token"]
-            event = classify_pixel_request(
+            event = pixel_asset_event(
+                runtime.config,
+                track_request,
                 request.headers,
-                tg_message_id=tg_message_id,
-                layer=track_request["layer"],
-                dimensions=track_request["dimensions"],
-                path=request.path,
-                pixel_id=pixel_id,
+                request.args,
+                request.path,
+                runtime.tracking_tokens,
             )
             await apply_pixel_event(runtime, application, event)
         except ConfigError:
@@ -5049,6 +6310,8 @@ def create_web_app(runtime: Runtime, application: Application) -> Quart:
             return jsonify({"status": "unauthorized"}), 401
 
         data = await request.get_json(silent=True) or {}
+        if not await wait_for_boot(runtime):
+            return jsonify({"status": "error", "message": "boot failed"}), 503
         try:
             await apply_pixel_event(runtime, application, data)
             return jsonify({"status": "success"}), 200
@@ -5058,6 +6321,26 @@ def create_web_app(runtime: Runtime, application: Application) -> Quart:
             LOGGER.exception("Pixel webhook update failed.")
             return jsonify({"status": "error", "message": str(exc)}), 500
 
+    @app.post("/pixel_status/batch")
+    async def pixel_status_batch():
+        if request.headers.get("X-Pixel-Secret") != runtime.config.pixel_webhook_secret:
+            return jsonify({"status": "unauthorized"}), 401
+
+        try:
+            events = parse_pixel_event_batch(await request.get_data(as_text=True))
+        except ConfigError as exc:
+            return jsonify({"status": "error", "message": str(exc)}), 400
+        if len(events) > PIXEL_BATCH_MAX_EVENTS:
+            return jsonify({"status": "error", "message": f"max {PIXEL_BATCH_MAX_EVENTS} events per batch"}), 413
+        if not await wait_for_boot(runtime):
+            return jsonify({"status": "error", "message": "boot failed"}), 503
+        try:
+            summary = await apply_pixel_events(runtime, application, events)
+            return jsonify({"status": "success", **summary}), 200
+        except Exception as exc:
+            LOGGER.exception("Pixel batch webhook failed.")
+            return jsonify({"status": "error", "message": str(exc)}), 500
+
     @app.post("/gmail/push")
     async def gmail_push():
         secret = request.args.get("secret") or request.headers.get("X-Gmail-Push-Secret")
@@ -5066,6 +6349,12 @@ def create_web_app(runtime: Runtime, application: Application) -> Quart:
         body = await request.get_json(silent=True) or {}
         try:
             payload = decode_pubsub_push_payload(body)
+            if not runtime_boot_ready(runtime):
+                assert runtime.boot is not None
+                if not gmail_push_ready(runtime.config):
+                    raise ConfigError("Gmail push is not configured yet")
+                runtime.boot.pending_gmail_pushes.append(payload)
+                return jsonify({"status": "queued", "historyId": str(payload.get("historyId") or "")}), 202
             result = await handle_gmail_push_notification(runtime, application, payload)
             return jsonify(result), 200
         except ConfigError as exc:
@@ -5090,7 +6379,114 @@ def create_web_app(runtime: Runtime, application: Application) -> Quart:
     return app
 
 
-async def run_http_server(runtime: Runtime, web_app: Quart) -> None:
+PIXEL_NOT_FOUND_HEADERS = ((b"content-type", b"text/plain; charset=utf-8"), (b"content-length", b"9"))
+
+
+class PixelFastPath:
+    def __init__(self, app: Any, runtime: Runtime, application: Application, queue_size: int = PIXEL_EVENT_QUEUE_SIZE):
+        self.app = app
+        self.runtime = runtime
+        self.application = application
+        self.queue_size = queue_size
+        self.queue: asyncio.Queue[Dict[str, Any]] | None = None
+        self.worker: asyncio.Task[Any] | None = None
+        self.served = 0
+        self.rejected = 0
+        self.dropped = 0
+
+    async def __call__(self, scope: Dict[str, Any], receive: Callable[..., Any], send: Callable[..., Any]) -> None:
+        if scope["type"] != "http" or scope["method"] not in {"GET", "HEAD"}:
+            await self.app(scope, receive, send)
+            return
+        path = scope["path"]
+        track_request = parse_track_request_path(path) if path == "/pixel" or path.startswith("/track/") else None
+        if not track_request:
+            await self.app(scope, receive, send)
+            return
+        try:
+            event = self.classify(scope, track_request)
+        except ConfigError:
+            LOGGER.warning("Pixel asset request rejected: %s", path)
+            self.rejected += 1
+            await send({"type": "http.response.start", "status": 404, "headers": PIXEL_NOT_FOUND_HEADERS})
+            await send({"type": "http.response.body", "body": b"Not Found" if scope["method"] == "GET" else b""})
+            return
+        except Exception:
+            LOGGER.exception("Self-hosted pixel handling failed.")
+            event = None
+        if event is not None:
+            self.enqueue(event)
+        template = pixel_asset_template(track_request["kind"])
+        self.served += 1
+        await send({"type": "http.response.start", "status": 200, "headers": template.asgi_headers})
+        await send({"type": "http.response.body", "body": template.body if scope["method"] == "GET" else b""})
+
+    def classify(self, scope: Mapping[str, Any], track_request: Mapping[str, str]) -> Dict[str, Any]:
+        headers: Dict[str, str] = {}
+        for name, value in scope.get("headers") or ():
+            headers.setdefault(name.decode("latin-1").lower(), value.decode("latin-1"))
+        args: Dict[str, str] = {}
+        for key, value in parse_qsl(scope.get("query_string", b"").decode("latin-1")):
+            args.setdefault(key, value)
+        return pixel_asset_event(
+            self.runtime.config, track_request, headers, args, scope["path"], self.runtime.tracking_tokens
+        )
+
+    def enqueue(self, event: Dict[str, Any]) -> None:
+        if self.queue is None:
+            self.queue = asyncio.Queue(maxsize=self.queue_size)
+        if self.worker is None or self.worker.done():
+            self.worker = asyncio.create_task(self.drain())
+        try:
+            self.queue.put_nowait(event)
+        except asyncio.QueueFull:
+            self.dropped += 1
+            LOGGER.warning("Pixel event queue full; dropping event for %s.", event.get("tg_msg_id"))
+
+    async def drain(self) -> None:
+        assert self.queue is not None
+        booted = await wait_for_boot(self.runtime)
+        if not booted:
+            LOGGER.warning("Boot failed: queued pixel events will be discarded.")
+        while True:
+            event = await self.queue.get()
+            try:
+                if not booted:
+                    self.dropped += 1
+                    continue
+                await apply_pixel_event(self.runtime, self.application, event)
+            except ConfigError as exc:
+                LOGGER.warning("Pixel event discarded: %s", exc)
+            except Exception:
+                LOGGER.exception("Pixel event processing failed.")
+            finally:
+                self.queue.task_done()
+
+    async def close(self, timeout: float = 5.0) -> None:
+        if self.worker is None:
+            return
+        if self.queue is not None:
+            try:
+                await asyncio.wait_for(self.queue.join(), timeout)
+            except asyncio.TimeoutError:
+                LOGGER.warning("Pixel event queue not drained before shutdown (%s pending).", self.queue.qsize())
+        self.worker.cancel()
+        await asyncio.gather(self.worker, return_exceptions=True)
+        self.worker = None
+
+    def stats(self) -> Dict[str, int]:
+        return {
+            "served": self.served,
+            "rejected": self.rejected,
+            "dropped": self.dropped,
+            "queued": self.queue.qsize() if self.queue is not None else 0,
+        }
+
+
+async def run_http_server(runtime: Runtime, web_app: Any) -> None:
+    from hypercorn.asyncio import serve
+    from hypercorn.config import Config as HypercornConfig
+
     server_config = HypercornConfig()
     server_config.bind = [f"{runtime.config.host}:{runtime.config.port}"]
     server_config.use_reloader = False
@@ -5112,6 +6508,8 @@ def install_signal_handlers(shutdown_event: asyncio.Event) -> None:
 
 
 def build_application(runtime: Runtime) -> Application:
+    from telegram.ext import Application, CallbackQueryHandler, CommandHandler, MessageHandler, filters
+
     application = (
         Application.builder()
         .token(runtime.config.bot_token)
@@ -5184,78 +6582,132 @@ def parse_args() -> argparse.Namespace:
     parser.add_argument("--interval", type=int, default=None)
     parser.add_argument("--lang", default=None)
     parser.add_argument("--mode", choices=["polling", "webhook"], default="polling")
+    parser.add_argument("--fast-boot", action="store_true")
     return parser.parse_args()
 
 
+async def load_gmail_labels_for_boot(runtime: Runtime) -> str | None:
+    if not gmail_ready_for_watch(runtime.config):
+        return None
+    assert runtime.boot is not None
+    with runtime.boot.phase("gmail_labels"):
+        try:
+            await gmail_io(runtime, runtime.gmail.refresh_labels, True)
+        except Exception as exc:
+            LOGGER.exception("Initial Gmail label load failed.")
+            return str(exc)
+    return None
+
+
+async def bootstrap_telegram_for_boot(application: Application, runtime: Runtime, mode: str) -> None:
+    assert runtime.boot is not None
+    with runtime.boot.phase("telegram"):
+        await bootstrap_telegram(application, runtime, mode)
+
+
+async def bootstrap_services(runtime: Runtime, application: Application, mode: str, *, concurrent: bool) -> None:
+    assert runtime.boot is not None
+    try:
+        if concurrent:
+            gmail_bootstrap_error, _ = await asyncio.gather(
+                load_gmail_labels_for_boot(runtime),
+                bootstrap_telegram_for_boot(application, runtime, mode),
+            )
+        else:
+            gmail_bootstrap_error = await load_gmail_labels_for_boot(runtime)
+            await bootstrap_telegram_for_boot(application, runtime, mode)
+    except BaseException as exc:
+        runtime.boot.error = str(exc) or type(exc).__name__
+        raise
+    finally:
+        runtime.boot.mark_ready()
+    startup_notice = startup_notice_text(runtime, gmail_bootstrap_error)
+    if startup_notice:
+        with runtime.boot.phase("startup_notice"):
+            try:
+                await application.bot.send_message(
+                    chat_id=runtime.config.chat_id,
+                    text=startup_notice,
+                    disable_web_page_preview=True,
+                )
+            except Exception:
+                LOGGER.exception("Failed to deliver startup notice to Telegram.")
+    drained = await drain_pending_gmail_pushes(runtime, application)
+    if drained:
+        LOGGER.info("Processed %s Gmail push notification(s) queued during boot.", drained)
+
+
 async def run(args: argparse.Namespace) -> None:
-    base_config = Config.from_env()
-    startup_overrides: Dict[str, str] = {}
-    if args.interval is not None:
-        startup_overrides["WATCH_INTERVAL"] = str(args.interval)
-    if args.lang:
-        startup_overrides["LANG"] = args.lang
-    base_config.ensure_storage()
+    boot = BootTimer()
+    fast_boot = bool(args.fast_boot) or parse_bool(os.environ.get("FAST_BOOT"), False)
+    with boot.phase("config"):
+        base_config = Config.from_env()
+        startup_overrides: Dict[str, str] = {}
+        if args.interval is not None:
+            startup_overrides["WATCH_INTERVAL"] = str(args.interval)
+        if args.lang:
+            startup_overrides["LANG"] = args.lang
+        base_config.ensure_storage()
 
     logging.basicConfig(
         level=logging.INFO,
         format="%(asctime)s %(levelname)s %(name)s: %(message)s",
     )
 
-    store = StateStore(base_config.state_db_path)
-    stored_overrides = store.get_app_settings()
-    config = base_config.with_overrides(stored_overrides).with_overrides(startup_overrides)
-    config.validate_effective(args.mode)
-    config.materialize_google_credentials()
-    config.materialize_gmail_token()
-    store.purge_old_rows(config.state_retention_days)
-
-    model: Any = None
-    if config.google_api_key:
-        genai.configure(api_key=config.google_api_key)
-        model = genai.GenerativeModel(config.ai_model)
-
-    runtime = Runtime(
-        base_config=base_config,
-        config=config,
-        startup_overrides=startup_overrides,
-        store=store,
-        gmail=GmailClient(config),
-        model=model,
-        shutdown_event=asyncio.Event(),
-        mode=args.mode,
-    )
-    install_signal_handlers(runtime.shutdown_event)
+    with boot.phase("state"):
+        store = StateStore(base_config.state_db_path)
+        stored_overrides = store.get_app_settings()
+        config = base_config.with_overrides(stored_overrides).with_overrides(startup_overrides)
+        config.validate_effective(args.mode)
+        config.materialize_google_credentials()
+        config.materialize_gmail_token()
+        store.purge_old_rows(config.state_retention_days)
+
+    with boot.phase("runtime"):
+        model: Any = None
+        if config.google_api_key:
+            model = build_gemini_model(config.google_api_key, config.ai_model)
+
+        runtime = Runtime(
+            base_config=base_config,
+            config=config,
+            startup_overrides=startup_overrides,
+            store=store,
+            gmail=GmailClient(config),
+            model=model,
+            shutdown_event=asyncio.Event(),
+            mode=args.mode,
+            attachment_cache=(
+                AttachmentCache(config.data_dir / "attachments", config.attachment_cache_max_mb * 1024 * 1024)
+                if config.attachment_cache_max_mb > 0
+                else None
+            ),
+            boot=boot,
+            gmail_executor=GmailExecutor(config.gmail_workers),
+        )
+        install_signal_handlers(runtime.shutdown_event)
 
-    application = build_application(runtime)
-    web_app = create_web_app(runtime, application)
+        application = build_application(runtime)
+        web_app = PixelFastPath(create_web_app(runtime, application), runtime, application)
+        runtime.pixel_fast_path = web_app
     http_task: asyncio.Task[Any] | None = None
     watcher_task: asyncio.Task[Any] | None = None
+    refresh_task: asyncio.Task[Any] | None = None
     stop_task: asyncio.Task[Any] | None = None
 
-    if gmail_ready_for_watch(runtime.config):
-        try:
-            await asyncio.to_thread(runtime.gmail.refresh_labels, True)
-            gmail_bootstrap_error = None
-        except Exception as exc:
-            LOGGER.exception("Initial Gmail label load failed.")
-            gmail_bootstrap_error = str(exc)
-    else:
-        gmail_bootstrap_error = None
+    async def boot_then_watch() -> None:
+        await bootstrap_services(runtime, application, args.mode, concurrent=True)
+        await watcher(runtime, application)
 
     try:
-        await bootstrap_telegram(application, runtime, args.mode)
-        startup_notice = startup_notice_text(runtime, gmail_bootstrap_error)
-        if startup_notice:
-            try:
-                await application.bot.send_message(
-                    chat_id=runtime.config.chat_id,
-                    text=startup_notice,
-                    disable_web_page_preview=True,
-                )
-            except Exception:
-                LOGGER.exception("Failed to deliver startup notice to Telegram.")
-        http_task = asyncio.create_task(run_http_server(runtime, web_app))
-        watcher_task = asyncio.create_task(watcher(runtime, application))
+        if fast_boot:
+            http_task = asyncio.create_task(run_http_server(runtime, web_app))
+            watcher_task = asyncio.create_task(boot_then_watch())
+        else:
+            await bootstrap_services(runtime, application, args.mode, concurrent=False)
+            http_task = asyncio.create_task(run_http_server(runtime, web_app))
+            watcher_task = asyncio.create_task(watcher(runtime, application))
+        refresh_task = asyncio.create_task(gmail_token_refresher(runtime))
         stop_task = asyncio.create_task(runtime.shutdown_event.wait())
 
         done, _ = await asyncio.wait(
@@ -5273,14 +6725,19 @@ async def run(args: argparse.Namespace) -> None:
         if watcher_task:
             watcher_task.cancel()
             await asyncio.gather(watcher_task, return_exceptions=True)
+        if refresh_task:
+            refresh_task.cancel()
+            await asyncio.gather(refresh_task, return_exceptions=True)
         if http_task:
             await asyncio.gather(http_task, return_exceptions=True)
+        await web_app.close()
         if stop_task:
             stop_task.cancel()
             await asyncio.gather(stop_task, return_exceptions=True)
         try:
             await shutdown_telegram(application, runtime, args.mode)
         finally:
+            runtime.gmail_executor.shutdown()
             store.close()
 
 